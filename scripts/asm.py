@@ -330,26 +330,25 @@ def write_binary(args, items):
     if args.verbose:
         print(f'- Writing binary: {args.output}')
 
-    mem_size = 0
-    with open(args.output, 'wb') as f:
-        for item in items:
-            # Labels have no encoding.
-            if isinstance(item, Label):
-                continue
-
-            if isinstance(item, Int):
-                f.write(struct.pack('>h', item.value))
-                mem_size += 1
-            else:
-                f.write(item.encode())
-                mem_size += item.size()
+    # Encode everything into one buffer, which is padded out with NOP
+    # instructions so we don't get uninitialised accesses due to the pipeline
+    # lookahead.
+    nop = isa.Instruction()
+    items = [x for x in items if not isinstance(x, Label)] + [nop] * 4
+
+    mem_size = sum(1 if isinstance(x, Int) else x.size() for x in items)
+    data = bytearray(mem_size * 2)
+    offset = 0
 
-        # Pad out with NOP instructions so we don't get uninitialised accesses
-        # due to the pipeline lookahead.
-        for _ in range(4):
-            f.write(isa.Instruction().encode())
-            mem_size += 1
+    for item in items:
+        if isinstance(item, Int):
+            struct.pack_into('>h', data, offset, item.value)
+            offset += 2
+        else:
+            offset = item.encode_into(data, offset)
 
+    with open(args.output, 'wb') as f:
+        f.write(data)
 
     # Check we haven't exceed the maximum supported memory size.
     if mem_size > (1 << 16):
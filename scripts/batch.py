@@ -0,0 +1,1101 @@
+import argparse
+import collections
+import pathlib
+import time
+
+import numpy as np
+
+import isa
+import sim
+
+
+# Result of running a single lane of the batch:
+# - reason          Why the lane stopped. This is 'uart' once the sentinel and
+#                   trailer have been written, 'halt' or 'idle' if it got
+#                   stuck, 'limit' if it reached the maximum number of
+#                   instructions, or 'error'.
+# - instructions    Number of instructions executed by the lane.
+# - error           Description of the error if the lane failed.
+LaneResult = collections.namedtuple('LaneResult', 'reason instructions error')
+
+
+# Initial size of the UART output buffer of each lane in bytes. This is doubled
+# whenever a lane runs out of space.
+UART_OUT_SIZE = 256
+
+
+# State of a lane other than memory compared to find when it's stuck in a loop,
+# which is the same as compared by sim.Idle, in order from cheapest to compare.
+_IDLE_REGS = tuple(
+    x for x in sim.IdleState._fields if x not in ('mem', 'mem_valid')
+)
+
+
+# Convert values from unsigned to signed. This matches sim._make_signed, so
+# negative immediates are moved down by a further 64K.
+def _signed(value, bits=16):
+    sign_bit = 1 << (bits - 1)
+    return np.where(value & sign_bit, value - (1 << bits), value)
+
+
+# Simulator running many copies of the same binary in lockstep, each with its
+# own UART input. The state of every lane is held in NumPy arrays, and on each
+# step lanes are grouped by the instruction they're executing so each group
+# can be run as a single vector operation. Lanes stop once they've written the
+# sentinel and trailer to the UART, if they hit an error, or if halt detection
+# is enabled and they halt or get stuck in a loop. The results match running
+# each lane on sim.Idli with a UartSentinel, and Halted and Idle if detecting
+# halts, except that the state of a lane which hits an error isn't defined.
+class IdliBatch:
+    def __init__(
+        self,
+        path,
+        uart_in,
+        sentinel=b'END',
+        trailer=2,
+        halt_detect=True,
+    ):
+        lanes = len(uart_in)
+
+        self.lanes = lanes
+        self.sentinel = np.frombuffer(sentinel, dtype=np.uint8)
+        self.trailer = trailer
+        self.halt_detect = halt_detect
+
+        # Architectural state of each lane. GREGs and PREGs have a flag for
+        # whether they've been initialised, with PT always set.
+        self.pc = np.zeros(lanes, dtype=np.int64)
+        self.gregs = np.zeros((lanes, 8), dtype=np.int64)
+        self.greg_valid = np.zeros((lanes, 8), dtype=bool)
+        self.pregs = np.zeros((lanes, 4), dtype=bool)
+        self.preg_valid = np.zeros((lanes, 4), dtype=bool)
+
+        self.pregs[:, isa.PREGS['pt']] = True
+        self.preg_valid[:, isa.PREGS['pt']] = True
+
+        # Every lane starts with the same memory image. As with sim.Idli words
+        # are held in the order the core sees them, with a flag for each word
+        # marking whether it has been initialised.
+        mem, mem_valid = sim.load_binary(path)
+        mem_valid = np.unpackbits(
+            np.frombuffer(mem_valid, dtype=np.uint8),
+            bitorder='little',
+        )
+
+        self.mem = np.tile(np.frombuffer(mem, dtype=np.uint16), (lanes, 1))
+        self.mem_valid = np.tile(mem_valid.astype(bool), (lanes, 1))
+
+        # UART input for each lane, padded so reads past the end of the input
+        # are still in bounds. The number of bytes read is the position in the
+        # input, and the number written is the size of the output.
+        in_size = max((len(x) for x in uart_in), default=0)
+        self.uart_in = np.zeros((lanes, in_size + 2), dtype=np.uint8)
+        self.uart_in_size = np.zeros(lanes, dtype=np.int64)
+
+        for i, data in enumerate(uart_in):
+            self.uart_in[i, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+            self.uart_in_size[i] = len(data)
+
+        self.uart_out = np.zeros((lanes, UART_OUT_SIZE), dtype=np.uint8)
+        self.uart_rx = np.zeros(lanes, dtype=np.int64)
+        self.uart_tx = np.zeros(lanes, dtype=np.int64)
+
+        # Status of each lane. The end position is where the sentinel was found
+        # in the output of lanes which finished.
+        self.running = np.ones(lanes, dtype=bool)
+        self.failed = np.zeros(lanes, dtype=bool)
+        self.halted = np.zeros(lanes, dtype=bool)
+        self.idled = np.zeros(lanes, dtype=bool)
+        self.errors = [None] * lanes
+        self.end_pos = np.full(lanes, -1, dtype=np.int64)
+        self.instructions = np.zeros(lanes, dtype=np.int64)
+
+        # Map from instruction name to function creating the operation for a
+        # specific instance of the instruction.
+        self.op_builders = self._build_op_builders()
+
+        # Functions executing the instruction at a PC for a group of lanes,
+        # indexed by the PC and the two words of memory at it.
+        self.execs = {}
+
+        # Schedule of checks for lanes stuck in a loop, kept in a sim.Idle so
+        # it's the same as for sim.Idli. Every running lane has run the same
+        # number of instructions so they all share it, and the snapshot holds
+        # the state of the lanes which were running when it was taken.
+        self.idle = sim.Idle()
+        self.idle_lanes = None
+        self.idle_saved = None
+
+    # Run every lane for at most the specified number of instructions, or until
+    # all lanes have stopped. Returns a LaneResult for each lane.
+    def run(self, max_instructions):
+        for _ in range(max_instructions):
+            if not self.step():
+                break
+
+        return self.results()
+
+    # Get the result of each lane.
+    def results(self):
+        results = []
+
+        for i in range(self.lanes):
+            if self.failed[i]:
+                reason = 'error'
+            elif self.end_pos[i] >= 0:
+                reason = 'uart'
+            elif self.halted[i]:
+                reason = 'halt'
+            elif self.idled[i]:
+                reason = 'idle'
+            else:
+                reason = 'limit'
+
+            results.append(LaneResult(
+                reason=reason,
+                instructions=int(self.instructions[i]),
+                error=self.errors[i],
+            ))
+
+        return results
+
+    # Get the UART output written by a lane.
+    def output(self, lane):
+        return self.uart_out[lane, :self.uart_tx[lane]].tobytes()
+
+    # Run one instruction on every lane which is still running. Returns the
+    # number of lanes which ran.
+    def step(self):
+        lanes = np.flatnonzero(self.running)
+        if not lanes.size:
+            return 0
+
+        pcs = self.pc[lanes]
+        valid = self.mem_valid[lanes, pcs]
+
+        if not valid.all():
+            for lane in lanes[~valid]:
+                self._fail(
+                    lane,
+                    f'Fetch from uninitialised memory: 0x{self.pc[lane]:04x}',
+                )
+
+            lanes = lanes[valid]
+            pcs = pcs[valid]
+
+            if not lanes.size:
+                return 0
+
+        # Lanes are grouped by the PC and the words at it, which usually means
+        # they're all in the same group. Self-modifying code can give lanes at
+        # the same PC different instructions.
+        words = self.mem[lanes, pcs].astype(np.int64)
+        next_words = self.mem[lanes, (pcs + 1) & 0xffff].astype(np.int64)
+        keys = (pcs << 32) | (words << 16) | next_words
+
+        if (keys == keys[0]).all():
+            self._execute(int(keys[0]), lanes)
+        else:
+            keys, inverse = np.unique(keys, return_inverse=True)
+            order = np.argsort(inverse, kind='stable')
+            bounds = np.cumsum(np.bincount(inverse))[:-1]
+
+            for key, group in zip(keys, np.split(lanes[order], bounds)):
+                self._execute(int(key), group)
+
+        if self.halt_detect:
+            self._check_idle()
+
+        return lanes.size
+
+    # Execute the instruction identified by the key on the group of lanes,
+    # counting the instruction for any lanes which didn't fail.
+    def _execute(self, key, lanes):
+        execute = self.execs.get(key)
+
+        if execute is None:
+            execute = self._compile(key)
+            self.execs[key] = execute
+
+        execute(lanes)
+        self.instructions[lanes[~self.failed[lanes]]] += 1
+
+    # Create the function executing the instruction identified by the key.
+    def _compile(self, key):
+        pc = key >> 32
+        word = (key >> 16) & 0xffff
+        next_word = key & 0xffff
+
+        try:
+            instr = isa.Instruction.from_words(word, next_word)
+        except Exception as e:
+            message = str(e)
+
+            def execute(lanes):
+                for lane in lanes:
+                    self._fail(lane, message)
+
+            return execute
+
+        size = instr.size()
+        pred = instr.ops.get('p')
+        invert = instr.name in isa.INSTRS_PRED_INVERT
+
+        reads, consts = sim.predecode_operands(instr, pc)
+        names = [x for x, _ in reads]
+        regs = [x for _, x in reads]
+
+        op = self.op_builders[instr.name](instr, pc, size)
+
+        next_pc = (pc + 1) & 0xffff
+        skip_pc = (pc + size) & 0xffff
+
+        def execute(lanes):
+            # The immediate must also have been fetched from initialised memory.
+            if size > 1:
+                valid = self.mem_valid[lanes, next_pc]
+
+                if not valid.all():
+                    for lane in lanes[~valid]:
+                        self._fail(
+                            lane,
+                            f'Missing immediate for instruction: 0x{word:04x}',
+                        )
+
+                    lanes = lanes[valid]
+
+            self.pc[lanes] = next_pc
+
+            # Check the predicate, inverting if required by the instruction.
+            # Uninitialised PREGs are treated as false.
+            if pred is not None:
+                run = self.pregs[lanes, pred]
+                if invert:
+                    run = ~run
+
+                self.pc[lanes[~run]] = skip_pc
+                lanes = lanes[run]
+
+            # Read the GREGs, failing any lanes where they're uninitialised.
+            ops = dict(consts)
+
+            if regs:
+                valid = self.greg_valid[lanes[:, None], regs]
+
+                if not valid.all():
+                    ok = valid.all(axis=1)
+
+                    for lane, row in zip(lanes[~ok], valid[~ok]):
+                        reg = isa.GREGS_INV[regs[row.argmin()]]
+                        self._fail(
+                            lane,
+                            f'Read of uninitialised register {reg} in '
+                            f'instruction: {instr}',
+                        )
+
+                    lanes = lanes[ok]
+
+                values = self.gregs[lanes[:, None], regs]
+                for i, name in enumerate(names):
+                    ops[name] = values[:, i]
+
+            if not lanes.size:
+                return
+
+            # Lanes which didn't redirect the PC need to skip the immediate.
+            lanes, redirect = op(lanes, ops)
+
+            if size > 1 and redirect is not True:
+                if redirect is False:
+                    self.pc[lanes] = skip_pc
+                else:
+                    self.pc[lanes[~redirect]] = skip_pc
+
+        return execute
+
+    # Check for lanes which are stuck in a loop they can never leave, in the
+    # same way as sim.Idle. This is called after every step, and compares the
+    # state of the running lanes with the snapshot every stride steps. Fields
+    # are compared cheapest first, and only for lanes which matched so far.
+    def _check_idle(self):
+        idle = self.idle
+
+        idle.countdown -= 1
+        if idle.countdown:
+            return
+
+        idle.countdown = idle.stride
+
+        if idle.state is not None:
+            lanes = np.flatnonzero(self.running)
+            rows = np.searchsorted(self.idle_lanes, lanes)
+
+            for name in _IDLE_REGS:
+                if not lanes.size:
+                    break
+
+                current = getattr(self, name)[lanes]
+                same = current == getattr(idle.state, name)[rows]
+                if same.ndim > 1:
+                    same = same.all(axis=1)
+
+                lanes = lanes[same]
+                rows = rows[same]
+
+            if lanes.size:
+                lanes = lanes[self._mem_unchanged(lanes)]
+
+            self.running[lanes] = False
+            self.idled[lanes] = True
+
+        idle.compares += 1
+        if idle.compares >= idle.limit:
+            lanes = np.flatnonzero(self.running)
+
+            self.idle_lanes = lanes
+            idle.state = sim.IdleState(
+                mem=None,
+                mem_valid=None,
+                **{name: getattr(self, name)[lanes] for name in _IDLE_REGS},
+            )
+
+            # Memory is too large to copy for every lane, so instead the first
+            # write to each address after the snapshot saves the word it had.
+            # The array is zeroed lazily by the OS, so only the pages which are
+            # written use any memory.
+            self.idle_saved = np.zeros(self.mem.shape, dtype=np.uint32)
+
+            idle.compares = 0
+            idle.limit *= 2
+
+    # Check which of the lanes have the same memory as when the snapshot was
+    # taken, which is where every address written since holds its old word.
+    def _mem_unchanged(self, lanes):
+        saved = self.idle_saved[lanes]
+        words = self._saved_words(lanes, slice(None))
+
+        return ((saved == 0) | (saved == words)).all(axis=1)
+
+    # Get words of memory as saved for finding idle lanes, which are the value
+    # and whether it's valid, with a flag set to tell them apart from words
+    # which haven't been saved.
+    def _saved_words(self, lanes, addr):
+        words = self.mem[lanes, addr].astype(np.uint32)
+        words |= self.mem_valid[lanes, addr].astype(np.uint32) << 16
+
+        return words | (1 << 17)
+
+    # Stop lanes which have halted.
+    def _halt(self, lanes):
+        self.running[lanes] = False
+        self.halted[lanes] = True
+
+    # Stop a lane with an error.
+    def _fail(self, lane, message):
+        self.running[lane] = False
+        self.failed[lane] = True
+        self.errors[lane] = message
+
+    # Fail lanes where the mask is false, returning the remaining lanes and
+    # their operands.
+    def _keep(self, mask, lanes, ops, message):
+        mask = np.broadcast_to(mask, lanes.shape)
+
+        if mask.all():
+            return lanes, ops
+
+        for lane in lanes[~mask]:
+            self._fail(lane, message(lane) if callable(message) else message)
+
+        ops = {
+            k: v[mask] if isinstance(v, np.ndarray) else v
+            for k, v in ops.items()
+        }
+
+        return lanes[mask], ops
+
+    # Fail lanes reading uninitialised memory at the addresses, returning the
+    # remaining lanes and their operands and addresses.
+    def _check_mem(self, lanes, ops, addrs):
+        valid = self.mem_valid[lanes[:, None], addrs]
+        ok = valid.all(axis=1)
+
+        if ok.all():
+            return lanes, ops, addrs
+
+        for lane, row, addr in zip(lanes[~ok], valid[~ok], addrs[~ok]):
+            self._fail(
+                lane,
+                f'Read of uninitialised memory: 0x{addr[row.argmin()]:04x}',
+            )
+
+        ops = {
+            k: v[ok] if isinstance(v, np.ndarray) else v
+            for k, v in ops.items()
+        }
+
+        return lanes[ok], ops, addrs[ok]
+
+    # Write GREG or PREG for the lanes.
+    def _write_greg(self, lanes, reg, value):
+        self.gregs[lanes, reg] = value & 0xffff
+        self.greg_valid[lanes, reg] = True
+
+    def _write_preg(self, lanes, reg, value):
+        # Writes to p3 are ignored.
+        if reg == isa.PREGS['pt']:
+            return
+
+        self.pregs[lanes, reg] = value
+        self.preg_valid[lanes, reg] = True
+
+    # Write memory for the lanes.
+    def _write_mem(self, lanes, addr, value):
+        if self.idle_saved is not None:
+            self._save_mem(lanes, addr)
+
+        self.mem[lanes, addr] = value & 0xffff
+        self.mem_valid[lanes, addr] = True
+
+    # Save the old values of memory which is about to be written for the first
+    # time since the snapshot was taken for finding idle lanes.
+    def _save_mem(self, lanes, addr):
+        addr = np.broadcast_to(addr, lanes.shape)
+        first = self.idle_saved[lanes, addr] == 0
+
+        if first.any():
+            lanes = lanes[first]
+            addr = addr[first]
+
+            self.idle_saved[lanes, addr] = self._saved_words(lanes, addr)
+
+    # Append bytes to the UART output of the lanes, then check whether any of
+    # them have finished writing the sentinel and trailer.
+    def _write_uart(self, lanes, value, width):
+        pos = self.uart_tx[lanes]
+        end = int(pos.max()) + width
+        size = self.uart_out.shape[1]
+
+        if end > size:
+            while size < end:
+                size *= 2
+
+            grown = np.zeros((self.lanes, size), dtype=np.uint8)
+            grown[:, :self.uart_out.shape[1]] = self.uart_out
+            self.uart_out = grown
+
+        self.uart_out[lanes, pos] = value & 0xff
+        if width == 2:
+            self.uart_out[lanes, pos + 1] = (value >> 8) & 0xff
+
+        self.uart_tx[lanes] = pos + width
+
+        # Only the bytes just written can complete the trailer, which limits
+        # where the sentinel can start. Check the earliest position first as
+        # this is the one that would be found by a search of the output.
+        total = len(self.sentinel) + self.trailer
+        offsets = np.arange(len(self.sentinel))
+
+        for back in reversed(range(width)):
+            start = self.uart_tx[lanes] - total - back
+            check = (start >= 0) & self.running[lanes]
+            if not check.any():
+                continue
+
+            found = lanes[check]
+            start = start[check]
+            data = self.uart_out[found[:, None], start[:, None] + offsets]
+            match = (data == self.sentinel).all(axis=1)
+
+            self.end_pos[found[match]] = start[match]
+            self.running[found[match]] = False
+
+    # Build the map from instruction name to the function creating the operation
+    # for an instance of the instruction. Each function takes the instruction,
+    # its PC and size, and returns a function which executes the instruction on
+    # an array of lanes with a dict of operand values. Values read from GREGs
+    # are arrays with an entry for each lane, while those from the encoding are
+    # ints. Operations return the lanes which didn't fail and whether each lane
+    # redirected the PC, either as an array or a single bool.
+    def _build_op_builders(self):
+        builders = {
+            'nop':      self._make_nop,
+            'push':     self._make_push,
+            'pop':      self._make_pop,
+            'putp':     self._make_putp,
+            'putpf':    self._make_putp_const(False),
+            'putpt':    self._make_putp_const(True),
+            'extbl':    self._make_unary(
+                lambda a, b: _signed(b & 0xff, 8),
+            ),
+            'extbh':    self._make_unary(
+                lambda a, b: _signed((b >> 8) & 0xff, 8),
+            ),
+            'insbl':    self._make_unary(
+                lambda a, b: (a & 0xff00) | (b & 0xff),
+            ),
+            'insbh':    self._make_unary(
+                lambda a, b: (a & 0xff) | ((b & 0xff) << 8),
+            ),
+            'not':      self._make_unary(lambda a, b: ~b),
+            'neg':      self._make_unary(lambda a, b: -b),
+            'inc':      self._make_unary(lambda a, b: a + 1),
+            'dec':      self._make_unary(lambda a, b: a - 1),
+            'urxb':     self._make_uart_rx(1),
+            'urx':      self._make_uart_rx(2),
+            'mov':      self._make_mov,
+            'addpc':    self._make_addpc,
+            'utxb':     self._make_uart_tx(1),
+            'utx':      self._make_uart_tx(2),
+            'srl':      self._make_shift(
+                lambda b, c: b >> np.minimum(c, 16),
+            ),
+            'sra':      self._make_shift(
+                lambda b, c: _signed(b) >> np.minimum(c, 16),
+            ),
+            'sll':      self._make_shift(
+                lambda b, c: b << np.minimum(c, 16),
+            ),
+            'ror':      self._make_shift(
+                lambda b, c: (b >> c) | (b << (16 - c)),
+                limit=16,
+            ),
+        }
+
+        # The other binary operations are shared with sim.Idli, while shifts
+        # have their own to give the results of Python shifts with NumPy.
+        for name in ('add', 'sub', 'and', 'andn', 'or', 'xor'):
+            builders[name] = self._make_binary(sim._BINARY_OPS[name])
+
+        for name, (func, signed) in sim._CMP_OPS.items():
+            builders[name] = self._make_cmp(func, signed)
+
+        for name, func in sim._CMP_ZERO_OPS.items():
+            builders[name] = self._make_cmp_zero(func)
+
+        for name, func in sim._BRANCH_REG_OPS.items():
+            builders[name] = self._make_branch_reg(func)
+
+        for name in ('bt', 'bf', 'blt', 'blf', 'jt', 'jf', 'jlt', 'jlf'):
+            builders[name] = self._make_branch_pred(
+                link='l' in name,
+                relative=name[0] == 'b',
+            )
+
+        for name in ('!ld', 'ld!', 'ld'):
+            builders[name] = self._make_load(wb_post=name[-1] == '!')
+
+        for name in ('!st', 'st!', 'st'):
+            builders[name] = self._make_store(
+                wb_pre=name[0] == '!',
+                wb_post=name[-1] == '!',
+            )
+
+        return builders
+
+    # NOP doesn't do anything.
+    def _make_nop(self, instr, pc, size):
+        return lambda lanes, ops: (lanes, False)
+
+    # Operation on A and B writing the result to A. Either may be unused.
+    def _make_unary(self, func):
+        def build(instr, pc, size):
+            a = instr.ops['a']
+
+            def run(lanes, ops):
+                self._write_greg(lanes, a, func(ops.get('a'), ops.get('b')))
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Binary operation on B and C writing the result to A.
+    def _make_binary(self, func):
+        def build(instr, pc, size):
+            a = instr.ops['a']
+
+            def run(lanes, ops):
+                self._write_greg(lanes, a, func(ops['b'], ops['c']))
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Shift B by C. Shifts by a negative amount, or by more than the limit if
+    # there is one, raise an error in Python so these lanes fail.
+    def _make_shift(self, func, limit=None):
+        def build(instr, pc, size):
+            a = instr.ops['a']
+
+            def run(lanes, ops):
+                valid = ops['c'] >= 0
+                if limit is not None:
+                    valid &= ops['c'] <= limit
+
+                lanes, ops = self._keep(
+                    valid,
+                    lanes,
+                    ops,
+                    'negative shift count',
+                )
+
+                self._write_greg(lanes, a, func(ops['b'], ops['c']))
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Move C into A.
+    def _make_mov(self, instr, pc, size):
+        a = instr.ops['a']
+
+        def run(lanes, ops):
+            self._write_greg(lanes, a, ops['c'])
+            return lanes, False
+
+        return run
+
+    # Add C to the PC and write to A.
+    def _make_addpc(self, instr, pc, size):
+        a = instr.ops['a']
+        next_pc = (pc + 1) & 0xffff
+
+        def run(lanes, ops):
+            self._write_greg(lanes, a, next_pc + ops['c'])
+            return lanes, False
+
+        return run
+
+    # Write bit C of B into a predicate register.
+    def _make_putp(self, instr, pc, size):
+        q = instr.ops['q']
+
+        def run(lanes, ops):
+            lanes, ops = self._keep(
+                ops['c'] >= 0,
+                lanes,
+                ops,
+                'negative shift count',
+            )
+
+            value = (ops['b'] >> np.minimum(ops['c'], 16)) & 1
+            self._write_preg(lanes, q, value != 0)
+            return lanes, False
+
+        return run
+
+    # Clear or set a predicate register.
+    def _make_putp_const(self, value):
+        def build(instr, pc, size):
+            q = instr.ops['q']
+
+            def run(lanes, ops):
+                self._write_preg(lanes, q, value)
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Compare B with C, optionally treating both values as signed.
+    def _make_cmp(self, func, signed):
+        def build(instr, pc, size):
+            q = instr.ops['q']
+
+            def run(lanes, ops):
+                lhs = ops['b']
+                rhs = ops['c']
+
+                if signed:
+                    lhs = _signed(lhs)
+                    rhs = _signed(rhs)
+
+                self._write_preg(lanes, q, func(lhs, rhs))
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Compare signed B with zero.
+    def _make_cmp_zero(self, func):
+        def build(instr, pc, size):
+            q = instr.ops['q']
+
+            def run(lanes, ops):
+                self._write_preg(lanes, q, func(_signed(ops['b']), 0))
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Branch based on B compared with zero.
+    def _make_branch_reg(self, func):
+        def build(instr, pc, size):
+            next_pc = (pc + 1) & 0xffff
+
+            def run(lanes, ops):
+                taken = func(_signed(ops['b']), 0)
+
+                target = ops.get('target')
+                if target is None:
+                    target = ((next_pc + ops['c']) & 0xffff)[taken]
+
+                self.pc[lanes[taken]] = target
+                return lanes, taken
+
+            return run
+
+        return build
+
+    # Branch or jump, optionally writing the link register. The predicate has
+    # already been checked so this always redirects the PC. When detecting
+    # halts, lanes stop on a branch or jump to its own PC which doesn't link, as
+    # with sim.Halted. Like sim.Halted this is only found once the lane has
+    # already run an instruction, so a lane starting on one runs it twice.
+    def _make_branch_pred(self, link, relative):
+        def build(instr, pc, size):
+            next_pc = (pc + 1) & 0xffff
+            link_pc = (next_pc + size - 1) & 0xffff
+            base = next_pc if relative else 0
+
+            pred = instr.ops['p']
+            _, consts = sim.predecode_operands(instr, pc)
+            halts = (
+                self.halt_detect
+                and not link
+                and consts.get('target') == pc
+            )
+
+            def run(lanes, ops):
+                if link:
+                    self._write_greg(lanes, isa.GREGS['lr'], link_pc)
+
+                target = ops.get('target')
+                if target is None:
+                    target = (ops['c'] + base) & 0xffff
+
+                self.pc[lanes] = target
+
+                if halts:
+                    self._halt(lanes[
+                        self.preg_valid[lanes, pred]
+                        & (self.instructions[lanes] > 0)
+                    ])
+
+                return lanes, True
+
+            return run
+
+        return build
+
+    # Read bytes from UART, failing lanes which have run out of input.
+    def _make_uart_rx(self, width):
+        def build(instr, pc, size):
+            a = instr.ops['a']
+
+            def run(lanes, ops):
+                pos = self.uart_rx[lanes]
+                lanes, ops = self._keep(
+                    self.uart_in_size[lanes] - pos >= width,
+                    lanes,
+                    ops,
+                    'UART input exhausted',
+                )
+
+                pos = self.uart_rx[lanes]
+                value = self.uart_in[lanes, pos].astype(np.int64)
+
+                if width == 2:
+                    value |= self.uart_in[lanes, pos + 1].astype(np.int64) << 8
+
+                self._write_greg(lanes, a, _signed(value, width * 8))
+                self.uart_rx[lanes] = pos + width
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Write bytes to UART, failing lanes where the value doesn't fit.
+    def _make_uart_tx(self, width):
+        def build(instr, pc, size):
+            def run(lanes, ops):
+                value = ops['c']
+                lanes, ops = self._keep(
+                    (value >= 0) & (value < (1 << (width * 8))),
+                    lanes,
+                    ops,
+                    'UART output value out of range',
+                )
+
+                self._write_uart(lanes, ops['c'], width)
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Load from memory. Only the post-increment form writes the address back.
+    def _make_load(self, wb_post):
+        def build(instr, pc, size):
+            a = instr.ops['a']
+            b = instr.ops['b']
+
+            def run(lanes, ops):
+                addr = ops['b']
+                addr_final = (addr + ops['c']) & 0xffff
+
+                if not wb_post:
+                    addr = addr_final
+
+                ops['addr_final'] = addr_final
+                lanes, ops, addr = self._check_mem(lanes, ops, addr[:, None])
+
+                self._write_greg(lanes, a, self.mem[lanes, addr[:, 0]])
+
+                if wb_post:
+                    self._write_greg(lanes, b, ops['addr_final'])
+
+                return lanes, False
+
+            return run
+
+        return build
+
+    # Store to memory, optionally with writeback.
+    def _make_store(self, wb_pre, wb_post):
+        def build(instr, pc, size):
+            a = instr.ops['a']
+            b = instr.ops['b']
+
+            def run(lanes, ops):
+                addr = ops['b']
+                addr_final = (addr + ops['c']) & 0xffff
+                value = ops['a']
+
+                if not wb_post:
+                    addr = addr_final
+
+                # If the writeback address is the value being stored then it
+                # should be visible to the store.
+                if wb_pre and a == b:
+                    self._write_greg(lanes, b, addr_final)
+                    value = addr_final
+
+                self._write_mem(lanes, addr, value)
+
+                if wb_post:
+                    self._write_greg(lanes, b, addr_final)
+
+                return lanes, False
+
+            return run
+
+        return build
+
+    # PUSH register range onto the stack and update SP.
+    def _make_push(self, instr, pc, size):
+        regs = sim._RANGE_REGS[instr.ops['d']]
+        sp_reg = isa.GREGS['sp']
+
+        def run(lanes, ops):
+            lanes, ops = self._keep(
+                self.greg_valid[lanes[:, None], (sp_reg,) + regs].all(axis=1),
+                lanes,
+                ops,
+                f'Push of uninitialised register in instruction: {instr}',
+            )
+
+            sp = self.gregs[lanes, sp_reg]
+
+            for idx in regs:
+                sp = (sp - 1) & 0xffff
+                self._write_mem(lanes, sp, self.gregs[lanes, idx])
+
+            self._write_greg(lanes, sp_reg, sp)
+            return lanes, False
+
+        return run
+
+    # Reverse of push, failing lanes where any of the stack is uninitialised.
+    def _make_pop(self, instr, pc, size):
+        regs = sim._RANGE_REGS[instr.ops['d']]
+        sp_reg = isa.GREGS['sp']
+        offsets = np.arange(len(regs))
+
+        def run(lanes, ops):
+            lanes, ops = self._keep(
+                self.greg_valid[lanes, sp_reg],
+                lanes,
+                ops,
+                f'Pop with uninitialised sp in instruction: {instr}',
+            )
+
+            sp = self.gregs[lanes, sp_reg]
+            addrs = (sp[:, None] + offsets) & 0xffff
+            lanes, ops, addrs = self._check_mem(lanes, ops, addrs)
+
+            for i, idx in enumerate(reversed(regs)):
+                self._write_greg(lanes, idx, self.mem[lanes, addrs[:, i]])
+
+            sp = (self.gregs[lanes, sp_reg] + len(regs)) & 0xffff
+            self._write_greg(lanes, sp_reg, sp)
+            return lanes, False
+
+        return run
+
+
+# Run a lane on sim.Idli, raising an exception if the result or final state
+# differs from the batch. The program is either a path or a shared image.
+def compare_lane(batch, lane, path, uart_in, max_instructions):
+    cb = sim.UartCallback(uart_in)
+    idli = sim.Idli(path, callback=cb)
+    end = sim.UartSentinel(
+        cb.uart_out,
+        batch.sentinel.tobytes(),
+        trailer=batch.trailer,
+    )
+
+    stop = [end]
+    if batch.halt_detect:
+        stop += [sim.Halted(), sim.Idle()]
+
+    result = batch.results()[lane]
+
+    try:
+        expected = idli.run(max_instructions, stop=stop)
+    except Exception as e:
+        if result.reason != 'error':
+            raise Exception(f'Lane {lane} should have failed: {e}')
+
+        return
+
+    if result.reason != expected.reason:
+        raise Exception(
+            f'Lane {lane} stopped with {result.reason} instead of '
+            f'{expected.reason}: {result.error}'
+        )
+
+    mem_valid = np.unpackbits(
+        np.frombuffer(idli.mem_valid, dtype=np.uint8),
+        bitorder='little',
+    )
+
+    state = {
+        'instructions': (result.instructions, expected.instructions),
+        'pc': (batch.pc[lane], idli.pc),
+        'gregs': ([int(x) for x in batch.gregs[lane]], idli.gregs),
+        'greg validity': (
+            [bool(x) for x in batch.greg_valid[lane]],
+            [bool((idli.greg_valid >> i) & 1) for i in range(8)],
+        ),
+        'pregs': ([bool(x) for x in batch.pregs[lane]], idli.pregs),
+        'preg validity': (
+            [bool(x) for x in batch.preg_valid[lane]],
+            [bool((idli.preg_valid >> i) & 1) for i in range(4)],
+        ),
+        'memory': (
+            batch.mem[lane].tobytes(),
+            np.array(idli.mem, dtype=np.uint16).tobytes(),
+        ),
+        'memory validity': (
+            batch.mem_valid[lane].tobytes(),
+            mem_valid.astype(bool).tobytes(),
+        ),
+        'UART output': (batch.output(lane), bytes(cb.uart_out.data)),
+    }
+
+    for name, (actual, expected) in state.items():
+        if actual != expected:
+            raise Exception(f'Lane {lane} {name} differs from sim.Idli')
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'input',
+        metavar='INPUT',
+        type=pathlib.Path,
+        help='Path to input binary.',
+    )
+
+    parser.add_argument(
+        '-i',
+        '--uart-in',
+        type=pathlib.Path,
+        nargs='+',
+        required=True,
+        help='UART input file for each lane.',
+    )
+
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        type=int,
+        default=5000,
+        help='Maximum instructions to run on each lane.',
+    )
+
+    parser.add_argument(
+        '--no-halt-detect',
+        action='store_true',
+        help='Run until the timeout even if a lane halts or gets stuck.',
+    )
+
+    parser.add_argument(
+        '--compare',
+        action='store_true',
+        help='Check every lane against sim.Idli.',
+    )
+
+    args = parser.parse_args()
+
+    if not args.input.is_file():
+        raise Exception(f'Bad input file: {args.input}')
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    uart_in = [sim.load_uart_file(x) for x in args.uart_in]
+
+    batch = IdliBatch(
+        args.input,
+        uart_in,
+        halt_detect=not args.no_halt_detect,
+    )
+
+    start = time.perf_counter()
+    results = batch.run(args.timeout)
+    elapsed = time.perf_counter() - start
+
+    for i, result in enumerate(results):
+        line = f'{i:6}  {result.reason:6}{result.instructions:12}'
+
+        if result.reason == 'error':
+            line = f'{line}  {result.error}'
+        else:
+            line = f'{line}  {batch.output(i)}'
+
+        print(line)
+
+    total = sum(x.instructions for x in results)
+    print(
+        f'{total} instructions in {elapsed:.3f}s '
+        f'({total / elapsed / 1e6:.3f} MIPS)'
+    )
+
+    if args.compare:
+        with sim.ProgramImage(args.input) as image:
+            for i in range(len(results)):
+                compare_lane(batch, i, image, uart_in[i], args.timeout)
+
+        print('All lanes match sim.Idli.')
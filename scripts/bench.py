@@ -0,0 +1,155 @@
+import argparse
+import os
+import tempfile
+import time
+
+import isa
+import sim
+
+
+# Number of copies of the instruction placed in the benchmark binary before the
+# jump back to the start.
+COPIES = 1024
+
+
+# Operands used for each instruction. The registers are initialised so these
+# are all valid, and any branches or jumps land on the following instruction or
+# the start of the binary.
+OPERANDS = {
+    'a': 'r5',
+    'b': 'r2',
+    'c': 'r1',
+    'd': 'r0',
+    'q': 'p0',
+}
+
+# Operands for instructions accessing memory through B.
+MEM_OPERANDS = {
+    'a': 'r5',
+    'b': 'r4',
+    'c': 'r0',
+}
+
+# Operands for branches and jumps.
+BRANCH_OPERANDS = {
+    'b': 'r2',
+    'c': 'r0',
+}
+
+
+# Initial GREG values. R4 points at data and SP at the top of memory.
+GREGS = [0, 1, 2, 3, 0x8000, 5, 0x10, 0xf000]
+
+
+# Callback feeding zeros into the UART and discarding anything sent.
+class BenchCallback(sim.IdliCallback):
+    def read_uart(self, width):
+        return 0
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '-n',
+        '--count',
+        type=int,
+        default=20000,
+        help='Number of instructions to run for each measurement.',
+    )
+
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of measurements to take the best of.',
+    )
+
+    parser.add_argument(
+        'names',
+        metavar='NAME',
+        nargs='*',
+        help='Instructions to measure, defaulting to the whole ISA.',
+    )
+
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in isa.SYNTAX:
+            raise Exception(f'Unknown instruction: {name}')
+
+    return args
+
+
+# Assemble the binary for the named instruction.
+def make_binary(name):
+    if name in isa.INSTRS_BRANCH or name in isa.INSTRS_JUMP:
+        operands = BRANCH_OPERANDS
+    elif 'ld' in name or 'st' in name:
+        operands = MEM_OPERANDS
+    else:
+        operands = OPERANDS
+
+    line = isa.SYNTAX[name].replace('.{p}', '').format(**operands)
+    instr = isa.Instruction.from_parts(line.replace(',', ' ').split())
+
+    end = isa.Instruction.from_parts(['j', '0'])
+    return instr.encode() * COPIES + end.encode()
+
+
+# Measure the time per instruction for the named instruction with the specified
+# simulator options. The first run warms up any caches, and the best of the
+# remaining runs is taken to reduce noise.
+def measure(path, count, repeat, **kwargs):
+    idli = sim.Idli(path, callback=BenchCallback(), **kwargs)
+    best = None
+
+    # Mark all memory as initialised so POP and loads can run anywhere.
+    idli.mem_valid[:] = b'\xff' * len(idli.mem_valid)
+
+    for i in range(repeat + 1):
+        idli.pc = 0
+        idli.gregs[:] = GREGS
+        idli.greg_valid = 0xff
+        idli.pregs[:3] = [True] * 3
+        idli.preg_valid = 0xf
+
+        start = time.perf_counter()
+
+        ticks = 0
+        while ticks < count:
+            ticks += idli.run_block(count - ticks)
+
+        elapsed = (time.perf_counter() - start) / ticks
+        if i and (best is None or elapsed < best):
+            best = elapsed
+
+    return best
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    names = args.names or list(isa.SYNTAX)
+
+    engines = {
+        'uncached':  {'decode_cache': False},
+        'cached':    {},
+        'jit':       {'use_jit': True},
+        'unchecked': {'checked': False},
+    }
+
+    print(f'{"name":8}' + ''.join(f'{x:>12}' for x in engines))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            path = os.path.join(tmp, f'{name}.iout')
+            with open(path, 'wb') as f:
+                f.write(make_binary(name))
+
+            times = [
+                measure(path, args.count, args.repeat, **x)
+                for x in engines.values()
+            ]
+            print(f'{name:8}' + ''.join(f'{x * 1e9:10.0f}ns' for x in times))
@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import itertools
+import os
+import pathlib
+import tty
+
+import sim
+
+
+# Default number of instructions each core runs before letting the others run.
+QUANTUM = 1 << 12
+
+# Maximum number of bytes read from a connection at once.
+READ_SIZE = 1 << 12
+
+
+# UART input fed with data from a connection as it arrives. Reads raise
+# UartStall if there isn't enough input yet instead of waiting for it, so the
+# core can be resumed once more has been fed in.
+class StallInput:
+    def __init__(self):
+        self.data = bytearray()
+        self.pos = 0
+
+    # Add data received from the connection.
+    def feed(self, data):
+        self.data += data
+
+    # Read the specified number of bytes.
+    def read(self, size):
+        if len(self.data) < size:
+            raise sim.UartStall()
+
+        data = bytes(self.data[:size])
+        del self.data[:size]
+        self.pos += size
+
+        return data
+
+    # Skip over bytes which have already been consumed.
+    def skip(self, size):
+        self.read(size)
+
+    def close(self):
+        pass
+
+
+# Callback connecting the UART of a core to a connection, where reads stall
+# until input arrives.
+class BridgeCallback(sim.UartCallback):
+    stalls = True
+
+    def __init__(self):
+        super().__init__(StallInput())
+
+    # Take the output written since this was last called.
+    def take_output(self):
+        out = self.uart_out
+        data = bytes(out.data)
+
+        out.start += len(data)
+        out.data.clear()
+
+        return data
+
+
+# Run a core with its UART connected to a stream reader and writer. The core
+# runs in slices of the quantum, letting other tasks run in between. Output is
+# written after each slice and the core waits for it to drain so it can't get
+# ahead of the other end, and when the core stalls reading the UART it waits
+# for more input without busy-waiting. Ends when the core halts, hits the
+# timeout, or needs input after the connection has closed.
+async def serve(image, name, reader, writer, args):
+    cb = BridgeCallback()
+    idli = sim.Idli(
+        image,
+        callback=cb,
+        use_jit=args.jit,
+        checked=not args.unchecked,
+    )
+
+    stop = [sim.Halted()]
+    print(f'{name}: started')
+
+    try:
+        while args.timeout is None or idli.instructions < args.timeout:
+            quantum = args.quantum
+            if args.timeout is not None:
+                quantum = min(quantum, args.timeout - idli.instructions)
+
+            result = idli.run(quantum, stop=stop)
+
+            output = cb.take_output()
+            if output:
+                writer.write(output)
+                await writer.drain()
+
+            if result.reason == 'stall':
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    print(f'{name}: closed')
+                    break
+
+                cb.uart_in.feed(data)
+            elif result.reason == 'limit':
+                await asyncio.sleep(0)
+            else:
+                print(f'{name}: halted')
+                break
+        else:
+            print(f'{name}: timed out')
+    except Exception as e:
+        print(f'{name}: {e}')
+    finally:
+        print(f'{name}: ran {idli.instructions} instructions')
+        writer.close()
+
+
+# Writer for the master side of a PTY, providing the parts of StreamWriter used
+# by serve(). The transport pauses writing when its buffer fills up, and drain()
+# waits until it resumes:
+# - transport   Pipe transport writing to the PTY.
+# - drained     Future completed when writing resumes, or None if not paused.
+class PtyWriter(asyncio.Protocol):
+    def __init__(self):
+        self.transport = None
+        self.drained = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pause_writing(self):
+        self.drained = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        self._wake()
+
+    def connection_lost(self, exc):
+        self._wake()
+
+    # Wake anything waiting for the buffer to drain.
+    def _wake(self):
+        drained, self.drained = self.drained, None
+        if drained is not None and not drained.done():
+            drained.set_result(None)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    # Wait until the buffer has drained, raising an exception if the PTY has
+    # been closed.
+    async def drain(self):
+        if self.drained is not None:
+            await self.drained
+
+        if self.transport.is_closing():
+            raise ConnectionResetError('PTY closed')
+
+    def close(self):
+        self.transport.close()
+
+
+# Open streams for reading and writing the master side of a new PTY, returning
+# them along with the path of the slave for clients to open. The slave is put
+# in raw mode so data passes through unchanged, and is held open so the PTY
+# stays usable as clients come and go.
+async def open_pty():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+
+    loop = asyncio.get_running_loop()
+
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader),
+        os.fdopen(master, 'rb', buffering=0),
+    )
+
+    _, writer = await loop.connect_write_pipe(
+        PtyWriter,
+        os.fdopen(os.dup(master), 'wb', buffering=0),
+    )
+
+    return reader, writer, os.ttyname(slave)
+
+
+# Serve cores on all the requested sockets and PTYs until interrupted. Every
+# connection to a socket gets a new core, while each PTY has a single core.
+# All the cores share one copy of the program.
+async def main(args):
+    with sim.ProgramImage(args.input) as image:
+        tasks = []
+        ids = itertools.count()
+
+        def connect(reader, writer):
+            name = f'core {next(ids)}'
+            return serve(image, name, reader, writer, args)
+
+        if args.tcp is not None:
+            host, port = args.tcp
+            server = await asyncio.start_server(connect, host, port)
+            tasks.append(server.serve_forever())
+
+            for sock in server.sockets:
+                print(f'Listening on TCP: {sock.getsockname()}')
+
+        if args.unix is not None:
+            server = await asyncio.start_unix_server(connect, args.unix)
+            tasks.append(server.serve_forever())
+            print(f'Listening on Unix socket: {args.unix}')
+
+        for i in range(args.pty):
+            reader, writer, path = await open_pty()
+            tasks.append(serve(image, path, reader, writer, args))
+            print(f'Serving on PTY: {path}')
+
+        await asyncio.gather(*tasks)
+
+
+# Parse a TCP address, which is a port optionally preceded by a host.
+def parse_tcp(text):
+    host, _, port = text.rpartition(':')
+
+    try:
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Bad TCP address: {text}')
+
+    return host or 'localhost', port
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'input',
+        metavar='INPUT',
+        type=pathlib.Path,
+        help='Path to input binary.'
+    )
+
+    parser.add_argument(
+        '--tcp',
+        type=parse_tcp,
+        metavar='[HOST:]PORT',
+        help='Run a core for each connection to a TCP port.'
+    )
+
+    parser.add_argument(
+        '--unix',
+        type=pathlib.Path,
+        metavar='PATH',
+        help='Run a core for each connection to a Unix socket.'
+    )
+
+    parser.add_argument(
+        '--pty',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Run N cores, each connected to a new PTY.'
+    )
+
+    parser.add_argument(
+        '-q',
+        '--quantum',
+        type=int,
+        default=QUANTUM,
+        help='Instructions each core runs before letting others run.'
+    )
+
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        type=int,
+        help='Maximum instructions each core runs, or unlimited if not given.'
+    )
+
+    parser.add_argument(
+        '--jit',
+        action='store_true',
+        help='Compile basic blocks into Python functions to run them.'
+    )
+
+    parser.add_argument(
+        '--unchecked',
+        action='store_true',
+        help='Skip checking for reads of uninitialised registers and memory.'
+    )
+
+    args = parser.parse_args()
+
+    if not args.input.is_file():
+        raise Exception(f'Bad input file: {args.input}')
+
+    if args.tcp is None and args.unix is None and not args.pty:
+        raise Exception('Nothing to serve, give --tcp, --unix or --pty')
+
+    if args.quantum < 1:
+        raise Exception(f'Bad quantum: {args.quantum}')
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
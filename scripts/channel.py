@@ -0,0 +1,183 @@
+import sys
+
+
+# Number of bytes of recent output kept by streamed outputs, which must be
+# enough to find a sentinel and anything following it.
+KEEP_BYTES = 1 << 12
+
+
+# UART input read from a buffer held in memory. Reads return views of the
+# buffer so no data is copied as it's consumed.
+class BufferInput:
+    def __init__(self, data=b''):
+        self.view = memoryview(data).cast('B')
+        self.pos = 0
+
+    # Read the specified number of bytes.
+    def read(self, size):
+        end = self.pos + size
+        if end > len(self.view):
+            raise Exception(f'UART input exhausted after {self.pos} bytes')
+
+        data = self.view[self.pos:end]
+        self.pos = end
+
+        return data
+
+    # Skip over bytes which have already been consumed, such as when resuming
+    # from a checkpoint.
+    def skip(self, size):
+        self.read(size)
+
+    def close(self):
+        pass
+
+
+# UART input read from a file or pipe as it's needed, so only a small buffered
+# window of the input is in memory at any time. This can be used for inputs
+# which are too large to hold in memory, or which never end.
+class StreamInput:
+    def __init__(self, file):
+        self.file = file
+        self.pos = 0
+
+    # Read the specified number of bytes, waiting for them to arrive if the
+    # input is a pipe.
+    def read(self, size):
+        data = self.file.read(size)
+        if len(data) < size:
+            raise Exception(f'UART input exhausted after {self.pos} bytes')
+
+        self.pos += size
+        return data
+
+    # Skip over bytes which have already been consumed. These are read rather
+    # than seeked over so this works on pipes.
+    def skip(self, size):
+        while size:
+            chunk = min(size, KEEP_BYTES)
+            self.read(chunk)
+            size -= chunk
+
+    def close(self):
+        if self.file is not sys.stdin.buffer:
+            self.file.close()
+
+
+# UART input which keeps everything read from another input in a log, so it can
+# be read again after going back to an earlier point in a run. Reads before the
+# end of the log are replayed from it and only those past the end come from the
+# input. With no input, everything must be replayed from the log. The log starts
+# at the position in the input stream given by start, which is only non-zero if
+# recording began part way through.
+class RecordInput:
+    def __init__(self, input=None, log=b'', start=0):
+        self.input = input
+        self.log = bytearray(log)
+        self.start = start
+        self.pos = start
+
+    # Read the specified number of bytes.
+    def read(self, size):
+        begin = self.pos - self.start
+        end = begin + size
+
+        if end > len(self.log):
+            if self.input is None:
+                raise Exception(f'UART input exhausted after {self.pos} bytes')
+
+            self.log += self.input.read(end - len(self.log))
+
+        data = bytes(self.log[begin:end])
+        self.pos += size
+
+        return data
+
+    # Skip over bytes which have already been consumed.
+    def skip(self, size):
+        self.read(size)
+
+    # Move back to a position in the input which has already been read, such as
+    # when restoring an earlier checkpoint.
+    def seek(self, pos):
+        if not self.start <= pos <= self.start + len(self.log):
+            raise Exception(f'UART input not recorded at {pos} bytes')
+
+        self.pos = pos
+
+    def close(self):
+        if self.input is not None:
+            self.input.close()
+
+
+# UART output collected in a buffer in memory:
+# - data        All the output written.
+# - start       Position in the output stream of the first byte of data, which
+#               is only non-zero if restored from a stream.
+class BufferOutput:
+    def __init__(self):
+        self.data = bytearray()
+        self.start = 0
+
+    # Write bytes to the output.
+    def write(self, data):
+        self.data += data
+
+    # Restore the output from before a checkpoint, where total is the number of
+    # bytes that had been written in total.
+    def restore(self, data, total):
+        self.data[:] = data
+        self.start = total - len(data)
+
+    def close(self):
+        pass
+
+
+# UART output written to a file or pipe as it's produced. Only the most recent
+# output is kept in memory so the simulator can look for a sentinel, with data
+# and start having the same meaning as for BufferOutput.
+class StreamOutput:
+    def __init__(self, file, keep=KEEP_BYTES):
+        self.file = file
+        self.keep = keep
+        self.data = bytearray()
+        self.start = 0
+
+    # Write bytes to the output, dropping old output from memory once there's
+    # twice as much as needs to be kept.
+    def write(self, data):
+        self.file.write(data)
+        self.data += data
+
+        size = len(self.data)
+        if size > 2 * self.keep:
+            drop = size - self.keep
+            del self.data[:drop]
+            self.start += drop
+
+    # Restore the recent output from before a checkpoint. This isn't written to
+    # the file, which only gets output from after the checkpoint.
+    def restore(self, data, total):
+        self.data[:] = data[-self.keep:]
+        self.start = total - len(self.data)
+
+    def close(self):
+        self.file.flush()
+        if self.file is not sys.stdout.buffer:
+            self.file.close()
+
+
+# Open a file for streaming UART input, where '-' is stdin.
+def open_input(path):
+    if str(path) == '-':
+        return StreamInput(sys.stdin.buffer)
+
+    return StreamInput(open(path, 'rb'))
+
+
+# Open a file for streaming UART output, where '-' is stdout.
+def open_output(path):
+    if str(path) == '-':
+        return StreamOutput(sys.stdout.buffer)
+
+    return StreamOutput(open(path, 'wb'))
@@ -0,0 +1,577 @@
+import argparse
+import collections
+import pathlib
+import signal
+import struct
+
+import channel
+import isa
+import record
+import sim
+
+
+# Prompt shown when waiting for a command.
+PROMPT = '(idli) '
+
+# Number of instructions continue runs at a time when it isn't given a count.
+CONTINUE_CHUNK = 1 << 20
+
+# Number of words shown on each line of a memory dump.
+MEM_LINE_WORDS = 8
+
+
+# Command of the debugger, giving its short alias, the usage of its arguments
+# and a description.
+Command = collections.namedtuple('Command', 'alias usage help')
+
+COMMANDS = {
+    'step': Command(
+        's',
+        '[N]',
+        'Run N instructions, default one.',
+    ),
+    'continue': Command(
+        'c',
+        '[N]',
+        'Run until stopped, or for at most N.',
+    ),
+    'reverse-step': Command(
+        'rs',
+        '[N]',
+        'Go back N instructions, default one.',
+    ),
+    'reverse-continue': Command(
+        'rc',
+        '',
+        'Go back to the last breakpoint or watchpoint.',
+    ),
+    'break': Command(
+        'b',
+        'ADDR [if EXPR]',
+        'Stop at the address, if the expression is true.',
+    ),
+    'delete': Command(
+        'd',
+        'ADDR',
+        'Remove the breakpoint.',
+    ),
+    'watch': Command(
+        'w',
+        'ADDR[..END] [r|w|rw]',
+        'Stop after memory is accessed, default writes.',
+    ),
+    'unwatch': Command(
+        'u',
+        'ADDR[..END]',
+        'Stop watching the memory.',
+    ),
+    'info': Command(
+        'i',
+        '',
+        'List breakpoints and watchpoints.',
+    ),
+    'regs': Command(
+        'r',
+        '',
+        'Show the registers, ---- if uninitialised.',
+    ),
+    'mem': Command(
+        'x',
+        'ADDR [N]',
+        'Show N words of memory, default one line.',
+    ),
+    'print': Command(
+        'p',
+        'EXPR',
+        'Evaluate registers, pc and mem[ADDR].',
+    ),
+    'help': Command(
+        'h',
+        '',
+        'Show this help.',
+    ),
+    'quit': Command(
+        'q',
+        '',
+        'Exit the debugger.',
+    ),
+}
+
+# Map from alias to the name of each command.
+ALIASES = {x.alias: name for name, x in COMMANDS.items()}
+
+
+# Stop when the user presses Ctrl-C. The signal only sets a flag so the run
+# stops cleanly between instructions rather than part way through one.
+class Interrupt(sim.StopCondition):
+    reason = 'interrupt'
+
+    def __init__(self):
+        self.pending = False
+
+    def handle(self, signum, frame):
+        self.pending = True
+
+    def check(self, sim):
+        if not self.pending:
+            return False
+
+        self.pending = False
+        return True
+
+
+# Interactive debugger stepping through a program on the simulator. Breakpoints
+# and watchpoints are stop conditions, so a run without any set is as fast as
+# any other and can use the JIT. Going backwards needs a recording of the run,
+# which forward runs are made through so it keeps up with them.
+class Debugger:
+    def __init__(self, idli, cb, recording=None):
+        self.sim = idli
+        self.cb = cb
+        self.recording = recording
+        self.breaks = sim.Breakpoints()
+        self.watch = sim.Watchpoints()
+        self.end = sim.UartSentinel(cb.uart_out, b'END', trailer=2)
+        self.interrupt = Interrupt()
+
+        # Length of the UART output which has already been shown.
+        self.shown = len(cb.uart_out.data)
+
+    # Read and run commands until the user quits. An empty line repeats the
+    # previous command, as is usual for stepping.
+    def loop(self):
+        self.show_pc()
+        last = ''
+
+        while True:
+            try:
+                line = input(PROMPT).strip() or last
+            except EOFError:
+                print()
+                return
+            except KeyboardInterrupt:
+                print()
+                continue
+
+            last = line
+            if not line:
+                continue
+
+            name, _, rest = line.partition(' ')
+            name = ALIASES.get(name, name)
+
+            if name not in COMMANDS:
+                print(f'Unknown command: {name}')
+                continue
+
+            if name == 'quit':
+                return
+
+            try:
+                getattr(self, f'do_{name.replace("-", "_")}')(rest.strip())
+            except Exception as e:
+                self.show_uart()
+                print(f'Error: {e}')
+
+    # Get the conditions to stop at, which are the breakpoints, watchpoints,
+    # any others given and Ctrl-C. Memory is only watched if there are
+    # watchpoints, as the JIT isn't used while watching.
+    def stops(self, *others):
+        stop = [self.breaks, *others, self.interrupt]
+        if any(self.watch.reads) or any(self.watch.writes):
+            stop.insert(0, self.watch)
+
+        return stop
+
+    # Call the function with Ctrl-C stopping the run instead of the debugger.
+    def interruptible(self, func, *args):
+        handler = signal.signal(signal.SIGINT, self.interrupt.handle)
+
+        try:
+            return func(*args)
+        finally:
+            signal.signal(signal.SIGINT, handler)
+
+    # Run at most the number of instructions, also stopping at the end of the
+    # test or a halt.
+    def run(self, count):
+        runner = self.sim if self.recording is None else self.recording
+        stop = self.stops(self.end, sim.Halted())
+
+        return self.interruptible(runner.run, count, stop)
+
+    # Get the recording for going backwards.
+    def history(self):
+        if self.recording is None:
+            raise Exception('Cannot go backwards without --record or --replay')
+
+        return self.recording
+
+    def do_step(self, arg):
+        self.show_result(self.run(parse_count(arg, 1)))
+
+    def do_continue(self, arg):
+        if arg:
+            self.show_result(self.run(parse_count(arg, None)))
+            return
+
+        # Run in chunks so the total isn't limited, until stopped by anything
+        # other than reaching the end of a chunk.
+        total = 0
+
+        while True:
+            result = self.run(CONTINUE_CHUNK)
+            total += result.instructions
+            if result.reason != 'limit':
+                break
+
+        self.show_result(result._replace(instructions=total))
+
+    def do_reverse_step(self, arg):
+        count = self.history().reverse_step(parse_count(arg, 1))
+        self.show_back(count)
+
+    def do_reverse_continue(self, arg):
+        recording = self.history()
+        current = self.sim.instructions
+        reason = self.interruptible(
+            recording.reverse_continue,
+            self.stops(),
+        )
+
+        if reason is None:
+            print('Reached the start of the recording')
+        else:
+            self.show_stop(reason)
+
+        self.show_back(current - self.sim.instructions)
+
+    def do_break(self, arg):
+        addr, _, expr = arg.partition(' if ')
+        pc = parse_addr(addr)
+        cond = None
+
+        if expr:
+            code = compile(expr, '<condition>', 'eval')
+            cond = lambda idli: evaluate(idli, code)
+
+        self.breaks.add(pc, cond)
+
+    def do_delete(self, arg):
+        self.breaks.remove(parse_addr(arg))
+
+    def do_watch(self, arg):
+        parts = arg.split()
+        if not parts or len(parts) > 2:
+            raise Exception(f'Bad watchpoint: {arg}')
+
+        mode = parts[1] if len(parts) > 1 else 'w'
+        if mode not in ('r', 'w', 'rw'):
+            raise Exception(f'Bad watchpoint mode: {mode}')
+
+        start, end = parse_range(parts[0])
+        self.watch.add(start, end, read='r' in mode, write='w' in mode)
+
+    def do_unwatch(self, arg):
+        self.watch.remove(*parse_range(arg))
+
+    def do_info(self, arg):
+        for pc, cond in sorted(self.breaks.conds.items()):
+            print(f'Breakpoint 0x{pc:04x}{" (conditional)" if cond else ""}')
+
+        watched = [('read', self.watch.reads), ('write', self.watch.writes)]
+
+        for kind, bits in watched:
+            for start, end in bitmap_ranges(bits):
+                print(f'Watch {kind:6}0x{start:04x}..0x{end:04x}')
+
+    def do_regs(self, arg):
+        idli = self.sim
+        print(f'pc  0x{idli.pc:04x}')
+
+        gregs = []
+        for reg, value in enumerate(idli.gregs):
+            valid = (idli.greg_valid >> reg) & 1
+            value = f'0x{value:04x}' if valid else '----'
+            gregs.append(f'{isa.GREGS_INV[reg]:4}{value}')
+
+        print('  '.join(gregs[:4]))
+        print('  '.join(gregs[4:]))
+
+        pregs = []
+        for reg, value in enumerate(idli.pregs):
+            valid = (idli.preg_valid >> reg) & 1
+            value = int(value) if valid else '-'
+            pregs.append(f'{isa.PREGS_INV[reg]:4}{value}')
+
+        print('  '.join(pregs))
+
+    def do_mem(self, arg):
+        parts = arg.split()
+        if not parts or len(parts) > 2:
+            raise Exception(f'Bad memory range: {arg}')
+
+        addr = parse_addr(parts[0])
+        count = parse_count(parts[1] if len(parts) > 1 else '', MEM_LINE_WORDS)
+        idli = self.sim
+
+        for line in range(addr, addr + count, MEM_LINE_WORDS):
+            words = []
+
+            for i in range(line, min(line + MEM_LINE_WORDS, addr + count)):
+                i &= 0xffff
+                valid = idli._mem_is_valid(i)
+                words.append(f'{idli.mem[i]:04x}' if valid else '----')
+
+            print(f'0x{line & 0xffff:04x}: {" ".join(words)}')
+
+    def do_print(self, arg):
+        value = evaluate(self.sim, compile(arg, '<expression>', 'eval'))
+
+        if isinstance(value, int) and not isinstance(value, bool):
+            print(f'{value} (0x{value & 0xffff:04x})')
+        else:
+            print(value)
+
+    def do_help(self, arg):
+        for name, command in COMMANDS.items():
+            usage = f'{name} {command.usage}'
+            print(f'  {command.alias}  {usage:28}{command.help}')
+
+    # Show any UART output written since it was last shown.
+    def show_uart(self):
+        data = self.cb.uart_out.data
+        if len(data) > self.shown:
+            print(f'UART: {bytes(data[self.shown:])}')
+            self.shown = len(data)
+
+    # Show the output of a run, why it stopped and where the PC is now.
+    def show_result(self, result):
+        self.show_uart()
+        self.show_stop(result.reason)
+
+        print(
+            f'Ran {result.instructions} instructions '
+            f'({self.sim.instructions} in total)'
+        )
+        self.show_pc()
+
+    # Show how far a recording went back and where the PC is now. The output
+    # replayed on the way isn't shown again.
+    def show_back(self, count):
+        self.shown = len(self.cb.uart_out.data)
+
+        print(
+            f'Went back {count} instructions '
+            f'({self.sim.instructions} in total)'
+        )
+        self.show_pc()
+
+    # Show why a run stopped.
+    def show_stop(self, reason):
+        if reason == 'break':
+            print(f'Breakpoint at 0x{self.sim.pc:04x}')
+        elif reason == 'watch':
+            for hit in self.watch.hits:
+                kind = 'Write' if hit.write else 'Read'
+                print(
+                    f'{kind} of 0x{hit.value:04x} at 0x{hit.addr:04x} by '
+                    f'instruction at 0x{hit.pc:04x}'
+                )
+        elif reason == 'uart':
+            data, base = self.cb.uart_out.data, self.cb.uart_out.start
+            pos = self.end.pos - base + len(self.end.sentinel)
+            code, = struct.unpack_from('<h', data, pos)
+            print(f'Test finished with exit code: {code}')
+        elif reason == 'halt':
+            print('Core halted')
+        elif reason == 'interrupt':
+            print('Interrupted')
+
+    # Show the PC and the instruction there.
+    def show_pc(self):
+        pc = self.sim.pc
+
+        try:
+            instr, _ = self.sim.next_instr()
+        except Exception as e:
+            print(f'0x{pc:04x}: {e}')
+            return
+
+        print(f'0x{pc:04x}: {instr}')
+
+
+# Evaluate compiled code for an expression, with the registers available by
+# name along with the PC and memory.
+def evaluate(idli, code):
+    names = {name: idli.gregs[reg] for name, reg in isa.GREGS.items()}
+    names.update({name: idli.pregs[reg] for name, reg in isa.PREGS.items()})
+    names['pc'] = idli.pc
+    names['mem'] = idli.mem
+
+    return eval(code, {'__builtins__': {}}, names)
+
+
+# Parse a 16b address.
+def parse_addr(text):
+    try:
+        addr = int(text, 0)
+    except ValueError:
+        raise Exception(f'Bad address: {text}')
+
+    if not 0 <= addr <= 0xffff:
+        raise Exception(f'Bad address: {text}')
+
+    return addr
+
+
+# Parse an address, or a range of addresses from the start to the end
+# inclusive.
+def parse_range(text):
+    start, _, end = text.partition('..')
+    start = parse_addr(start)
+    end = parse_addr(end) if end else start
+
+    if end < start:
+        raise Exception(f'Bad address range: {text}')
+
+    return start, end
+
+
+# Parse a positive count, or return the default if it isn't given.
+def parse_count(text, default):
+    if not text:
+        return default
+
+    try:
+        count = int(text, 0)
+    except ValueError:
+        raise Exception(f'Bad count: {text}')
+
+    if count < 1:
+        raise Exception(f'Bad count: {text}')
+
+    return count
+
+
+# Get the ranges of addresses set in a bitmap, as inclusive start and end pairs.
+def bitmap_ranges(bits):
+    ranges = []
+    start = None
+
+    for addr in range(len(bits) * 8 + 1):
+        set_ = addr < len(bits) * 8 and (bits[addr >> 3] >> (addr & 7)) & 1
+
+        if set_ and start is None:
+            start = addr
+        elif not set_ and start is not None:
+            ranges.append((start, addr - 1))
+            start = None
+
+    return ranges
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'input',
+        metavar='INPUT',
+        type=pathlib.Path,
+        help='Path to input binary.'
+    )
+
+    parser.add_argument(
+        '-i',
+        '--uart-in',
+        default='',
+        help='UART input file.'
+    )
+
+    parser.add_argument(
+        '--no-decode-cache',
+        action='store_true',
+        help='Decode every instruction from memory as it is executed.'
+    )
+
+    parser.add_argument(
+        '--jit',
+        action='store_true',
+        help='Compile basic blocks into Python functions to run them.'
+    )
+
+    parser.add_argument(
+        '--unchecked',
+        action='store_true',
+        help='Skip checking for reads of uninitialised registers and memory.'
+    )
+
+    parser.add_argument(
+        '--resume',
+        type=pathlib.Path,
+        metavar='FILE',
+        help='Resume from a checkpoint instead of starting from reset.'
+    )
+
+    parser.add_argument(
+        '--record',
+        type=int,
+        metavar='INTERVAL',
+        help='Record the run, with checkpoints every INTERVAL instructions.'
+    )
+
+    parser.add_argument(
+        '--replay',
+        type=pathlib.Path,
+        metavar='FILE',
+        help='Replay a recording, starting from where it ended.'
+    )
+
+    args = parser.parse_args()
+
+    if not args.input.is_file():
+        raise Exception(f'Bad input file: {args.input}')
+
+    if args.resume and not args.resume.is_file():
+        raise Exception(f'Bad checkpoint file: {args.resume}')
+
+    if args.replay and not args.replay.is_file():
+        raise Exception(f'Bad recording file: {args.replay}')
+
+    if args.replay and (args.resume or args.record or args.uart_in):
+        raise Exception('Cannot replay with other input or a new recording')
+
+    if args.record is not None and args.record < 1:
+        raise Exception(f'Bad recording interval: {args.record}')
+
+    args.uart_in = sim.load_uart_file(args.uart_in) if args.uart_in else b''
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    cb = sim.UartCallback(channel.BufferInput(args.uart_in))
+    idli = sim.Idli(
+        args.input,
+        callback=cb,
+        decode_cache=not args.no_decode_cache,
+        use_jit=args.jit,
+        checked=not args.unchecked,
+    )
+
+    if args.resume:
+        cb.uart_out.restore(idli.load_checkpoint(args.resume), idli.uart_tx)
+        cb.uart_in.skip(idli.uart_rx)
+
+    recording = None
+
+    if args.replay:
+        recording = record.load(args.replay, idli, cb)
+        recording.seek(recording.end)
+    elif args.record:
+        recording = record.Recording(idli, cb, args.record)
+
+    Debugger(idli, cb, recording).loop()
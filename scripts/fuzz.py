@@ -0,0 +1,585 @@
+import argparse
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import pathlib
+import random
+import struct
+import tempfile
+import time
+
+import asm
+import isa
+import sim
+
+
+# Simulator options for each engine that can be compared.
+ENGINES = {
+    'uncached':         {'decode_cache': False},
+    'cached':           {},
+    'jit':              {'use_jit': True},
+    'unchecked':        {'checked': False},
+    'unchecked-jit':    {'use_jit': True, 'checked': False},
+}
+
+# Number of words of data after the program, which loads, stores, push and pop
+# access. The stack starts in the middle so it can grow in either direction.
+DATA_WORDS = 1 << 8
+
+# GREGs that instructions can write. SP is left alone, other than by push and
+# pop, so the stack stays within the data.
+GREGS = [f'r{x}' for x in range(7)]
+
+# Instructions to generate, which is every instruction in the ISA.
+NAMES = list(isa.SYNTAX)
+
+# Immediates that are more likely to find problems than random values.
+IMMS = [0, 1, -1, 2, 15, 16, 0xff, 0x7fff, -0x8000]
+
+# Instructions that shift by operand C, which are given small shifts.
+INSTRS_SHIFT = set(['srl', 'sra', 'ror', 'sll', 'putp'])
+
+# Loads and stores, which are given addresses within the data.
+INSTRS_MEM = set(['!ld', '!st', 'ld!', 'st!', 'ld', 'st'])
+
+
+# Random program as lines of assembly, with the data for the UART input.
+Program = collections.namedtuple('Program', 'lines uart')
+
+# Difference between two engines, giving the number of instructions after which
+# it was found and a description.
+Mismatch = collections.namedtuple('Mismatch', 'instructions message')
+
+
+# Callback reading the UART input and recording the values written to the UART,
+# which may be out of range for a byte.
+class FuzzCallback(sim.UartCallback):
+    def __init__(self, uart_in):
+        super().__init__(uart_in)
+        self.output = []
+
+    def write_uart(self, value, width):
+        self.output.append((value, width))
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '-n',
+        '--count',
+        type=int,
+        default=1000,
+        help='Number of random programs to run.',
+    )
+
+    parser.add_argument(
+        '-s',
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed of the first program, which increments for each one.',
+    )
+
+    parser.add_argument(
+        '-l',
+        '--length',
+        type=int,
+        default=200,
+        help='Number of random instructions in each program.',
+    )
+
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        type=int,
+        default=5000,
+        help='Maximum instructions to run for each program.',
+    )
+
+    parser.add_argument(
+        '-i',
+        '--interval',
+        type=int,
+        default=256,
+        help='Number of instructions to run between comparisons.',
+    )
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of programs to run in parallel.',
+    )
+
+    parser.add_argument(
+        '-r',
+        '--reference',
+        choices=ENGINES,
+        default='uncached',
+        help='Engine giving the expected results.',
+    )
+
+    parser.add_argument(
+        '-e',
+        '--engine',
+        choices=ENGINES,
+        default='jit',
+        help='Engine to check against the reference.',
+    )
+
+    parser.add_argument(
+        '-b',
+        '--build-dir',
+        type=pathlib.Path,
+        default=pathlib.Path('build/fuzz'),
+        help='Directory to write reproducers to.',
+    )
+
+    parser.add_argument(
+        '--replay',
+        type=pathlib.Path,
+        metavar='FILE',
+        help='Compare the engines on a reproducer instead of random programs.',
+    )
+
+    args = parser.parse_args()
+
+    if args.interval < 1:
+        raise Exception(f'Bad interval: {args.interval}')
+
+    if args.replay and not args.replay.is_file():
+        raise Exception(f'Bad reproducer: {args.replay}')
+
+    return args
+
+
+# Generates random programs. Every GREG and PREG is initialised first, and all
+# memory accesses are to the data following the program so the programs are
+# valid unless shrinking removes the setup. Each instruction has a label so
+# branches and jumps can target any of them, or the end of the program.
+class Generator:
+    def __init__(self, seed, length):
+        self.rng = random.Random(seed)
+        self.length = length
+        self.lines = []
+
+    # Generate the program, with enough UART input that it can't run out.
+    def program(self, timeout):
+        rng = self.rng
+
+        for reg in GREGS:
+            self.emit(f'mov {reg}, {self.imm()}')
+
+        self.emit('addpc sp, @stack')
+
+        for pred in ('p0', 'p1', 'p2'):
+            self.emit(f'{rng.choice(["putpf", "putpt"])} {pred}')
+
+        for i in range(self.length):
+            self.lines.append(f'L{i}:')
+            self.instr(i, rng.choice(NAMES))
+
+        self.lines.append('end:')
+        self.emit('b @end')
+
+        self.lines.append('data:')
+        for i in range(DATA_WORDS):
+            if i == DATA_WORDS // 2:
+                self.lines.append('stack:')
+            self.emit(f'.int {self.imm()}')
+
+        uart = [rng.randrange(-0x8000, 0x8000) for _ in range(timeout)]
+        return Program(lines=self.lines, uart=uart)
+
+    # Add a line with an instruction or directive.
+    def emit(self, line):
+        self.lines.append(f'    {line}')
+
+    # Random 16b immediate.
+    def imm(self):
+        if self.rng.random() < 0.5:
+            return self.rng.choice(IMMS)
+
+        return self.rng.randrange(-0x8000, 0x8000)
+
+    # Random GREG, other than any excluded.
+    def greg(self, *exclude):
+        return self.rng.choice([x for x in GREGS if x not in exclude])
+
+    # Label to branch or jump to, which is usually forwards so the program
+    # doesn't get stuck in a loop.
+    def target(self, i):
+        rng = self.rng
+
+        if i and rng.random() < 0.2:
+            target = rng.randrange(i + 1)
+        else:
+            target = rng.randrange(i + 1, self.length + 1)
+
+        return 'end' if target == self.length else f'L{target}'
+
+    # Generate the instruction with random operands, along with any setup it
+    # needs.
+    def instr(self, i, name):
+        rng = self.rng
+        syntax = isa.SYNTAX[name]
+
+        ops = {
+            'p': rng.choice(['pt', 'pt', 'p0', 'p1', 'p2']),
+            'q': rng.choice(list(isa.PREGS)[:4]),
+            'a': self.greg(),
+            'b': self.greg(),
+            'c': self.greg() if rng.random() < 0.5 else self.imm(),
+        }
+
+        # Register ranges can include any GREG other than SP.
+        mask = rng.randrange(1, 1 << len(GREGS))
+        ops['d'] = ', '.join(x for x in GREGS if mask & (1 << isa.GREGS[x]))
+
+        if name in isa.INSTRS_BRANCH:
+            ops['c'] = f'@{self.target(i)}'
+        elif name in isa.INSTRS_JUMP:
+            if rng.random() < 0.5:
+                ops['c'] = f'${self.target(i)}'
+            else:
+                ops['c'] = self.greg()
+                self.emit(f'mov {ops["c"]}, ${self.target(i)}')
+        elif name in INSTRS_SHIFT and rng.random() < 0.75:
+            ops['c'] = rng.randrange(17)
+        elif name in INSTRS_MEM:
+            self.emit(f'addpc {ops["b"]}, @data')
+
+            offset = rng.randrange(DATA_WORDS // 2)
+            if rng.random() < 0.5:
+                ops['c'] = offset
+            else:
+                ops['c'] = self.greg(ops['b'])
+                self.emit(f'mov {ops["c"]}, {offset}')
+
+        self.emit(syntax.format(**ops))
+
+
+# Assemble the program into a binary at the path, returning the address of the
+# end of the program.
+def assemble(lines, path):
+    args = argparse.Namespace(verbose=False, output=path)
+    items = []
+
+    for i, line in enumerate(lines):
+        items += asm.parse_line(args, line.strip(), None, f'{i + 1}: ', 0)
+
+    asm.resolve_labels(args, items)
+    asm.write_binary(args, items)
+
+    pc = 0
+    for item in items:
+        if isinstance(item, asm.Label):
+            if item.name == 'end':
+                return pc
+        elif isinstance(item, isa.Instruction):
+            pc += item.size()
+        else:
+            pc += 1
+
+    raise Exception('Missing end of program.')
+
+
+# Get the architectural state of a simulator. Validity is only tracked when the
+# simulator is checked.
+def get_state(idli, cb):
+    state = {
+        'pc': idli.pc,
+        'gregs': list(idli.gregs),
+        'pregs': list(idli.pregs),
+        'memory': idli.mem.tobytes(),
+        'UART input': idli.uart_rx,
+        'UART output': list(cb.output),
+    }
+
+    if idli.checked:
+        state['GREG validity'] = idli.greg_valid
+        state['PREG validity'] = idli.preg_valid
+        state['memory validity'] = bytes(idli.mem_valid)
+
+    return state
+
+
+# Describe the first difference between two states, or return None if they're
+# the same.
+def diff_states(expected, actual):
+    for name, value in expected.items():
+        if name not in actual or actual[name] == value:
+            continue
+
+        if name == 'memory':
+            words = zip(
+                struct.iter_unpack('=H', value),
+                struct.iter_unpack('=H', actual[name]),
+            )
+
+            for addr, (x, y) in enumerate(words):
+                if x != y:
+                    return (
+                        f'memory differs at 0x{addr:04x}: '
+                        f'expected 0x{x[0]:04x}, got 0x{y[0]:04x}'
+                    )
+
+        return f'{name} differs: expected {value}, got {actual[name]}'
+
+    return None
+
+
+# Run a simulator for at most the number of instructions, returning the result
+# or the exception raised.
+def advance(idli, count, stop):
+    try:
+        return idli.run(count, stop=stop)
+    except Exception as e:
+        return e
+
+
+# Describe the difference between the results of running two simulators, which
+# are either RunResults or exceptions, or return None if they're the same.
+def diff_results(expected, actual):
+    if isinstance(expected, Exception):
+        if not isinstance(actual, Exception):
+            return f'expected exception: {expected}'
+
+        if str(expected) != str(actual):
+            return f'exception differs: expected {expected}, got {actual}'
+    elif isinstance(actual, Exception):
+        return f'unexpected exception: {actual}'
+    elif expected != actual:
+        return f'result differs: expected {expected}, got {actual}'
+
+    return None
+
+
+# Run the program on the reference and the engine being checked, comparing the
+# state after every interval of instructions. Returns the first mismatch, or
+# None if they matched until the end of the program, the timeout, or the same
+# exception. The state isn't compared after an exception, as compiled blocks
+# don't write back their registers when an operation raises one. Programs that
+# read uninitialised state can't mismatch if either engine is unchecked, as
+# they're invalid.
+def compare(program, reference, engine, interval, timeout):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = pathlib.Path(tmp) / 'fuzz.iout'
+
+        end = assemble(program.lines, path)
+        uart = struct.pack(f'<{len(program.uart)}h', *program.uart)
+        sims = []
+
+        for name in (reference, engine):
+            cb = FuzzCallback(uart)
+            idli = sim.Idli(path, callback=cb, **ENGINES[name])
+            sims.append((idli, cb, sim.PcReached(end)))
+
+    checked = all(idli.checked for idli, _, _ in sims)
+    count = 0
+
+    while count < timeout:
+        size = min(interval, timeout - count)
+        results = [advance(idli, size, stop) for idli, _, stop in sims]
+
+        if not checked and any(
+            'uninitialised' in str(x)
+            for x in results
+            if isinstance(x, Exception)
+        ):
+            return None
+
+        message = diff_results(*results)
+        if message:
+            return Mismatch(count, message)
+
+        expected = results[0]
+        if isinstance(expected, Exception):
+            return None
+
+        count += expected.instructions
+
+        message = diff_states(*[get_state(idli, cb) for idli, cb, _ in sims])
+        if message:
+            return Mismatch(count, message)
+
+        if expected.reason == 'pc':
+            return None
+
+    return None
+
+
+# Generate and compare the random program for a seed, returning the seed and
+# any mismatch. This runs in a worker process.
+def run_seed(seed, args):
+    program = Generator(seed, args.length).program(args.timeout)
+    mismatch = compare(
+        program,
+        args.reference,
+        args.engine,
+        args.interval,
+        args.timeout,
+    )
+
+    return seed, mismatch
+
+
+# Shrink a program which gives a mismatch by removing as many of its
+# instructions as possible while it still gives one, first removing large
+# chunks then smaller ones. Labels are kept as branches may refer to them, and
+# unused ones are removed at the end.
+def shrink(program, args):
+    def fails(lines):
+        trial = program._replace(lines=lines)
+        return compare(
+            trial,
+            args.reference,
+            args.engine,
+            args.interval,
+            args.timeout,
+        ) is not None
+
+    lines = list(program.lines)
+    end = lines.index('end:')
+    size = end
+
+    while size:
+        i = 0
+
+        while i < end:
+            chunk = lines[i:i + size]
+            labels = [x for x in chunk if x.endswith(':')]
+            trial = lines[:i] + labels + lines[i + size:]
+
+            if len(labels) < len(chunk) and fails(trial):
+                end -= len(lines) - len(trial)
+                lines = trial
+            else:
+                i += size
+
+        size //= 2
+
+    # Data is needed by loads, but can usually be zero.
+    for i in range(lines.index('data:') + 1, len(lines)):
+        if lines[i].endswith(':') or lines[i].strip() == '.int 0':
+            continue
+
+        trial = lines[:i] + ['    .int 0'] + lines[i + 1:]
+        if fails(trial):
+            lines = trial
+
+    used = set()
+    for line in lines:
+        for part in line.replace(',', ' ').split():
+            if part[0] in '@$':
+                used.add(part[1:])
+
+    lines = [
+        x for x in lines
+        if not x.endswith(':') or x[:-1] in used | {'end', 'data', 'stack'}
+    ]
+
+    return program._replace(lines=lines)
+
+
+# Write a reproducer for a mismatch, as assembly and the UART input in the same
+# formats as the tests.
+def write_reproducer(path, program, mismatch, args):
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path, 'w') as f:
+        f.write(
+            f'# {args.engine} differs from {args.reference} after '
+            f'{mismatch.instructions} instructions:\n'
+            f'# {mismatch.message}\n'
+        )
+        f.write('\n'.join(program.lines) + '\n')
+
+    with open(path.with_suffix('.in'), 'w') as f:
+        f.write('\n'.join(str(x) for x in program.uart) + '\n')
+
+
+# Load a reproducer written by write_reproducer.
+def load_reproducer(path):
+    with open(path, 'r') as f:
+        lines = [x.rstrip('\n') for x in f if not x.startswith('#')]
+
+    uart = sim.load_uart_file(path.with_suffix('.in'))
+    uart = list(struct.unpack(f'<{len(uart) // 2}h', uart))
+
+    return Program(lines=lines, uart=uart)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.replay:
+        program = load_reproducer(args.replay)
+        mismatch = compare(
+            program,
+            args.reference,
+            args.engine,
+            args.interval,
+            args.timeout,
+        )
+
+        if mismatch:
+            raise Exception(
+                f'{args.engine} differs from {args.reference} after '
+                f'{mismatch.instructions} instructions: {mismatch.message}'
+            )
+
+        print(f'{args.engine} matches {args.reference}.')
+        raise SystemExit()
+
+    # Workers are forked from this process where possible so they share the ISA
+    # tables which have already been built on import.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = None
+
+    start = time.perf_counter()
+    seeds = range(args.seed, args.seed + args.count)
+    failures = []
+
+    with concurrent.futures.ProcessPoolExecutor(args.jobs, context) as pool:
+        run = functools.partial(run_seed, args=args)
+
+        for seed, mismatch in pool.map(run, seeds, chunksize=16):
+            if mismatch:
+                failures.append((seed, mismatch))
+                print(
+                    f'FAIL  seed {seed} after {mismatch.instructions} '
+                    f'instructions: {mismatch.message}'
+                )
+
+    elapsed = time.perf_counter() - start
+    print(
+        f'{args.count - len(failures)}/{args.count} programs matched in '
+        f'{elapsed:.3f}s'
+    )
+
+    if failures:
+        seed, mismatch = failures[0]
+        program = Generator(seed, args.length).program(args.timeout)
+        program = shrink(program, args)
+
+        mismatch = compare(
+            program,
+            args.reference,
+            args.engine,
+            args.interval,
+            args.timeout,
+        )
+
+        path = args.build_dir / f'seed-{seed}.ia'
+        write_reproducer(path, program, mismatch, args)
+        print(f'Reproducer for seed {seed} written to: {path}')
+
+        raise Exception(f'{len(failures)} programs differed!')
@@ -1,3 +1,4 @@
+import itertools
 import re
 import struct
 
@@ -272,18 +273,75 @@ SYNONYMS = {
 }
 
 
+# Plans for parsing each instruction and synonym from assembly, precomputed from
+# the syntax strings so they don't need searching for each line. Each is a tuple
+# of the real instruction name, the names of the operands in the order they're
+# written, and the operands a synonym adds as (name, source, value) tuples. The
+# value is copied from the source operand unless the source is None.
+PARSE_PLANS = {}
+
+for _name, _syntax in SYNTAX.items():
+    _ops = tuple(re.findall(r'\{([abcdpq])\}', _syntax))
+    PARSE_PLANS[_name] = (_name, _ops, ())
+
+for _name, (_syntax, _real, _op_map) in SYNONYMS.items():
+    _ops = tuple(re.findall(r'\{([abcdpq])\}', _syntax))
+    _adds = []
+
+    for _op, _value in _op_map.items():
+        _m = re.match(r'\{([abcdpq])\}', str(_value))
+        _adds.append((_op, _m.group(1) if _m else None, _value))
+
+    PARSE_PLANS[_name] = (_real, _ops, tuple(_adds))
+
+del _name, _syntax, _real, _op_map, _ops, _adds, _op, _value, _m
+
+
 # Instructions which read operand A as a source register.
 INSTRS_READ_A = set([
     '!st',
     'st!',
     'st',
     'insbl',
-    'insbt',
+    'insbh',
     'inc',
     'dec',
 ])
 
 
+# Instructions which branch relative to the PC.
+INSTRS_BRANCH = set([
+    'beqz',
+    'bnez',
+    'bltz',
+    'blez',
+    'bgtz',
+    'bgez',
+    'bt',
+    'bf',
+    'blt',
+    'blf',
+])
+
+
+# Instructions which jump to an absolute address.
+INSTRS_JUMP = set([
+    'jt',
+    'jf',
+    'jlt',
+    'jlf',
+])
+
+
+# Instructions which negate the predicate before checking it.
+INSTRS_PRED_INVERT = set([
+    'bf',
+    'blf',
+    'jf',
+    'jlf',
+])
+
+
 # Parse an immediate of the specified number of bits.
 def parse_imm(data, error_prefix='', bits=16):
     try:
@@ -309,6 +367,48 @@ def parse_imm(data, error_prefix='', bits=16):
     return imm
 
 
+# Numeric literals accepted by parse_imm, which are integer literals in Python
+# syntax with an optional sign.
+_NUMERIC = re.compile(
+    r'[+-]?(0[xX](_?[0-9a-fA-F])+|0[oO](_?[0-7])+|0[bB](_?[01])+'
+    r'|0(_?0)*|[1-9](_?[0-9])*)'
+)
+
+
+# Check whether a value is in range for parse_imm with the specified number of
+# bits.
+def _imm_in_range(imm, bits=16):
+    bias = 1 << (bits - 1)
+    if imm >= bias:
+        imm -= 1 << bits
+
+    return -bias <= imm < bias
+
+
+# Match a character literal at the start of an operand, such as 'A' or '\n',
+# returning the character or escape sequence between the quotes, or None if
+# there isn't one.
+def _match_char(value):
+    if value[:1] != "'":
+        return None
+
+    if value[1:2] == '\\':
+        if value[2:3] in ('\\', 't', 'n', '0') and value[3:4] == "'":
+            return value[1:3]
+
+        return None
+
+    if value[1:2] and value[2:3] == "'":
+        return value[1]
+
+    return None
+
+
+# Encoded instructions are 16b words followed by an optional signed immediate.
+_WORD = struct.Struct('>H')
+_IMM = struct.Struct('>h')
+
+
 # Class representing a single instruction.
 class Instruction:
     # Default to a NOP.
@@ -331,21 +431,15 @@ class Instruction:
         else:
             pred = None
 
-        # Find the syntax string for the instruction.
-        if instr.name in SYNONYMS:
-            syntax, instr.name, op_map = SYNONYMS[instr.name]
-        else:
-            syntax = SYNTAX.get(instr.name)
-            op_map = {}
-
-        if not syntax:
+        # Find the plan for parsing the instruction.
+        plan = PARSE_PLANS.get(instr.name)
+        if plan is None:
             raise Exception(f'{error_prefix}Unknown instruction: {instr.name}')
 
-        # Find all of the operands from the syntax string and parse them.
-        op_pattern = re.compile(r'\{(?P<name>[abcdpq])\}')
-        for name in op_pattern.finditer(syntax):
-            name = name.group('name')
+        instr.name, op_names, op_adds = plan
 
+        # Parse each of the operands in the order of the syntax string.
+        for name in op_names:
             # If this is operand p but none was specified in the instruction
             # name then it defaults to pt.
             if name == 'p' and not pred:
@@ -405,28 +499,27 @@ class Instruction:
             # - A character literal e.g. 'A', '\n'
             # - An absolute reference to a label e.g. $target
             # - A relative reference to a label e.g. @target
+            # Anything else, including numeric literals which are out of range,
+            # is parsed as a GREG.
             if name == 'c':
                 imm = None
 
                 if value[0] in '$@':
                     imm = value
-                elif m := re.match(r"'(?P<value>[^\\]|\\[\\tn0])'", value):
-                    value = m.group('value')
-                    if value == '\\0':
+                elif (char := _match_char(value)) is not None:
+                    if char == '\\0':
                         imm = 0
-                    elif value == '\\n':
+                    elif char == '\\n':
                         imm = ord('\n')
-                    elif value == '\\t':
+                    elif char == '\\t':
                         imm = ord('\t')
                     else:
-                        imm = ord(value)
-                else:
-                    # If we can't parse an immediate here then the value will be
-                    # treated as a GREG.
-                    try:
-                        imm = parse_imm(value, error_prefix)
-                    except:
-                        pass
+                        imm = ord(char)
+                elif (
+                    _NUMERIC.fullmatch(value)
+                    and _imm_in_range(int(value, 0))
+                ):
+                    imm = parse_imm(value, error_prefix)
 
                 # If an immediate was parsed then we should store it as an
                 # operand and encode c as r7.
@@ -448,9 +541,9 @@ class Instruction:
 
         # Add in an operands that come from the mapping from synonym to real
         # underlying instruction.
-        for name, value in op_map.items():
-            if m := op_pattern.match(str(value)):
-                instr.ops[name] = instr.ops[m.group('name')]
+        for name, source, value in op_adds:
+            if source is not None:
+                instr.ops[name] = instr.ops[source]
             else:
                 instr.ops[name] = value
 
@@ -499,42 +592,62 @@ class Instruction:
         out |= (enc & 0x000f) << 12
         return out
 
-    # Encode the instruction into raw bytes.
-    def encode(self, error_prefix=''):
-        bits = ENCODINGS[self.name]
+    # Get the first 16b word of the encoded instruction as stored in memory,
+    # along with the immediate or None if there isn't one.
+    def _encode_word(self, error_prefix=''):
+        fields = ENCODE_FIELDS[self.name]
+        enc = OPCODES[self.name]
+        count = 0
 
-        # Replace bits in the encoding with operand values.
+        # OR the operand values into their fields of the encoding.
         for name, value in self.ops.items():
             if name == 'imm':
                 continue
 
-            n = bits.count(name)
-            enc = f'{value:0{n}b}'
-
-            if len(enc) != n:
+            field = fields.get(name)
+            if field is None or not 0 <= value <= field[0]:
                 raise Exception(
                     f'{error_prefix}Cannot encode operand {name}: {value}'
                 )
 
-            enc = iter(enc)
-            bits = ''.join(next(enc) if x == name else x for x in bits)
+            enc |= value << field[1]
+            count += 1
 
-        # Generate bytes for the instruction.
-        enc = Instruction._reverse_nibbles(int(bits, 2))
-        enc = struct.pack('>H', enc)
+        if count != len(fields):
+            missing = [x for x in fields if x not in self.ops]
+            raise Exception(
+                f'{error_prefix}Missing operands to encode: {missing}'
+            )
 
-        # Append with immediate value if present.
         imm = self.ops.get('imm')
-        if imm is None:
-            return enc
-
-        if not isinstance(imm, int):
-            print(self)
+        if imm is not None and not isinstance(imm, int):
             raise Exception(
-                f'{error_prefix}Cannot encode non-int immediate: {imm}'
+                f'{error_prefix}Cannot encode non-int immediate {imm}: {self}'
             )
 
-        return enc + struct.pack('>h', imm)
+        return Instruction._reverse_nibbles(enc), imm
+
+    # Encode the instruction into raw bytes.
+    def encode(self, error_prefix=''):
+        word, imm = self._encode_word(error_prefix)
+
+        if imm is None:
+            return _WORD.pack(word)
+
+        return _WORD.pack(word) + _IMM.pack(imm)
+
+    # Encode the instruction into a buffer at the byte offset, returning the
+    # offset just after it. This avoids creating bytes for each instruction
+    # when encoding many of them.
+    def encode_into(self, buf, offset, error_prefix=''):
+        word, imm = self._encode_word(error_prefix)
+        _WORD.pack_into(buf, offset, word)
+
+        if imm is None:
+            return offset + 2
+
+        _IMM.pack_into(buf, offset + 2, imm)
+        return offset + 4
 
     # Size of the instruction when encoded in number of 16b chunks.
     def size(self):
@@ -543,45 +656,45 @@ class Instruction:
     # Parse instruction from a pair of 16b chunks.
     @staticmethod
     def from_bytes(this_half, next_half):
-        instr = Instruction()
-
         if len(this_half) < 2:
             raise Exception(f'Not enough bytes to parse: {this_half}')
 
-        # Read first 16b chunk and identify the instruction.
-        enc, = struct.unpack('>H', this_half)
-        enc = Instruction._reverse_nibbles(enc)
-        names = []
+        this_word, = struct.unpack('>H', this_half)
 
-        for name, opcode in OPCODES.items():
-            mask = OPCODE_MASKS[name]
+        if len(next_half) < 2:
+            next_word = None
+        else:
+            next_word, = struct.unpack('>H', next_half)
 
-            if (enc & mask) == opcode:
-                names.append(name)
+        return Instruction.from_words(this_word, next_word)
 
-        if not name:
-            raise Exception(f'No matching opcodes found: {this_half}')
-        if len(names) > 1:
-            raise Exception(f'Ambiguous decode of {this_half}: {names}')
+    # Parse instruction from a pair of 16b words as stored in memory. The second
+    # word is only required if the instruction takes an immediate, and may be
+    # None if it isn't available.
+    @staticmethod
+    def from_words(this_word, next_word):
+        entry = DECODE_TABLE[this_word]
 
-        instr.name = names[0]
-        enc_str = ENCODINGS[instr.name]
+        if entry is None:
+            raise Exception(f'No matching opcodes found: 0x{this_word:04x}')
+        if isinstance(entry, list):
+            raise Exception(f'Ambiguous decode of 0x{this_word:04x}: {entry}')
 
-        # Extract the operand values from the encoding.
-        instr.ops = {k: None for k in enc_str if k not in '01'}
-        for name in instr.ops:
-            mask = int(''.join('1' if x == name else '0' for x in enc_str), 2)
-            value = (enc & mask) >> ((mask & -mask).bit_length() - 1)
-            instr.ops[name] = value
+        instr = Instruction()
+        instr.name, values = entry
+        instr.ops = dict(zip(OPERAND_NAMES[instr.name], values))
 
-        # Read immediate operand if present.
+        # Read immediate operand if present, converting to signed.
         if instr.ops.get('c') == GREGS['r7']:
-            if len(next_half) < 2:
+            if next_word is None:
                 raise Exception(
-                    'Not enough bytes to parse immediate: {next_half}'
+                    f'Missing immediate for instruction: 0x{this_word:04x}'
                 )
 
-            instr.ops['imm'], = struct.unpack('>h', next_half)
+            if next_word & 0x8000:
+                next_word -= 1 << 16
+
+            instr.ops['imm'] = next_word
 
         return instr
 
@@ -591,3 +704,103 @@ class Instruction:
             return False
 
         return self.name == other.name and self.ops == other.ops
+
+
+# Bit fields of the operands in each encoding as (name, mask, shift) tuples,
+# listed in the order they first appear in the encoding string.
+OPERAND_FIELDS = {}
+
+for _name, _bits in ENCODINGS.items():
+    _fields = []
+
+    for _op in dict.fromkeys(x for x in _bits if x not in '01'):
+        _mask = int(''.join('1' if x == _op else '0' for x in _bits), 2)
+        _fields.append((_op, _mask, (_mask & -_mask).bit_length() - 1))
+
+    OPERAND_FIELDS[_name] = tuple(_fields)
+
+# Names of the operands in each encoding, in the same order as OPERAND_FIELDS.
+OPERAND_NAMES = {
+    k: tuple(x for x, _, _ in v) for k, v in OPERAND_FIELDS.items()
+}
+
+
+# Fields of the operands in each encoding for encoding instructions, as a map
+# from operand name to the maximum value and shift of the field.
+ENCODE_FIELDS = {
+    k: {x: (m >> s, s) for x, m, s in v} for k, v in OPERAND_FIELDS.items()
+}
+
+
+# Decode table mapping every raw 16b word, as it is stored in memory, to a tuple
+# of instruction name and operand values in the order of OPERAND_FIELDS. Words
+# that don't match any encoding are None, and words that match more than one
+# are a list of the matching names. This is built once by enumerating the free
+# operand bits of each encoding rather than searching the encodings on every
+# decode.
+DECODE_TABLE = [None] * (1 << 16)
+
+for _name, _fields in OPERAND_FIELDS.items():
+    # Reversing the nibbles just moves bits around, so the raw word is the sum
+    # of the reversed opcode and the reversed operand fields.
+    _base = Instruction._reverse_nibbles(OPCODES[_name])
+    _raws = itertools.product(*[
+        [Instruction._reverse_nibbles(v << s) for v in range((m >> s) + 1)]
+        for _, m, s in _fields
+    ])
+    _values = itertools.product(*[range((m >> s) + 1) for _, m, s in _fields])
+
+    for _raw, _entry in zip(map(sum, _raws), _values):
+        _raw += _base
+
+        if DECODE_TABLE[_raw] is None:
+            DECODE_TABLE[_raw] = (_name, _entry)
+        elif isinstance(DECODE_TABLE[_raw], list):
+            DECODE_TABLE[_raw].append(_name)
+        else:
+            DECODE_TABLE[_raw] = [DECODE_TABLE[_raw][0], _name]
+
+del _name, _bits, _fields, _op, _mask, _base, _raws, _values, _raw, _entry
+
+
+# Check the decode table against a search of all the encodings for every
+# possible 16b word, raising an exception on the first mismatch.
+def check_decode_table():
+    for raw in range(1 << 16):
+        enc = Instruction._reverse_nibbles(raw)
+        names = [k for k, v in OPCODES.items() if enc & OPCODE_MASKS[k] == v]
+        entry = DECODE_TABLE[raw]
+
+        if not names:
+            if entry is not None:
+                raise Exception(f'Bad decode of 0x{raw:04x}: {entry}')
+            continue
+
+        if len(names) > 1:
+            if entry != names:
+                raise Exception(f'Bad decode of 0x{raw:04x}: {entry}')
+            continue
+
+        name, = names
+        bits = ENCODINGS[name]
+        ops = {}
+
+        for op in bits:
+            if op in '01' or op in ops:
+                continue
+
+            mask = int(''.join('1' if x == op else '0' for x in bits), 2)
+            ops[op] = (enc & mask) >> ((mask & -mask).bit_length() - 1)
+
+        values = tuple(ops.values())
+        if entry is None or entry[0] != name or entry[1] != values:
+            raise Exception(
+                f'Bad decode of 0x{raw:04x}: expected {name} {ops}, '
+                f'got {entry}'
+            )
+
+
+# Running the module directly checks the generated tables.
+if __name__ == '__main__':
+    check_decode_table()
+    print('Decode table OK.')
@@ -0,0 +1,619 @@
+import array
+import collections
+
+import isa
+
+
+# Maximum number of instructions compiled into a single block.
+MAX_BLOCK_SIZE = 64
+
+
+# Instructions which end a basic block as they may redirect the PC.
+INSTRS_BLOCK_END = isa.INSTRS_BRANCH | isa.INSTRS_JUMP
+
+
+# A compiled basic block. The function runs the block and returns the number of
+# instructions executed, or zero if the block couldn't run and the instruction
+# at the PC should be run by the interpreter instead. The block covers the
+# addresses from start up to (but not including) end, which may extend past the
+# top of memory if the block wraps around.
+Block = collections.namedtuple('Block', 'func start end size')
+
+
+# Compiles basic blocks of instructions into Python functions for the
+# simulator. Registers are held in local variables for the duration of the block
+# and only written back to the simulator on exit.
+class BlockCompiler:
+    def __init__(self, sim):
+        self.sim = sim
+
+        # Compiled blocks indexed by their entry PC.
+        self.blocks = {}
+
+        # Number of blocks covering each address in memory. Stores to any
+        # address with a non-zero count must invalidate the blocks.
+        self.code = array.array('H', bytes(1 << 17))
+
+        # Addresses that blocks must not run through, so the simulator can stop
+        # at them. Blocks may still start at these addresses.
+        self.splits = set()
+
+        # Whether blocks end after each write to the UART, so the simulator can
+        # stop straight after it.
+        self.uart_tx_splits = False
+
+        # Whether reads from the UART can stall, in which case they're left to
+        # the interpreter so the run can stop before them.
+        self.stalls = sim.cb is not None and sim.cb.stalls
+
+    # Get the block starting at the specified address, compiling it if it isn't
+    # already in the cache. Returns None if no instructions could be compiled.
+    def get(self, addr):
+        block = self.blocks.get(addr)
+
+        if block is None:
+            block = self._compile(addr)
+            if block is None:
+                return None
+
+            self.blocks[addr] = block
+            for i in range(block.start, block.end):
+                self.code[i & 0xffff] += 1
+
+        return block
+
+    # Throw away all blocks, such as when the whole of memory is replaced.
+    def clear(self):
+        self.blocks.clear()
+        self.code[:] = array.array('H', bytes(len(self.code) * 2))
+
+    # Throw away all blocks containing the address.
+    def invalidate(self, addr):
+        for start, block in list(self.blocks.items()):
+            if ((addr - start) & 0xffff) < block.end - start:
+                self._remove(block)
+
+    # Make sure no block runs through the address, throwing away any that
+    # already do.
+    def split(self, addr):
+        if addr in self.splits:
+            return
+
+        self.splits.add(addr)
+
+        for start, block in list(self.blocks.items()):
+            offset = (addr - start) & 0xffff
+            if 0 < offset < block.end - start:
+                self._remove(block)
+
+    # Make sure blocks end after each write to the UART, throwing away any
+    # compiled before this was needed.
+    def split_uart_tx(self):
+        if self.uart_tx_splits:
+            return
+
+        self.uart_tx_splits = True
+        self.clear()
+
+    # Remove the block from the cache.
+    def _remove(self, block):
+        del self.blocks[block.start]
+        for i in range(block.start, block.end):
+            self.code[i & 0xffff] -= 1
+
+    # Find the instructions in the block starting at the specified address. The
+    # block ends at the first branch or jump, or at the first instruction that
+    # can't be decoded so it's left for the interpreter to report the error.
+    # UART reads which can stall are also left to the interpreter, and UART
+    # writes end the block when the simulator must be able to stop after them.
+    def _find_block(self, start):
+        instrs = []
+        addr = start
+
+        while len(instrs) < MAX_BLOCK_SIZE:
+            if instrs and (addr & 0xffff) in self.splits:
+                break
+
+            try:
+                instr = self.sim._decode(addr & 0xffff)
+            except Exception:
+                break
+
+            if self.stalls and instr.name in ('urxb', 'urx'):
+                break
+
+            instrs.append((addr, instr))
+            addr += instr.size()
+
+            if instr.name in INSTRS_BLOCK_END:
+                break
+
+            if self.uart_tx_splits and instr.name in ('utxb', 'utx'):
+                break
+
+        return instrs, addr
+
+    # Compile the block starting at the specified address.
+    def _compile(self, start):
+        instrs, end = self._find_block(start)
+        if not instrs:
+            return None
+
+        gen = _BlockGenerator(self.sim)
+        for i, (addr, instr) in enumerate(instrs):
+            gen.instr(i, addr & 0xffff, instr)
+
+        # Blocks which don't end in a branch fall through to the next address.
+        if instrs[-1][1].name not in INSTRS_BLOCK_END:
+            gen.exit(0, str(end & 0xffff), len(instrs))
+
+        namespace = {'sim': self.sim, 'jit': self}
+        exec(gen.source(), namespace)
+
+        return Block(
+            func=namespace['block'],
+            start=start,
+            end=end,
+            size=len(instrs),
+        )
+
+
+# Generates the source of the function for a single block.
+class _BlockGenerator:
+    def __init__(self, sim):
+        # Which events the callback handles, so hooks are only called for them.
+        self.on_greg = sim.on_greg is not None
+        self.on_preg = sim.on_preg is not None
+        self.on_mem_write = sim.on_mem_write is not None
+        self.on_mem_read = sim.on_mem_read is not None
+        self.on_uart_write = sim.on_uart_write is not None
+        self.icache = sim.icache is not None
+
+        # Whether validity is tracked, which unchecked simulators don't do.
+        self.checked = sim.checked
+
+        # Lines of the function body as (indent, line) pairs.
+        self.lines = []
+
+        # GREGs and PREGs used in the block, GREGs that must be valid on entry
+        # as they're read before being written, registers that have been
+        # written on every path so far and so become valid, registers that
+        # must be valid on entry as they're only written on some paths, and
+        # registers that have been written and so must be stored back on exit.
+        self.gregs_used = set()
+        self.gregs_checked = set()
+        self.gregs_defined = set()
+        self.gregs_cond = set()
+        self.gregs_dirty = set()
+        self.pregs_used = set()
+        self.pregs_defined = set()
+        self.pregs_cond = set()
+        self.pregs_dirty = set()
+
+        # Whether the current instruction is conditionally executed.
+        self.cond = False
+
+    # Add a line to the function body.
+    def emit(self, indent, line):
+        self.lines.append((indent, line))
+
+    # Read a GREG.
+    def rd(self, reg):
+        self.gregs_used.add(reg)
+        if reg not in self.gregs_defined:
+            self.gregs_checked.add(reg)
+
+        return f'r{reg}'
+
+    # Write a GREG with the value of the expression, masking to 16b.
+    def wr(self, indent, reg, expr):
+        self.gregs_used.add(reg)
+        self.gregs_dirty.add(reg)
+        if not self.cond:
+            self.gregs_defined.add(reg)
+        elif reg not in self.gregs_defined:
+            self.gregs_cond.add(reg)
+
+        self.emit(indent, f'r{reg} = ({expr}) & 0xffff')
+        if self.on_greg:
+            self.emit(indent, f'sim.on_greg({reg}, r{reg})')
+
+    # Read a PREG, with PT being constant.
+    def rd_pred(self, reg):
+        if reg == isa.PREGS['pt']:
+            return 'True'
+
+        self.pregs_used.add(reg)
+        return f'p{reg}'
+
+    # Write a PREG with the boolean value of the expression. Writes to PT are
+    # discarded, but the expression is still evaluated as the interpreter does
+    # so that any errors match.
+    def wr_pred(self, indent, reg, expr):
+        if reg == isa.PREGS['pt']:
+            self.emit(indent, expr)
+            return
+
+        self.pregs_used.add(reg)
+        self.pregs_dirty.add(reg)
+        if not self.cond:
+            self.pregs_defined.add(reg)
+        elif reg not in self.pregs_defined:
+            self.pregs_cond.add(reg)
+
+        self.emit(indent, f'p{reg} = bool({expr})')
+        if self.on_preg:
+            self.emit(indent, f'sim.on_preg({reg}, p{reg})')
+
+    # Operand C, which is either a GREG or an immediate.
+    def op_c(self, instr):
+        imm = instr.ops.get('imm')
+        if imm is None:
+            return self.rd(instr.ops['c'])
+
+        return repr(imm)
+
+    # Signed value of operand C. Immediates are converted in the same way as the
+    # interpreter does.
+    def op_c_signed(self, instr):
+        imm = instr.ops.get('imm')
+        if imm is None:
+            return _signed(self.rd(instr.ops['c']))
+
+        if imm & 0x8000:
+            imm -= 1 << 16
+
+        return repr(imm)
+
+    # Write back modified registers, set the PC and return from the block.
+    # Registers written on every path to the exit are marked as valid, unless
+    # they must already have been valid on entry.
+    def exit(self, indent, pc, count):
+        for reg in sorted(self.gregs_dirty):
+            self.emit(indent, f'gregs[{reg}] = r{reg}')
+        for reg in sorted(self.pregs_dirty):
+            self.emit(indent, f'pregs[{reg}] = p{reg}')
+
+        if self.checked:
+            gregs = self.gregs_defined - self.gregs_checked - self.gregs_cond
+            if gregs:
+                self.emit(indent, f'sim.greg_valid |= {_mask(gregs)}')
+
+            pregs = self.pregs_defined - self.pregs_cond
+            if pregs:
+                self.emit(indent, f'sim.preg_valid |= {_mask(pregs)}')
+
+        self.emit(indent, f'sim.pc = {pc}')
+        self.emit(indent, f'return {count}')
+
+    # Exit the block before the instruction if the word at the address in the
+    # expression has not been initialised. Unchecked simulators don't check.
+    def check_mem(self, indent, i, addr, expr):
+        if not self.checked:
+            return
+
+        self.emit(indent, f'if not (valid[{expr} >> 3] >> ({expr} & 7)) & 1:')
+        self.exit(indent + 1, str(addr), i)
+
+    # Load a word from memory into a GREG. The address must already have been
+    # checked.
+    def load(self, indent, reg, expr):
+        if self.on_mem_read:
+            value = _swap(f'mem[{expr}]')
+            self.emit(indent, f'sim.on_mem_read({expr}, {value})')
+
+        self.wr(indent, reg, f'mem[{expr}]')
+
+    # Store the value of a GREG to memory, invalidating any cached instructions
+    # and blocks at the address.
+    def store(self, indent, expr, reg):
+        if self.on_mem_write:
+            value = _swap(f'r{reg}')
+            self.emit(indent, f'sim.on_mem_write({expr}, {value})')
+
+        self.emit(indent, f'mem[{expr}] = r{reg}')
+        if self.checked:
+            self.emit(indent, f'valid[{expr} >> 3] |= 1 << ({expr} & 7)')
+
+        if self.icache:
+            self.emit(indent, f'icache.pop({expr}, None)')
+            self.emit(indent, f'icache.pop(({expr} - 1) & 0xffff, None)')
+
+        self.emit(indent, f'if jit.code[{expr}]:')
+        self.emit(indent + 1, f'jit.invalidate({expr})')
+        self.emit(indent + 1, 'hit = True')
+
+    # Generate the code for a single instruction.
+    def instr(self, i, addr, instr):
+        name = instr.name
+        ops = instr.ops
+        size = instr.size()
+
+        self.emit(0, f'# 0x{addr:04x}: {instr}')
+
+        if name in INSTRS_BLOCK_END:
+            self.branch(i, addr, instr)
+            return
+
+        # Predicated instructions are wrapped in a check of the predicate.
+        pred = ops.get('p')
+        if pred is None or pred == isa.PREGS['pt']:
+            indent = 0
+            self.cond = False
+        else:
+            self.emit(0, f'if {self.rd_pred(pred)}:')
+            indent = 1
+            self.cond = True
+
+        # Stores must exit the block after the instruction if they've written
+        # to the instructions of a block, as this one may now be stale.
+        stores = name in ('!st', 'st!', 'st', 'push')
+        if stores:
+            self.emit(indent, 'hit = False')
+
+        if name == 'nop':
+            self.emit(indent, 'pass')
+        elif name in _ALU_EXPRS:
+            a = ops.get('a')
+            b = ops.get('b')
+            expr = _ALU_EXPRS[name].format(
+                a=self.rd(a) if name in isa.INSTRS_READ_A else None,
+                b=self.rd(b) if b is not None else None,
+                c=self.op_c(instr) if 'c' in ops else None,
+                sb=_signed(f'r{b}') if b is not None else None,
+                pc=addr + 1,
+            )
+            self.wr(indent, a, expr)
+        elif name in _CMP_EXPRS:
+            expr = _CMP_EXPRS[name].format(
+                b=self.rd(ops['b']) if 'b' in ops else None,
+                c=self.op_c(instr) if 'c' in ops else None,
+                sb=_signed(self.rd(ops['b'])) if 'b' in ops else None,
+                sc=self.op_c_signed(instr) if 'c' in ops else None,
+            )
+            self.wr_pred(indent, ops['q'], expr)
+        elif name in ('!ld', '!st', 'ld!', 'st!', 'ld', 'st'):
+            self.ld_st(indent, i, addr, instr)
+        elif name == 'push':
+            self.push(indent, instr)
+        elif name == 'pop':
+            self.pop(indent, i, addr, instr)
+        elif name in ('urxb', 'urx'):
+            width = 1 if name == 'urxb' else 2
+            self.wr(indent, ops['a'], f'sim.cb.read_uart({width})')
+            self.emit(indent, f'sim.uart_rx += {width}')
+        elif name in ('utxb', 'utx'):
+            width = 1 if name == 'utxb' else 2
+            value = self.op_c(instr)
+            if self.on_uart_write:
+                self.emit(indent, f'sim.on_uart_write({value}, {width})')
+            self.emit(indent, f'sim.uart_tx += {width}')
+        else:
+            raise Exception(f'Cannot compile instruction: {instr}')
+
+        if stores:
+            self.emit(indent, 'if hit:')
+            self.exit(indent + 1, str((addr + size) & 0xffff), i + 1)
+
+        self.cond = False
+
+    # Load/store with optional writeback.
+    def ld_st(self, indent, i, addr, instr):
+        name = instr.name
+        a = instr.ops['a']
+        b = instr.ops['b']
+        wb_pre = name[0] == '!'
+        wb_post = name[-1] == '!'
+        load = 'ld' in name
+
+        base = self.rd(b)
+        offset = self.op_c(instr)
+        self.emit(indent, f'final = ({base} + {offset}) & 0xffff')
+        access = f'r{b}' if wb_post else 'final'
+
+        if load:
+            self.check_mem(indent, i, addr, access)
+            if wb_post:
+                self.emit(indent, f'access = {access}')
+                access = 'access'
+            self.load(indent, a, access)
+        else:
+            if wb_post:
+                self.emit(indent, f'access = {access}')
+                access = 'access'
+            if wb_pre and a == b:
+                self.wr(indent, b, 'final')
+            self.rd(a)
+            self.store(indent, access, a)
+
+        if wb_post:
+            self.wr(indent, b, 'final')
+
+    # Push register range onto the stack.
+    def push(self, indent, instr):
+        mask = instr.ops['d']
+        sp = isa.GREGS['sp']
+
+        self.emit(indent, f'sp = {self.rd(sp)}')
+
+        for idx in range(8):
+            if mask & (1 << idx):
+                self.rd(idx)
+                self.emit(indent, 'sp = (sp - 1) & 0xffff')
+                self.store(indent, 'sp', idx)
+
+        self.wr(indent, sp, 'sp')
+
+    # Pop register range from the stack. All the addresses are checked before
+    # any registers are written.
+    def pop(self, indent, i, addr, instr):
+        mask = instr.ops['d']
+        sp = isa.GREGS['sp']
+        count = bin(mask).count('1')
+
+        self.emit(indent, f'sp = {self.rd(sp)}')
+        for offset in range(count):
+            self.check_mem(indent, i, addr, f'((sp + {offset}) & 0xffff)')
+
+        for idx in reversed(range(8)):
+            if mask & (1 << idx):
+                self.load(indent, idx, 'sp')
+                self.emit(indent, 'sp = (sp + 1) & 0xffff')
+
+        self.wr(indent, sp, 'sp')
+
+    # Branches and jumps end the block.
+    def branch(self, i, addr, instr):
+        name = instr.name
+        ops = instr.ops
+        size = instr.size()
+        next_pc = (addr + size) & 0xffff
+
+        # Calculate the target before anything else in case it's the link
+        # register being overwritten.
+        imm = ops.get('imm')
+        if name in isa.INSTRS_JUMP:
+            if imm is None:
+                target = f'{self.rd(ops["c"])} & 0xffff'
+            else:
+                target = str(imm & 0xffff)
+        elif imm is None:
+            target = f'({addr + 1} + {self.rd(ops["c"])}) & 0xffff'
+        else:
+            target = str((addr + 1 + imm) & 0xffff)
+
+        if name in _BRANCH_REG_EXPRS:
+            cond = _BRANCH_REG_EXPRS[name].format(
+                sb=_signed(self.rd(ops['b'])),
+            )
+        else:
+            cond = self.rd_pred(ops['p'])
+            if name in ('bf', 'blf', 'jf', 'jlf'):
+                cond = f'not {cond}'
+
+        self.cond = True
+        self.emit(0, f'if {cond}:')
+        self.emit(1, f'target = {target}')
+
+        # The LR is written on every path to the exit for the taken branch, so
+        # becomes valid there without needing to be valid on entry.
+        defined = set(self.gregs_defined)
+
+        if name in ('blt', 'blf', 'jlt', 'jlf'):
+            self.cond = False
+            self.wr(1, isa.GREGS['lr'], str(next_pc))
+            self.cond = True
+
+        self.exit(1, 'target', i + 1)
+
+        self.gregs_defined = defined
+        self.exit(0, str(next_pc), i + 1)
+
+    # Get the source for the generated function.
+    def source(self):
+        lines = [
+            'def block():',
+            '    gregs = sim.gregs',
+            '    pregs = sim.pregs',
+            '    mem = sim.mem',
+            '    valid = sim.mem_valid',
+            '    icache = sim.icache',
+        ]
+
+        # If any GREGs are read before being written and aren't valid then let
+        # the interpreter handle the block so it can report errors correctly.
+        # Registers only written on some paths must also be valid, as the block
+        # doesn't track whether they've become valid.
+        if self.checked:
+            gregs = self.gregs_checked | self.gregs_cond
+            if gregs:
+                lines.append(f'    if ~sim.greg_valid & {_mask(gregs)}:')
+                lines.append('        return 0')
+
+            pregs = self.pregs_cond
+            if pregs:
+                lines.append(f'    if ~sim.preg_valid & {_mask(pregs)}:')
+                lines.append('        return 0')
+
+        for reg in sorted(self.gregs_used):
+            lines.append(f'    r{reg} = gregs[{reg}]')
+
+        for reg in sorted(self.pregs_used):
+            lines.append(f'    p{reg} = pregs[{reg}]')
+
+        for indent, line in self.lines:
+            lines.append(f'{"    " * (indent + 1)}{line}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# Mask of a set of registers.
+def _mask(regs):
+    return f'0x{sum(1 << x for x in regs):02x}'
+
+
+# Expression for the signed value of a 16b GREG.
+def _signed(expr):
+    return f'(({expr} ^ 0x8000) - 0x8000)'
+
+
+# Expression swapping the bytes of a 16b value, as seen by memory callbacks.
+def _swap(expr):
+    return f'((({expr}) & 0xff) << 8 | (({expr}) >> 8) & 0xff)'
+
+
+# Expressions for instructions writing a GREG. The result is masked to 16b when
+# written.
+_ALU_EXPRS = {
+    'add':      '{b} + {c}',
+    'sub':      '{b} - {c}',
+    'neg':      '-{b}',
+    'inc':      '{a} + 1',
+    'dec':      '{a} - 1',
+    'mov':      '{c}',
+    'addpc':    '{pc} + {c}',
+    'and':      '{b} & {c}',
+    'andn':     '{b} & ~{c}',
+    'or':       '{b} | {c}',
+    'xor':      '{b} ^ {c}',
+    'not':      '~{b}',
+    'srl':      '{b} >> {c}',
+    'sra':      '{sb} >> {c}',
+    'ror':      '({b} >> {c}) | ({b} << (16 - {c}))',
+    'sll':      '{b} << {c}',
+    'extbl':    '(({b} & 0xff) ^ 0x80) - 0x80',
+    'extbh':    '((({b} >> 8) & 0xff) ^ 0x80) - 0x80',
+    'insbl':    '({a} & 0xff00) | ({b} & 0xff)',
+    'insbh':    '({a} & 0xff) | (({b} & 0xff) << 8)',
+}
+
+
+# Expressions for instructions writing a PREG.
+_CMP_EXPRS = {
+    'eq':       '{sb} == {sc}',
+    'ne':       '{sb} != {sc}',
+    'lt':       '{sb} < {sc}',
+    'ltu':      '{b} < {c}',
+    'ge':       '{sb} >= {sc}',
+    'geu':      '{b} >= {c}',
+    'putp':     '({b} >> {c}) & 1',
+    'eqz':      '{sb} == 0',
+    'nez':      '{sb} != 0',
+    'ltz':      '{sb} < 0',
+    'lez':      '{sb} <= 0',
+    'gtz':      '{sb} > 0',
+    'gez':      '{sb} >= 0',
+    'putpf':    'False',
+    'putpt':    'True',
+}
+
+
+# Conditions for branches comparing a GREG with zero.
+_BRANCH_REG_EXPRS = {
+    'beqz':     '{sb} == 0',
+    'bnez':     '{sb} != 0',
+    'bltz':     '{sb} < 0',
+    'blez':     '{sb} <= 0',
+    'bgtz':     '{sb} > 0',
+    'bgez':     '{sb} >= 0',
+}
@@ -42,16 +42,17 @@ def parse(args):
         raise Exception(f'Input not multiple of 16b: {len(data)}')
 
     # Process all the data in 16b chunks, making notes of duplicates.
-    while data:
-        this_half = data[:2]
-        next_half = data[2:4]
+    offset = 0
+    while offset < len(data):
+        this_half = data[offset:offset + 2]
+        next_half = data[offset + 2:offset + 4]
 
         try:
             item = isa.Instruction.from_bytes(this_half, next_half)
-            data = data[item.size() * 2:]
+            offset += item.size() * 2
         except:
             item, = struct.unpack('>h', this_half)
-            data = data[2:]
+            offset += 2
 
         if items:
             prev_item, prev_count = items[-1]
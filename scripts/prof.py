@@ -0,0 +1,124 @@
+import argparse
+import array
+
+import objdump
+
+
+# Execution profile of a program, counted per PC in flat arrays so updating it
+# while simulating is cheap:
+# - runs        Number of times the instruction at each PC was executed.
+# - skips       Number of times it was skipped as the predicate was false.
+# - back        Number of times the branch at each PC redirected the PC
+#               backwards, or to itself. These close loops.
+# - back_to     Address last redirected to by each backwards branch.
+class Profile:
+    def __init__(self):
+        self.runs = array.array('Q', bytes(8 << 16))
+        self.skips = array.array('Q', bytes(8 << 16))
+        self.back = array.array('Q', bytes(8 << 16))
+        self.back_to = array.array('H', bytes(2 << 16))
+
+    # Total number of instructions counted, including skipped instructions.
+    def total(self):
+        return sum(self.runs) + sum(self.skips)
+
+    # Get the (pc, count) pairs for the most frequently executed PCs.
+    def hot_pcs(self, top):
+        counts = [
+            (pc, self.runs[pc] + self.skips[pc])
+            for pc in range(1 << 16)
+            if self.runs[pc] or self.skips[pc]
+        ]
+
+        counts.sort(key=lambda x: (-x[1], x[0]))
+        return counts[:top]
+
+    # Get the loops found in the profile as (head, tail, iterations, count)
+    # tuples, where the loop runs from the head to the backwards branch at the
+    # tail. The count is the number of instructions executed in that range,
+    # which doesn't include any functions called from the loop.
+    def loops(self, top):
+        loops = []
+
+        for tail in range(1 << 16):
+            iterations = self.back[tail]
+            if not iterations:
+                continue
+
+            head = self.back_to[tail]
+            count = sum(self.runs[head:tail + 1])
+            count += sum(self.skips[head:tail + 1])
+            loops.append((head, tail, iterations, count))
+
+        loops.sort(key=lambda x: (-x[3], x[0]))
+        return loops[:top]
+
+
+# Get a description of the instruction at a PC from the simulator memory, or
+# the raw data if it can't be decoded.
+def _describe(sim, pc):
+    try:
+        return str(sim._decode(pc))
+    except Exception:
+        return f'.data 0x{sim.mem[pc]:04x}'
+
+
+# Format a count as a percentage of the total.
+def _percent(count, total):
+    return 100 * count / total if total else 0
+
+
+# Generate the report of the hottest PCs and loops for a profile of the
+# simulator.
+def report(profile, sim, top=20):
+    total = profile.total()
+    lines = [f'Total instructions: {total}', '', 'Hottest PCs:']
+
+    for pc, count in profile.hot_pcs(top):
+        lines.append(
+            f'  {pc:04x}:  {count:12} {_percent(count, total):6.2f}%'
+            f'  {profile.skips[pc]:12} skipped  {_describe(sim, pc)}'
+        )
+
+    lines += ['', 'Hottest loops:']
+
+    for head, tail, iterations, count in profile.loops(top):
+        lines.append(
+            f'  {head:04x}-{tail:04x}:  {count:12} '
+            f'{_percent(count, total):6.2f}%  {iterations:12} iterations'
+        )
+
+    return lines
+
+
+# Generate the disassembly of the binary in the same format as objdump.dump,
+# with the execution count, skip count and percentage of the total inserted
+# after the raw encoding of each instruction.
+def annotate(profile, path):
+    args = argparse.Namespace(verbose=True, input=path)
+    lines = []
+    total = profile.total()
+
+    # Lines from objdump start with the PC and the raw encoding, which takes up
+    # a fixed number of columns.
+    width = len(f'{0:04x}:  {"":12}')
+
+    for line in objdump.dump(args, objdump.parse(args)):
+        pc = int(line[:4], 16)
+        count = profile.runs[pc] + profile.skips[pc]
+        lines.append(
+            f'{line[:width]}  {count:12} {profile.skips[pc]:12} '
+            f'{_percent(count, total):6.2f}%{line[width:]}'
+        )
+
+    return lines
+
+
+# Write the report and annotated disassembly for the profile to a file.
+def write(profile, sim, path, output, top=20):
+    lines = report(profile, sim, top)
+    lines += ['', 'Annotated disassembly:']
+    lines += annotate(profile, path)
+
+    with open(output, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
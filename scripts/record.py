@@ -0,0 +1,332 @@
+import argparse
+import bisect
+import pathlib
+import struct
+
+import channel
+import sim
+
+
+# Default number of instructions between checkpoints. Going back to any point
+# replays at most this many instructions, and each checkpoint is usually only a
+# few KB as memory compresses well.
+INTERVAL = 1 << 14
+
+# Recording files start with a header giving the interval, the furthest number
+# of instructions reached, the number of checkpoints, and the start and size of
+# the UART input log. Each checkpoint follows as its instruction count and size
+# then the checkpoint data, and the file ends with the UART input log.
+_RECORDING_MAGIC = b'IDLIREC1'
+_RECORDING_HEADER = struct.Struct('>8sQQIQQ')
+_RECORDING_CHECKPOINT = struct.Struct('>QI')
+
+
+# Recording of a run of the simulator, which can go back to any earlier point by
+# restoring the last checkpoint before it and replaying forwards. The UART is
+# the only input to the core, so the replay is identical to the original run as
+# long as the same input is read. Instead of logging every register and memory
+# write to undo them, checkpoints are taken every interval instructions and the
+# UART input is logged, so recording costs almost nothing and going back costs
+# at most an interval of replay:
+# - positions       Instruction counts at which checkpoints were taken.
+# - checkpoints     Checkpoint data for each position.
+# - end             Furthest instruction count that has been reached.
+class Recording:
+    def __init__(self, idli, cb, interval=INTERVAL):
+        if interval < 1:
+            raise Exception(f'Bad recording interval: {interval}')
+
+        self.sim = idli
+        self.cb = cb
+        self.interval = interval
+
+        # Log everything read from the UART so it can be read again.
+        if not isinstance(cb.uart_in, channel.RecordInput):
+            cb.uart_in = channel.RecordInput(cb.uart_in, start=idli.uart_rx)
+
+        self.positions = []
+        self.checkpoints = []
+        self.end = idli.instructions
+        self._checkpoint()
+
+        # Whether an exception has left the simulator part way through an
+        # instruction, so a checkpoint must be restored before replaying.
+        self.stale = False
+
+    # Run the simulator as Idli.run() does, taking a checkpoint each time the
+    # instruction count reaches an interval past the last one.
+    def run(self, max_instructions, stop=()):
+        idli = self.sim
+        count = 0
+
+        while True:
+            next_pos = self.positions[-1] + self.interval
+            limit = min(max_instructions - count, next_pos - idli.instructions)
+
+            try:
+                result = idli.run(limit, stop=stop)
+            except Exception:
+                self.stale = True
+                raise
+            finally:
+                self.end = max(self.end, idli.instructions)
+
+            count += result.instructions
+
+            if idli.instructions == next_pos:
+                self._checkpoint()
+
+            if result.reason != 'limit' or count >= max_instructions:
+                return sim.RunResult(reason=result.reason, instructions=count)
+
+    # Go to the point at which the target number of instructions had been run,
+    # which must be within the recording. This runs forwards from the current
+    # point if it's on the way, otherwise from the last checkpoint before it.
+    def seek(self, target):
+        if not self.positions[0] <= target <= self.end:
+            raise Exception(f'Instruction not recorded: {target}')
+
+        idli = self.sim
+        i = bisect.bisect_right(self.positions, target) - 1
+
+        if (
+            self.stale
+            or not self.positions[i] <= idli.instructions <= target
+        ):
+            self._restore(i)
+
+        self.run(target - idli.instructions)
+
+    # Go back the number of instructions, or to the start of the recording if
+    # there aren't that many. Returns the number of instructions gone back.
+    def reverse_step(self, count):
+        current = self.sim.instructions
+        self.seek(max(current - count, self.positions[0]))
+
+        return current - self.sim.instructions
+
+    # Go back to the last point before the current one at which any of the stop
+    # conditions was met, returning the reason, or to the start of the recording
+    # returning None if there wasn't one. The intervals between checkpoints are
+    # replayed from the latest backwards until one of them stops.
+    def reverse_continue(self, stop):
+        idli = self.sim
+        current = idli.instructions
+        i = bisect.bisect_left(self.positions, current) - 1
+
+        while i >= 0:
+            upper = current - 1
+            if i + 1 < len(self.positions):
+                upper = min(upper, self.positions[i + 1])
+
+            self._restore(i)
+            found = None
+
+            while idli.instructions < upper:
+                result = idli.run(upper - idli.instructions, stop=stop)
+                if result.reason != 'limit':
+                    found = (idli.instructions, result.reason)
+
+            if found is not None:
+                self.seek(found[0])
+                return found[1]
+
+            i -= 1
+
+        self._restore(0)
+        return None
+
+    # Write the recording to a file.
+    def save(self, path):
+        log = self.cb.uart_in
+
+        with open(path, 'wb') as f:
+            f.write(_RECORDING_HEADER.pack(
+                _RECORDING_MAGIC,
+                self.interval,
+                self.end,
+                len(self.positions),
+                log.start,
+                len(log.log),
+            ))
+
+            for pos, data in zip(self.positions, self.checkpoints):
+                f.write(_RECORDING_CHECKPOINT.pack(pos, len(data)))
+                f.write(data)
+
+            f.write(log.log)
+
+    # Take a checkpoint at the current point.
+    def _checkpoint(self):
+        self.positions.append(self.sim.instructions)
+        self.checkpoints.append(self.sim.dump_checkpoint())
+
+    # Restore the checkpoint at the index, along with the position in the UART
+    # input. The output from before the checkpoint isn't kept.
+    def _restore(self, i):
+        idli = self.sim
+        idli.restore_checkpoint(
+            self.checkpoints[i],
+            f'recording at {self.positions[i]}',
+        )
+
+        self.cb.uart_in.seek(idli.uart_rx)
+        self.cb.uart_out.restore(b'', idli.uart_tx)
+        self.stale = False
+
+
+# Load a recording from a file to replay on the simulator, replacing the UART
+# input of the callback with the recorded input. The simulator is left at the
+# start of the recording.
+def load(path, idli, cb):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if (
+        len(data) < _RECORDING_HEADER.size
+        or not data.startswith(_RECORDING_MAGIC)
+    ):
+        raise Exception(f'Bad recording file: {path}')
+
+    (
+        _,
+        interval,
+        end,
+        count,
+        log_start,
+        log_size,
+    ) = _RECORDING_HEADER.unpack_from(data)
+
+    offset = _RECORDING_HEADER.size
+    positions = []
+    checkpoints = []
+
+    for _ in range(count):
+        pos, size = _RECORDING_CHECKPOINT.unpack_from(data, offset)
+        offset += _RECORDING_CHECKPOINT.size
+
+        positions.append(pos)
+        checkpoints.append(data[offset:offset + size])
+        offset += size
+
+    log = data[offset:]
+    if not count or len(log) != log_size:
+        raise Exception(f'Bad recording file: {path}')
+
+    cb.uart_in = channel.RecordInput(log=log, start=log_start)
+
+    recording = Recording(idli, cb, interval)
+    recording.positions = positions
+    recording.checkpoints = checkpoints
+    recording.end = end
+    recording._restore(0)
+
+    return recording
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'input',
+        metavar='INPUT',
+        type=pathlib.Path,
+        help='Path to input binary.'
+    )
+
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        type=int,
+        default=5000,
+        help='Maximum ticks to run before ending the test.'
+    )
+
+    parser.add_argument(
+        '--interval',
+        type=int,
+        default=INTERVAL,
+        help='Number of instructions between checkpoints.'
+    )
+
+    parser.add_argument(
+        '-r',
+        '--recording',
+        type=pathlib.Path,
+        help='Recording file to write, defaulting to the input with .irec.'
+    )
+
+    parser.add_argument(
+        '--jit',
+        action='store_true',
+        help='Compile basic blocks into Python functions to run them.'
+    )
+
+    parser.add_argument(
+        '--unchecked',
+        action='store_true',
+        help='Skip checking for reads of uninitialised registers and memory.'
+    )
+
+    parser.add_argument(
+        '-i',
+        '--uart-in',
+        default='',
+        help='UART input file.'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--uart-out',
+        default='',
+        help='UART expected output file.'
+    )
+
+    args = parser.parse_args()
+
+    if not args.input.is_file():
+        raise Exception(f'Bad input file: {args.input}')
+
+    if args.interval < 1:
+        raise Exception(f'Bad recording interval: {args.interval}')
+
+    if args.recording is None:
+        args.recording = args.input.with_suffix('.irec')
+
+    args.uart_in = sim.load_uart_file(args.uart_in) if args.uart_in else b''
+    args.uart_out = sim.load_uart_file(args.uart_out) if args.uart_out else None
+
+    return args
+
+
+# Run a test as the simulator does, recording it so it can be replayed with the
+# debugger. The recording is written even if the run fails, as that's when it's
+# needed.
+if __name__ == '__main__':
+    args = parse_args()
+
+    cb = sim.UartCallback(args.uart_in)
+    idli = sim.Idli(
+        args.input,
+        callback=cb,
+        use_jit=args.jit,
+        checked=not args.unchecked,
+    )
+
+    recording = Recording(idli, cb, args.interval)
+    end = sim.UartSentinel(cb.uart_out, b'END', trailer=2)
+
+    try:
+        result = recording.run(
+            args.timeout,
+            stop=[end, sim.Halted(), sim.Idle()],
+        )
+    finally:
+        recording.save(args.recording)
+        print(
+            f'Recording of {recording.end} instructions written to: '
+            f'{args.recording}'
+        )
+
+    sim.check_test(result, end, cb.uart_out, args.uart_out)
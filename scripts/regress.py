@@ -0,0 +1,268 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import pathlib
+import time
+import xml.etree.ElementTree as ET
+
+import asm
+import objdump
+import sim
+
+
+# Name of the file included by every test which isn't a test itself.
+WRAPPER = 'wrapper.ia'
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '-d',
+        '--test-dir',
+        type=pathlib.Path,
+        default=pathlib.Path('tests/asm'),
+        help='Directory containing the test sources.',
+    )
+
+    parser.add_argument(
+        '-b',
+        '--build-dir',
+        type=pathlib.Path,
+        default=pathlib.Path('build'),
+        help='Directory to write binaries and disassembly to.',
+    )
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of tests to run in parallel.',
+    )
+
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        type=int,
+        default=5000,
+        help='Maximum instructions to run for each test.',
+    )
+
+    parser.add_argument(
+        '--jit',
+        action='store_true',
+        help='Run the tests using the JIT.',
+    )
+
+    parser.add_argument(
+        '--junit',
+        type=pathlib.Path,
+        help='Path to write JUnit XML results to.',
+    )
+
+    parser.add_argument(
+        '--json',
+        type=pathlib.Path,
+        help='Path to write JSON results to.',
+    )
+
+    parser.add_argument(
+        'names',
+        metavar='NAME',
+        nargs='*',
+        help='Tests to run, defaulting to all in the test directory.',
+    )
+
+    args = parser.parse_args()
+
+    if not args.test_dir.is_dir():
+        raise Exception(f'Bad test directory: {args.test_dir}')
+
+    return args
+
+
+# Find the sources of the tests to run.
+def find_tests(args):
+    if args.names:
+        paths = [args.test_dir / f'{x}.ia' for x in args.names]
+    else:
+        paths = sorted(args.test_dir.glob('*.ia'))
+
+    tests = []
+
+    for path in paths:
+        if path.name == WRAPPER:
+            continue
+
+        if not path.is_file():
+            raise Exception(f'Bad test source: {path}')
+
+        tests.append(path)
+
+    return tests
+
+
+# Load the UART data for a test, which is empty if the file doesn't exist.
+def load_uart(path):
+    if not path.is_file():
+        return bytes()
+
+    return sim.load_uart_file(path)
+
+
+# Assemble, disassemble and simulate a single test, returning a dict of the
+# results. This runs in a worker process so any exception from the test is
+# caught and reported in the result.
+def run_test(source, build_dir, timeout, use_jit):
+    binary = build_dir / source.with_suffix('.iout').name
+    result = {
+        'name': source.stem,
+        'passed': False,
+        'error': None,
+        'instructions': 0,
+        'asm_time': 0.0,
+        'objdump_time': 0.0,
+        'sim_time': 0.0,
+    }
+
+    stage = 'asm'
+    start = time.perf_counter()
+
+    try:
+        binary.parent.mkdir(parents=True, exist_ok=True)
+
+        asm_args = argparse.Namespace(
+            verbose=False,
+            input=source,
+            output=binary,
+        )
+
+        items = asm.parse_file(asm_args, source)
+        asm.resolve_labels(asm_args, items)
+        asm.write_binary(asm_args, items)
+
+        stage = 'objdump'
+        result['asm_time'] = time.perf_counter() - start
+        start = time.perf_counter()
+
+        dump_args = argparse.Namespace(verbose=False, input=binary)
+        lines = objdump.dump(dump_args, objdump.parse(dump_args))
+
+        with open(f'{binary}.dis', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        stage = 'sim'
+        result['objdump_time'] = time.perf_counter() - start
+        start = time.perf_counter()
+
+        cb = sim.UartCallback(load_uart(source.with_suffix('.in')))
+        idli = sim.Idli(binary, callback=cb, use_jit=use_jit)
+
+        end = sim.UartSentinel(cb.uart_out, b'END', trailer=2)
+        stop = [end, sim.Halted(), sim.Idle()]
+        run = idli.run(timeout, stop=stop)
+        result['instructions'] = run.instructions
+
+        expected = load_uart(source.with_suffix('.out'))
+        sim.check_test(run, end, cb.uart_out, expected)
+
+        result['passed'] = True
+    except Exception as e:
+        result['error'] = f'{stage}: {e}'
+
+    result[f'{stage}_time'] = time.perf_counter() - start
+    return result
+
+
+# Write the results in JUnit XML format.
+def write_junit(path, results, elapsed):
+    suite = ET.Element(
+        'testsuite',
+        name='idli',
+        tests=str(len(results)),
+        failures=str(sum(not x['passed'] for x in results)),
+        time=f'{elapsed:.6f}',
+    )
+
+    for result in results:
+        total = sum(result[f'{x}_time'] for x in ('asm', 'objdump', 'sim'))
+        case = ET.SubElement(
+            suite,
+            'testcase',
+            classname='asm',
+            name=result['name'],
+            time=f'{total:.6f}',
+        )
+
+        props = ET.SubElement(case, 'properties')
+        ET.SubElement(
+            props,
+            'property',
+            name='instructions',
+            value=str(result['instructions']),
+        )
+
+        if not result['passed']:
+            failure = ET.SubElement(case, 'failure', message=result['error'])
+            failure.text = result['error']
+
+    ET.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+
+# Write the results in JSON format.
+def write_json(path, results, elapsed):
+    with open(path, 'w') as f:
+        json.dump({'time': elapsed, 'tests': results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    tests = find_tests(args)
+
+    # Workers are forked from this process where possible so they share the ISA
+    # tables which have already been built on import.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = None
+
+    start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(args.jobs, context) as pool:
+        futures = [
+            pool.submit(run_test, x, args.build_dir, args.timeout, args.jit)
+            for x in tests
+        ]
+
+        results = []
+        for future in futures:
+            result = future.result()
+            results.append(result)
+
+            status = 'PASS' if result['passed'] else 'FAIL'
+            print(
+                f'{status}  {result["name"]:16}'
+                f'{result["instructions"]:12}'
+                f'{result["sim_time"]:10.3f}s'
+            )
+
+            if not result['passed']:
+                print(f'      {result["error"]}')
+
+    elapsed = time.perf_counter() - start
+
+    if args.junit:
+        write_junit(args.junit, results, elapsed)
+
+    if args.json:
+        write_json(args.json, results, elapsed)
+
+    failed = sum(not x['passed'] for x in results)
+    print(f'{len(results) - failed}/{len(results)} passed in {elapsed:.3f}s')
+
+    if failed:
+        raise Exception(f'{failed} tests failed!')
@@ -1,14 +1,67 @@
 import argparse
+import array
+import collections
+import mmap
+import operator
+import os
 import pathlib
 import struct
+import sys
+import tempfile
+import weakref
+import zlib
 
+import channel
 import isa
-import tb
+import jit
+import prof
+import timing
+import tracefile
+
+
+# Events that callbacks can handle. Reading from the UART isn't an event as the
+# core can't run without it, so it's always passed to the callback.
+EVENT_GREG = 1 << 0
+EVENT_PREG = 1 << 1
+EVENT_MEM_WRITE = 1 << 2
+EVENT_MEM_READ = 1 << 3
+EVENT_UART_WRITE = 1 << 4
+
+# Method of IdliCallback handling each event.
+EVENT_METHODS = {
+    EVENT_GREG:         'write_greg',
+    EVENT_PREG:         'write_preg',
+    EVENT_MEM_WRITE:    'write_mem',
+    EVENT_MEM_READ:     'read_mem',
+    EVENT_UART_WRITE:   'write_uart',
+}
+
+# Number of events held for a batched callback before they're delivered.
+BATCH_EVENTS = 1 << 12
 
 
 # Callback used by the simulator to invoke functions when events of note occur.
-# This is useful for comparisons with the RTL implementation of the core.
+# This is useful for comparisons with the RTL implementation of the core. Only
+# the events a callback handles are reported to it, so a callback which doesn't
+# care about an event costs nothing when it happens.
 class IdliCallback:
+    # Mask of the events to report. If this is None then the events are those
+    # with methods overridden by the subclass.
+    events = None
+
+    # If true, events are appended to a list as tuples of the event followed by
+    # the arguments of its method and passed to handle_events() in batches,
+    # instead of calling the method for each. Batches are delivered when full
+    # and at the end of each run, so they can lag behind reads from the UART.
+    # Batched callbacks must set the events mask.
+    batched = False
+
+    # If true, read_uart() can raise UartStall when there isn't enough input
+    # yet. The run then stops before the instruction reading the UART so it can
+    # be retried later, and the JIT leaves these instructions to the
+    # interpreter so they can be stopped before.
+    stalls = False
+
     # Called when a new value is written to a GREG.
     def write_greg(self, reg, value):
         pass
@@ -34,126 +87,1162 @@ class IdliCallback:
     def read_mem(self, addr, value):
         pass
 
+    # Called with a list of events when batched.
+    def handle_events(self, events):
+        raise NotImplementedError()
+
+
+# Raised by the read_uart() method of a callback which stalls when there isn't
+# enough UART input available yet. The run stops with the reason 'stall'.
+class UartStall(Exception):
+    pass
+
+
+# Get the mask of events the callback handles.
+def callback_events(cb):
+    if cb.events is not None:
+        return cb.events
+
+    if cb.batched:
+        raise Exception(f'Batched callback without events: {type(cb)}')
+
+    events = 0
+
+    for event, name in EVENT_METHODS.items():
+        if getattr(type(cb), name) is not getattr(IdliCallback, name):
+            events |= event
+
+    return events
+
+
+# Instruction decoded ahead of time for the instruction cache. As well as the
+# instruction itself this holds everything about it that doesn't depend on the
+# state of the core:
+# - func        Function implementing the operation.
+# - size        Size of the instruction in 16b chunks.
+# - pred        PREG controlling execution, or None if always executed.
+# - invert      Whether the predicate is negated before being checked.
+# - reads       Tuple of (operand, GREG) pairs read when executing.
+# - read_mask   Mask of every GREG read, including those PUSH and POP read
+#               directly, which must all be valid for the instruction to run.
+# - consts      Operands with fixed values, such as immediates, register range
+#               masks and the absolute targets of PC relative branches.
+Decoded = collections.namedtuple(
+    'Decoded',
+    'instr func size pred invert reads read_mask consts',
+)
+
+
+# Result of running the simulator, giving the reason it stopped and the number
+# of instructions that were executed.
+RunResult = collections.namedtuple('RunResult', 'reason instructions')
+
+
+# Condition for stopping a run of the simulator early. Conditions are checked
+# after each tick, or after each block when using the JIT.
+class StopCondition:
+    # Reason reported in the result when the condition stops the run.
+    reason = 'stop'
+
+    # Addresses the simulator must be able to stop at exactly. Blocks compiled
+    # by the JIT won't run through these.
+    pcs = ()
+
+    # Whether the condition can only be met by writing to the UART. Blocks
+    # compiled by the JIT end after each write so it's checked straight away.
+    uart_tx = False
+
+    # Returns true if the simulator should stop.
+    def check(self, sim):
+        return False
+
+
+# Stop when the PC reaches the specified address.
+class PcReached(StopCondition):
+    reason = 'pc'
+
+    def __init__(self, pc):
+        self.pc = pc
+        self.pcs = (pc,)
+
+    def check(self, sim):
+        return sim.pc == self.pc
+
+
+# Stop when a sentinel followed by a number of trailing bytes appears in the
+# UART output. The output must be a buffer that's appended to, such as a
+# bytearray, or an output channel, and is only searched when it has grown. Once
+# matched, the position of the sentinel in the output stream is available in
+# pos.
+class UartSentinel(StopCondition):
+    reason = 'uart'
+    uart_tx = True
+
+    def __init__(self, output, sentinel=b'END', trailer=0):
+        self.output = output
+        self.sentinel = sentinel
+        self.trailer = trailer
+        self.pos = None
+
+        # Length of the output that has already been searched.
+        self.searched = 0
+
+    def check(self, sim):
+        data, base = _output_window(self.output)
+
+        size = base + len(data)
+        if size == self.searched:
+            return False
+
+        # The sentinel may straddle the previously searched output. Positions
+        # are in the whole stream, but only the output from base is held.
+        start = max(self.searched - len(self.sentinel) + 1, base)
+        pos = data.find(self.sentinel, start - base)
+
+        if pos < 0:
+            self.searched = size
+            return False
+
+        pos += base
+
+        # Wait for the trailer to be written before stopping. We don't advance
+        # the search position so we find the sentinel again next time.
+        if size < pos + len(self.sentinel) + self.trailer:
+            self.searched = pos
+            return False
+
+        self.pos = pos
+        self.searched = size
+        return True
+
+
+# Get the output held by a buffer or output channel, and the position of its
+# first byte in the output stream.
+def _output_window(output):
+    if isinstance(output, (bytes, bytearray)):
+        return output, 0
+
+    return output.data, output.start
+
+
+# Stop when the core has halted on a branch or jump to its own PC which will
+# always be taken. Nothing changes any state while it spins, so it can never
+# leave the loop. There are no interrupts so this is true even if there's UART
+# input still waiting to be read. Halts are only looked for when the PC hasn't
+# changed since the last check, so this is cheap to check after every tick.
+class Halted(StopCondition):
+    reason = 'halt'
+
+    def __init__(self):
+        self.last_pc = None
+
+    def check(self, sim):
+        pc = sim.pc
+        if pc != self.last_pc:
+            self.last_pc = pc
+            return False
+
+        try:
+            instr = sim._decode(pc)
+        except Exception:
+            return False
+
+        # Branches and jumps that link write the LR, so only those which don't
+        # can be stopped at without changing the final state.
+        if instr.name not in ('bt', 'bf', 'jt', 'jf'):
+            return False
+
+        _, consts = predecode_operands(instr, pc)
+        if consts.get('target') != pc:
+            return False
+
+        pred = instr.ops['p']
+        if not (sim.preg_valid >> pred) & 1:
+            return False
+
+        taken = sim.pregs[pred]
+
+        if instr.name in isa.INSTRS_PRED_INVERT:
+            taken = not taken
+
+        return taken
+
+
+# Snapshot of the state of the core, used to find when it's stuck in a loop.
+IdleState = collections.namedtuple(
+    'IdleState',
+    'pc gregs greg_valid pregs preg_valid uart_rx uart_tx mem mem_valid',
+)
+
+
+# Stop when the core is stuck in a loop it can never leave, such as waiting on
+# a condition that never changes. The state of the core is saved periodically
+# and compared with the current state. If they're the same and no UART data has
+# been transferred in between then the core will keep going round the same loop
+# forever. To keep the cost of checking low the state is only compared every
+# stride checks. The snapshot is taken after the window of comparisons, then
+# after double the number each time, so any loop is eventually found while the
+# number of snapshots taken stays small.
+class Idle(StopCondition):
+    reason = 'idle'
+
+    def __init__(self, window=1 << 6, stride=1 << 4):
+        self.stride = stride
+        self.countdown = stride
+        self.limit = window
+        self.compares = 0
+        self.state = None
+
+    def check(self, sim):
+        self.countdown -= 1
+        if self.countdown:
+            return False
+
+        self.countdown = self.stride
+        state = self.state
+
+        # Compare cheapest first as registers are usually changing.
+        if (
+            state is not None
+            and sim.pc == state.pc
+            and sim.gregs == state.gregs
+            and sim.greg_valid == state.greg_valid
+            and sim.pregs == state.pregs
+            and sim.preg_valid == state.preg_valid
+            and sim.uart_rx == state.uart_rx
+            and sim.uart_tx == state.uart_tx
+            and sim.mem.tobytes() == state.mem
+            and sim.mem_valid == state.mem_valid
+        ):
+            return True
+
+        self.compares += 1
+        if self.compares >= self.limit:
+            self.state = IdleState(
+                pc=sim.pc,
+                gregs=list(sim.gregs),
+                greg_valid=sim.greg_valid,
+                pregs=list(sim.pregs),
+                preg_valid=sim.preg_valid,
+                uart_rx=sim.uart_rx,
+                uart_tx=sim.uart_tx,
+                mem=sim.mem.tobytes(),
+                mem_valid=bytes(sim.mem_valid),
+            )
+
+            self.compares = 0
+            self.limit *= 2
+
+        return False
+
+
+# Stop when the PC reaches any of a set of breakpoints, which are held as a
+# bitmap of PCs so checking after each tick is a single lookup. A breakpoint can
+# have a condition, which is a function taking the simulator and returning true
+# if it should stop. Blocks compiled by the JIT are split at every breakpoint.
+class Breakpoints(StopCondition):
+    reason = 'break'
+
+    def __init__(self):
+        self.bits = bytearray(1 << 13)
+        self.conds = {}
+
+    @property
+    def pcs(self):
+        return self.conds.keys()
+
+    # Add a breakpoint at the PC, replacing any condition already there.
+    def add(self, pc, cond=None):
+        self.bits[pc >> 3] |= 1 << (pc & 7)
+        self.conds[pc] = cond
+
+    # Remove the breakpoint at the PC.
+    def remove(self, pc):
+        if pc not in self.conds:
+            raise Exception(f'No breakpoint at: 0x{pc:04x}')
+
+        self.bits[pc >> 3] &= ~(1 << (pc & 7))
+        del self.conds[pc]
+
+    def check(self, sim):
+        pc = sim.pc
+        if not (self.bits[pc >> 3] >> (pc & 7)) & 1:
+            return False
+
+        cond = self.conds[pc]
+        return cond is None or bool(cond(sim))
+
+
+# Access to memory hitting a watchpoint, giving the PC of the instruction, the
+# address, the value read or written and whether it was a write.
+MemAccess = collections.namedtuple('MemAccess', 'pc addr value write')
+
+
+# Stop after an instruction reads or writes memory in any of a set of address
+# ranges, which are held as bitmaps of the addresses watched for reads and for
+# writes. Memory is only watched during runs that are passed the watchpoints,
+# which always use the interpreter so they stop after the exact instruction.
+# The simulator adds accesses to pending as they happen, and those that stopped
+# the run are moved to hits.
+class Watchpoints(StopCondition):
+    reason = 'watch'
+
+    def __init__(self):
+        self.reads = bytearray(1 << 13)
+        self.writes = bytearray(1 << 13)
+        self.pending = []
+        self.hits = []
+
+    # Watch the addresses from start to end inclusive for reads, writes or both.
+    def add(self, start, end, read=False, write=True):
+        for addr in range(start, end + 1):
+            bit = 1 << (addr & 7)
+            if read:
+                self.reads[addr >> 3] |= bit
+            if write:
+                self.writes[addr >> 3] |= bit
+
+    # Stop watching the addresses from start to end inclusive.
+    def remove(self, start, end):
+        for addr in range(start, end + 1):
+            bit = 1 << (addr & 7)
+            self.reads[addr >> 3] &= ~bit
+            self.writes[addr >> 3] &= ~bit
+
+    def check(self, sim):
+        if not self.pending:
+            return False
+
+        self.hits = self.pending
+        self.pending = []
+        return True
+
+
+# Convert a value from unsigned to signed.
+def _make_signed(value, bits=16):
+    sign_bit = 1 << (bits - 1)
+    bias = 1 << bits
+
+    if value & sign_bit:
+        value -= bias
+
+    return value
+
+
+# Binary operations on B and C writing A.
+_BINARY_OPS = {
+    'add':      operator.add,
+    'sub':      operator.sub,
+    'and':      operator.and_,
+    'andn':     lambda lhs, rhs: lhs & ~rhs,
+    'or':       operator.or_,
+    'xor':      operator.xor,
+    'srl':      operator.rshift,
+    'sra':      lambda lhs, rhs: _make_signed(lhs) >> rhs,
+    'ror':      lambda lhs, rhs: (lhs >> rhs) | (lhs << (16 - rhs)),
+    'sll':      operator.lshift,
+}
+
+
+# Comparisons of B and C writing Q, and whether the values are signed.
+_CMP_OPS = {
+    'eq':       (operator.eq, True),
+    'ne':       (operator.ne, True),
+    'lt':       (operator.lt, True),
+    'ltu':      (operator.lt, False),
+    'ge':       (operator.ge, True),
+    'geu':      (operator.ge, False),
+}
+
+
+# Comparisons of B with zero writing Q.
+_CMP_ZERO_OPS = {
+    'eqz':      operator.eq,
+    'nez':      operator.ne,
+    'ltz':      operator.lt,
+    'lez':      operator.le,
+    'gtz':      operator.gt,
+    'gez':      operator.ge,
+}
+
+
+# Comparisons of B with zero for branches.
+_BRANCH_REG_OPS = {
+    'beqz':     operator.eq,
+    'bnez':     operator.ne,
+    'bltz':     operator.lt,
+    'blez':     operator.le,
+    'bgtz':     operator.gt,
+    'bgez':     operator.ge,
+}
+
+
+# Split the operands of an instruction at the specified address into the GREGs
+# read when it's executed, as a tuple of (operand, GREG) pairs, and a dict of
+# operands with fixed values.
+def predecode_operands(instr, addr):
+    reads = []
+    consts = {}
+
+    for name, value in instr.ops.items():
+        # These operands are never read directly so can be skipped.
+        if name in ('p', 'q', 'imm'):
+            continue
+
+        # Only read A if the instruction uses it as a source operand.
+        if name == 'a' and instr.name not in isa.INSTRS_READ_A:
+            continue
+
+        # Immediates and register ranges come from the encoding.
+        if name == 'c' and value == isa.GREGS['r7']:
+            consts[name] = instr.ops['imm']
+        elif name == 'd':
+            consts[name] = value
+        else:
+            reads.append((name, value))
+
+    # Branches with an immediate always go to the same place, so calculate the
+    # target here. This is relative to the PC of the immediate for branches, or
+    # absolute for jumps.
+    if 'imm' in instr.ops:
+        if instr.name in isa.INSTRS_BRANCH:
+            consts['target'] = (addr + 1 + instr.ops['imm']) & 0xffff
+        elif instr.name in isa.INSTRS_JUMP:
+            consts['target'] = instr.ops['imm'] & 0xffff
+
+    return tuple(reads), consts
+
+
+# GREGs included in each register range mask, in increasing order.
+_RANGE_REGS = [
+    tuple(i for i in range(8) if mask & (1 << i)) for mask in range(1 << 7)
+]
+
+# Maps from instruction name to the function implementing it, shared by every
+# simulator with the same tracing and UART output. Each is built by Idli the
+# first time it's needed.
+_INSTR_FUNCS = {}
+
+
+# Get the GREGs an instruction reads in the order it reads them, given the
+# operands from predecode_operands. As well as the operands this includes the
+# SP and register range read by PUSH and POP.
+def greg_reads(instr, reads):
+    regs = [reg for _, reg in reads]
+
+    if instr.name in ('push', 'pop'):
+        regs.append(isa.GREGS['sp'])
+
+    if instr.name == 'push':
+        regs += _RANGE_REGS[instr.ops['d']]
+
+    return regs
+
+
+# Get the mask of the GREGs in a list.
+def greg_mask(regs):
+    mask = 0
+    for reg in regs:
+        mask |= 1 << reg
+
+    return mask
+
+
+# Load a binary into memory, returning the memory and the bitmap of which words
+# are valid. Memory can be addressed at 16b granularity only, so this takes up
+# the entire 16b address space with the content of the binary at the start.
+# Words are held in the order the core sees them.
+def load_binary(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if len(data) % 2:
+        raise Exception(f'Binary not multiple of 16b: {path}')
+    if len(data) > (1 << 17):
+        raise Exception(f'Binary exceeds memory size: {path}')
+
+    mem = array.array('H', data)
+    if sys.byteorder == 'little':
+        mem.byteswap()
+
+    size = len(mem)
+    mem.frombytes(bytes((1 << 17) - len(data)))
+
+    mem_valid = bytearray(1 << 13)
+    mem_valid[:size >> 3] = b'\xff' * (size >> 3)
+    if size & 7:
+        mem_valid[size >> 3] = (1 << (size & 7)) - 1
+
+    return mem, mem_valid
+
+
+# Close the file holding a program image, removing it if called in the process
+# which created it. Processes forked from the owner inherit the finalizer that
+# calls this, so the owner is checked when it runs rather than when created.
+def _close_image(fd, file, owner):
+    fd.close()
+    if owner == os.getpid():
+        os.unlink(file)
+
+
+# Binary loaded once so it can be shared between many simulators, which is much
+# cheaper than each loading it themselves. The memory is written to a temporary
+# file which each simulator maps copy-on-write, so all of them share the same
+# pages until they write to them and only the pages written are copied. Images
+# can be passed to worker processes, which map the same file. The file is
+# removed when the image is closed or garbage collected by the process that
+# created it, and copies in other processes only close their handle to it.
+class ProgramImage:
+    def __init__(self, path):
+        self.path = path
+        mem, self.mem_valid = load_binary(path)
+
+        fd, self.file = tempfile.mkstemp(prefix='idli-', suffix='.img')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(mem.tobytes())
+
+        self._open(owner=os.getpid())
+
+    # Open the file and register the finalizer which closes it, and removes it
+    # if this is the owning process.
+    def _open(self, owner):
+        self.fd = open(self.file, 'rb')
+        self._finalizer = weakref.finalize(
+            self,
+            _close_image,
+            self.fd,
+            self.file,
+            owner,
+        )
+
+    # Map the memory for a new simulator, returning the memory and the bitmap
+    # of which words are valid.
+    def map(self):
+        size = 1 << 17
+        data = mmap.mmap(self.fd.fileno(), size, access=mmap.ACCESS_COPY)
+
+        return memoryview(data).cast('H'), bytearray(self.mem_valid)
+
+    # Only the path to the file is passed to worker processes, which open it
+    # themselves.
+    def __getstate__(self):
+        return {
+            'path': self.path,
+            'file': self.file,
+            'mem_valid': self.mem_valid,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open(owner=None)
+
+    # Close the image, which does nothing if it's already closed.
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Checkpoints start with a header holding the state of the core:
+# - magic       Identifies the file as a checkpoint, including the version.
+# - pc          Current PC.
+# - count       Total number of instructions executed.
+# - uart_rx     Number of bytes read from the UART.
+# - uart_tx     Number of bytes written to the UART.
+# - greg_valid  Mask of GREGs that have been initialised.
+# - gregs       Value of each GREG, or zero if uninitialised.
+# - preg_valid  Mask of PREGs that have been initialised.
+# - pregs       Mask of PREGs that are set.
+# This is followed by the memory validity bitmap, the memory itself in the same
+# byte order as binaries and any extra data from the caller, all compressed
+# together with zlib. Most of memory is usually zero so this is much smaller
+# than the raw memory.
+_CHECKPOINT_MAGIC = b'IDLICKP1'
+_CHECKPOINT_HEADER = struct.Struct('>8sHQQQB8HBB')
+
 
 # Behavioural simulator for the CPU at the instruction level. This is not cycle
 # accurate!
 class Idli:
     # Initialise and reset the CPU.
-    def __init__(self, path, trace=False, callback=None):
-        self.trace = trace
+    def __init__(
+        self,
+        path,
+        trace=False,
+        callback=None,
+        decode_cache=True,
+        use_jit=False,
+        profile=False,
+        timed=False,
+        checked=True,
+    ):
         self.cb = callback
 
+        # Events are traced as text to stdout if trace is True. Otherwise it can
+        # be a tracer object from tracefile, such as one writing a binary trace,
+        # or false to disable tracing.
+        if trace is True:
+            trace = tracefile.TextTracer()
+        self.trace = trace or None
+
+        # Execution counts for each PC when profiling. This always uses the
+        # interpreter so predicate skips can be counted.
+        self.profile = prof.Profile() if profile else None
+
+        # Estimate of the cycles the RTL would take when timed. Like profiling,
+        # this always uses the interpreter as it counts every instruction.
+        self.timing = timing.Timing() if timed else None
+        self.counted = self.profile is not None or self.timing is not None
+
         # Program counter always resets to zero.
         self.pc = 0
 
-        # None of the GREGs are actually reset so set these to none at the start
-        # of time.
-        self.gregs = [None] * 8
+        # Total number of instructions executed by run().
+        self.instructions = 0
+
+        # Number of bytes read from and written to the UART. These give the
+        # position in each stream when saving a checkpoint.
+        self.uart_rx = 0
+        self.uart_tx = 0
+
+        # None of the GREGs are actually reset, so none are valid at the start
+        # of time. Each bit of the mask is set once the GREG is written, and
+        # the value is zero until then.
+        self.gregs = [0] * 8
+        self.greg_valid = 0
 
         # This is also true for PREGs, except we also have PT which is always
-        # set to 1.
-        self.pregs = [None] * 4
+        # set to 1. Uninitialised PREGs are treated as false.
+        self.pregs = [False] * 4
         self.pregs[isa.PREGS['pt']] = True
+        self.preg_valid = 1 << isa.PREGS['pt']
 
-        # Memory can be addressed at 16b granularity only. We create a memory
-        # which takes up the entire 16b address space (unitialised) then load
-        # the content of the specified binary.
-        self.mem = []
-        with open(path, 'rb') as f:
-            while data := f.read(2):
-                self.mem.append(data)
+        # Memory is either loaded from the binary at the path, or mapped from a
+        # program image which has already been loaded.
+        if isinstance(path, ProgramImage):
+            self.mem, self.mem_valid = path.map()
+        else:
+            self.mem, self.mem_valid = load_binary(path)
+
+        # Reads of uninitialised GREGs and memory raise an exception when
+        # checked, giving the PC of the instruction. Unchecked simulators don't
+        # track validity at all and treat everything as valid, which is faster
+        # and gives identical results for programs that never make such reads.
+        self.checked = checked
+        if not checked:
+            self._mark_valid()
+
+        # Hooks for each event the callback handles, or None for those it
+        # doesn't. Events for batched callbacks are held in a list until they're
+        # flushed.
+        self.events = []
+        self.cb_events = callback_events(callback) if callback else 0
+
+        self.on_greg = self._event_hook(EVENT_GREG)
+        self.on_preg = self._event_hook(EVENT_PREG)
+        self.on_mem_write = self._event_hook(EVENT_MEM_WRITE)
+        self.on_mem_read = self._event_hook(EVENT_MEM_READ)
+        self.on_uart_write = self._event_hook(EVENT_UART_WRITE)
+
+        # Operations which can be traced or reported to the callback have a fast
+        # variant which skips these checks entirely, selected for each operation
+        # when it's neither traced nor handled by the callback, and an unchecked
+        # variant which also skips tracking validity. All must have identical
+        # architectural behaviour. Tracing, the callback and checking can't be
+        # changed once the simulator is created.
+        traced = self.trace is not None
+
+        if traced or self.on_greg is not None:
+            self._write_greg = self._write_greg_traced
+        elif checked:
+            self._write_greg = self._write_greg_fast
+        else:
+            self._write_greg = self._write_greg_unchecked
+
+        if traced or self.on_preg is not None:
+            self._write_preg = self._write_preg_traced
+        elif checked:
+            self._write_preg = self._write_preg_fast
+        else:
+            self._write_preg = self._write_preg_unchecked
+
+        if traced:
+            self._write_pc = self._write_pc_traced
+        else:
+            self._write_pc = self._write_pc_fast
+
+        if traced or self.on_mem_write is not None:
+            self._write_mem = self._write_mem_traced
+        elif checked:
+            self._write_mem = self._write_mem_fast
+        else:
+            self._write_mem = self._write_mem_unchecked
 
-        self.mem += [None] * ((1 << 16) - len(self.mem))
+        if traced or self.on_mem_read is not None:
+            self._read_mem = self._read_mem_traced
+        elif checked:
+            self._read_mem = self._read_mem_fast
+        else:
+            self._read_mem = self._read_mem_unchecked
+
+        if checked:
+            self._read_operands = self._read_operands_checked
+        else:
+            self._read_operands = self._read_operands_unchecked
+
+        # Memory operations are wrapped to check accesses against watchpoints
+        # during runs that have them, and restored from these afterwards.
+        self.watch = None
+        self._mem_ops = (self._read_mem, self._write_mem)
 
         # Map from instruction name to function that implements the operation.
-        # Each function returns a bool indicating whether the instruction has
-        # modified the PC.
-        self.instr_funcs = {
-            'nop':      self._nop,
-            'beqz':     self._branch_reg,
-            'bnez':     self._branch_reg,
-            'bltz':     self._branch_reg,
-            'blez':     self._branch_reg,
-            'bgtz':     self._branch_reg,
-            'bgez':     self._branch_reg,
-            'push':     self._push,
-            'pop':      self._pop,
-            'eq':       self._cmp,
-            'ne':       self._cmp,
-            'lt':       self._cmp,
-            'ltu':      self._cmp,
-            'ge':       self._cmp,
-            'geu':      self._cmp,
-            'putp':     self._putp,
-            'eqz':      self._cmp,
-            'nez':      self._cmp,
-            'ltz':      self._cmp,
-            'lez':      self._cmp,
-            'gtz':      self._cmp,
-            'gez':      self._cmp,
-            'putpf':    self._putp,
-            'putpt':    self._putp,
-            'srl':      self._shift,
-            'sra':      self._shift,
-            'ror':      self._shift,
-            'sll':      self._shift,
-            '!ld':      self._ld_st,
-            '!st':      self._ld_st,
-            'ld!':      self._ld_st,
-            'st!':      self._ld_st,
-            'ld':       self._ld_st,
-            'st':       self._ld_st,
-            'extbl':    self._ext,
-            'extbh':    self._ext,
-            'insbl':    self._ins,
-            'insbh':    self._ins,
-            'not':      self._logic,
-            'neg':      self._add_sub,
-            'inc':      self._add_sub,
-            'dec':      self._add_sub,
-            'urxb':     self._uart_rx,
-            'urx':      self._uart_rx,
-            'add':      self._add_sub,
-            'sub':      self._add_sub,
-            'and':      self._logic,
-            'andn':     self._logic,
-            'or':       self._logic,
-            'xor':      self._logic,
-            'mov':      self._add_sub,
-            'addpc':    self._add_sub,
-            'bt':       self._branch_pred,
-            'bf':       self._branch_pred,
-            'blt':      self._branch_pred,
-            'blf':      self._branch_pred,
-            'jt':       self._branch_pred,
-            'jf':       self._branch_pred,
-            'jlt':      self._branch_pred,
-            'jlf':      self._branch_pred,
-            'utxb':     self._uart_tx,
-            'utx':      self._uart_tx,
-        }
+        self.instr_funcs = self._get_instr_funcs(
+            traced=self.trace is not None,
+            uart_write=self.on_uart_write is not None,
+        )
+
+        # Cache of decoded instructions by address, filled in the first time
+        # the instruction at each address is executed. Stores invalidate any
+        # entries they overlap. When the cache is disabled every instruction is
+        # decoded from memory as it's executed. tick() performs one "tick",
+        # equivalent to running a single instruction, using the implementation
+        # for the cache and tracing.
+        if decode_cache:
+            self.icache = {}
+            if self.trace is not None:
+                self.tick = self._tick_cached_traced
+            elif self.counted:
+                self.tick = self._tick_cached_counted
+            else:
+                self.tick = self._tick_cached_fast
+        else:
+            self.icache = None
+            self.tick = self._tick_uncached
+
+        # Compiler for running basic blocks as generated Python functions. This
+        # isn't used when tracing as instructions aren't run individually.
+        self.jit = jit.BlockCompiler(self) if use_jit else None
+
+        # Blocks are run by the JIT unless tracing, counting or watching memory,
+        # which need each instruction to be run individually.
+        self._set_watch(None)
+
+    # Run at most the specified number of instructions, or until one of the
+    # stop conditions is met. Returns a RunResult with the reason for stopping,
+    # which is 'limit' if the maximum number of instructions was reached.
+    def run(self, max_instructions, stop=()):
+        if isinstance(stop, StopCondition):
+            stop = [stop]
+
+        # Make sure compiled blocks will stop at any PCs or UART writes we need
+        # to check after.
+        if self.jit is not None:
+            for cond in stop:
+                for pc in cond.pcs:
+                    self.jit.split(pc)
+
+                if cond.uart_tx:
+                    self.jit.split_uart_tx()
+
+        # Only watch memory if there are watchpoints for this run, dropping any
+        # accesses left over from a run some other condition stopped.
+        watch = None
+        for cond in stop:
+            if isinstance(cond, Watchpoints):
+                watch = cond
+                watch.pending.clear()
+
+        if watch is not self.watch:
+            self._set_watch(watch)
+
+        count = 0
+        reason = 'limit'
+
+        # The total includes the instructions run before any exception, so
+        # it's known where a failed run stopped.
+        try:
+            if not stop:
+                while count < max_instructions:
+                    count += self.run_block(max_instructions - count)
+            else:
+                while count < max_instructions:
+                    count += self.run_block(max_instructions - count)
+
+                    for cond in stop:
+                        if cond.check(self):
+                            reason = cond.reason
+                            break
+                    else:
+                        continue
+
+                    break
+        except UartStall:
+            # The UART read is the first thing the instruction does, so going
+            # back to it is all that's needed to run it again later. Only the
+            # interpreter reads from a UART which stalls.
+            self.pc = (self.pc - 1) & 0xffff
+            reason = 'stall'
+        finally:
+            self.instructions += count
+
+        if self.events:
+            self.flush_events()
+
+        return RunResult(reason=reason, instructions=count)
+
+    # Deliver any events held for a batched callback.
+    def flush_events(self):
+        events = self.events
+        self.events = []
+        self.cb.handle_events(events)
+
+    # Get the function to call for an event, or None if the callback doesn't
+    # handle it.
+    def _event_hook(self, event):
+        if not self.cb_events & event:
+            return None
+
+        if not self.cb.batched:
+            return getattr(self.cb, EVENT_METHODS[event])
+
+        def hook(*args):
+            self.events.append((event,) + args)
+            if len(self.events) >= BATCH_EVENTS:
+                self.flush_events()
+
+        return hook
+
+    # Save the state of the core and memory to a checkpoint file. The callback
+    # isn't saved, but the UART stream positions are so the caller can resume
+    # the streams from the same point. Any other state the caller needs, such
+    # as the UART output so far, can be passed as bytes in extra.
+    def save_checkpoint(self, path, extra=b''):
+        with open(path, 'wb') as f:
+            f.write(self.dump_checkpoint(extra))
+
+    # Get a checkpoint of the state of the core and memory as bytes, in the
+    # same format as checkpoint files.
+    def dump_checkpoint(self, extra=b''):
+        pregs = 0
+
+        for i, value in enumerate(self.pregs):
+            if value:
+                pregs |= 1 << i
+
+        header = _CHECKPOINT_HEADER.pack(
+            _CHECKPOINT_MAGIC,
+            self.pc,
+            self.instructions,
+            self.uart_rx,
+            self.uart_tx,
+            self.greg_valid,
+            *self.gregs,
+            self.preg_valid,
+            pregs,
+        )
 
-    # Perform one "tick". This is equivalent to running a single instruction.
-    def tick(self):
+        mem = array.array('H', self.mem.tobytes())
+        if sys.byteorder == 'little':
+            mem.byteswap()
+
+        data = bytes(self.mem_valid) + mem.tobytes() + extra
+
+        return header + zlib.compress(data, 1)
+
+    # Restore the state of the core and memory from a checkpoint file, replacing
+    # whatever was loaded from the binary. Any cached or compiled instructions
+    # are thrown away as memory may have changed. Returns the extra data that
+    # was saved with the checkpoint.
+    def load_checkpoint(self, path):
+        with open(path, 'rb') as f:
+            return self.restore_checkpoint(f.read(), path)
+
+    # Restore the state of the core and memory from a checkpoint held as bytes,
+    # where the source is used to identify it in errors. Returns the extra data
+    # that was saved with the checkpoint.
+    def restore_checkpoint(self, data, source):
+        header = data[:_CHECKPOINT_HEADER.size]
+        data = data[_CHECKPOINT_HEADER.size:]
+
+        if (
+            len(header) != _CHECKPOINT_HEADER.size
+            or not header.startswith(_CHECKPOINT_MAGIC)
+        ):
+            raise Exception(f'Bad checkpoint file: {source}')
+
+        (
+            _,
+            pc,
+            instructions,
+            uart_rx,
+            uart_tx,
+            greg_valid,
+            *gregs,
+            preg_valid,
+            pregs,
+        ) = _CHECKPOINT_HEADER.unpack(header)
+
+        data = zlib.decompress(data)
+        valid_size = len(self.mem_valid)
+        mem_end = valid_size + (1 << 17)
+
+        if len(data) < mem_end:
+            raise Exception(f'Bad checkpoint memory size: {source}')
+
+        mem = array.array('H', data[valid_size:mem_end])
+        if sys.byteorder == 'little':
+            mem.byteswap()
+
+        self.mem[:] = mem
+        self.mem_valid[:] = data[:valid_size]
+
+        self.pc = pc
+        self.instructions = instructions
+        self.uart_rx = uart_rx
+        self.uart_tx = uart_tx
+
+        self.gregs[:] = gregs
+        self.greg_valid = greg_valid
+
+        for i in range(len(self.pregs)):
+            self.pregs[i] = bool((pregs >> i) & 1)
+
+        self.preg_valid = preg_valid
+
+        # Checkpoints from checked simulators only have some things valid.
+        if not self.checked:
+            self._mark_valid()
+
+        if self.icache is not None:
+            self.icache.clear()
+
+        if self.jit is not None:
+            self.jit.clear()
+
+        return data[mem_end:]
+
+    # Run instructions starting at the current PC, executing at most the
+    # specified number. If the JIT is enabled this runs a whole basic block,
+    # otherwise it's a single tick. Returns the number of instructions run.
+    def run_block(self, limit):
+        if self.use_blocks:
+            # Only compile new blocks if there's room to run a whole one, to
+            # avoid compiling a block at each PC as we approach the limit.
+            if limit >= jit.MAX_BLOCK_SIZE:
+                block = self.jit.get(self.pc)
+            else:
+                block = self.jit.blocks.get(self.pc)
+
+            if block is not None and block.size <= limit:
+                count = block.func()
+                if count:
+                    return count
+
+        self.tick()
+        return 1
+
+    # Tick using the cache of decoded instructions, without tracing.
+    def _tick_cached_fast(self):
+        pc = self.pc
+        entry = self.icache.get(pc)
+
+        if entry is None:
+            entry = self._predecode(pc)
+            self.icache[pc] = entry
+
+        # Account for the PC being updated before the instruction actually
+        # executes due to the pipeline in the RTL.
+        self.pc = (pc + 1) & 0xffff
+
+        # Check the predicate, inverting if required by the instruction.
+        if entry.pred is None:
+            run = True
+        else:
+            run = self.pregs[entry.pred]
+            if entry.invert:
+                run = not run
+
+        if run:
+            ops = self._read_operands(pc, entry)
+            redirect = entry.func(self, entry.instr, ops)
+        else:
+            redirect = False
+
+        # If the instruction didn't redirect the PC and it took an immediate
+        # then we need to increment the PC one more time.
+        if not redirect and entry.size > 1:
+            self.pc = (self.pc + entry.size - 1) & 0xffff
+
+    # Tick using the cache of decoded instructions, counting executions for the
+    # profile or timing model.
+    def _tick_cached_counted(self):
+        pc = self.pc
+        entry = self.icache.get(pc)
+
+        if entry is None:
+            entry = self._predecode(pc)
+            self.icache[pc] = entry
+
+        self.pc = (pc + 1) & 0xffff
+
+        if entry.pred is None:
+            run = True
+        else:
+            run = self.pregs[entry.pred]
+            if entry.invert:
+                run = not run
+
+        if run:
+            ops = self._read_operands(pc, entry)
+            redirect = entry.func(self, entry.instr, ops)
+        else:
+            redirect = False
+
+        if not redirect and entry.size > 1:
+            self.pc = (self.pc + entry.size - 1) & 0xffff
+
+        self._count(pc, entry.instr, run, redirect)
+
+    # Tick using the cache of decoded instructions, tracing each instruction as
+    # it runs or is skipped.
+    def _tick_cached_traced(self):
+        pc = self.pc
+        entry = self.icache.get(pc)
+
+        if entry is None:
+            entry = self._predecode(pc)
+            self.icache[pc] = entry
+
+        mem = self.mem
+        self.trace.run(pc, entry.instr, mem[pc], mem[(pc + 1) & 0xffff])
+
+        self.pc = (pc + 1) & 0xffff
+
+        if entry.pred is None:
+            run = True
+        else:
+            run = self.pregs[entry.pred]
+            if entry.invert:
+                run = not run
+
+        if run:
+            ops = self._read_operands(pc, entry)
+            redirect = entry.func(self, entry.instr, ops)
+        else:
+            self.trace.skip(entry.pred)
+            redirect = False
+
+        if not redirect and entry.size > 1:
+            self.pc = (self.pc + entry.size - 1) & 0xffff
+
+        if self.counted:
+            self._count(pc, entry.instr, run, redirect)
+
+    # Count an instruction at the PC which was either run or skipped in the
+    # profile and timing model, after the PC has been updated. Only PC relative
+    # branches redirecting backwards are counted as closing loops, as jumps are
+    # used for returns.
+    def _count(self, pc, instr, run, redirect):
+        profile = self.profile
+
+        if profile is not None:
+            if run:
+                profile.runs[pc] += 1
+            else:
+                profile.skips[pc] += 1
+
+            if (
+                redirect
+                and self.pc <= pc
+                and instr.name in isa.INSTRS_BRANCH
+            ):
+                profile.back[pc] += 1
+                profile.back_to[pc] = self.pc
+
+        if self.timing is not None:
+            self.timing.count(instr, run, redirect)
+
+    # Get operand values for a predecoded instruction at the PC, raising an
+    # exception if any of the GREGs it reads haven't been initialised. These are
+    # all checked at once against the mask of valid GREGs.
+    def _read_operands_checked(self, pc, entry):
+        if entry.read_mask & ~self.greg_valid:
+            self._check_reads(pc, entry.instr, entry.reads)
+
+        ops = dict(entry.consts)
+        gregs = self.gregs
+
+        for name, reg in entry.reads:
+            ops[name] = gregs[reg]
+
+        return ops
+
+    # Get operand values for a predecoded instruction without checking them.
+    def _read_operands_unchecked(self, pc, entry):
+        ops = dict(entry.consts)
+        gregs = self.gregs
+
+        for name, reg in entry.reads:
+            ops[name] = gregs[reg]
+
+        return ops
+
+    # Raise an exception for the first GREG the instruction at the PC reads
+    # which hasn't been initialised, if there is one.
+    def _check_reads(self, pc, instr, reads):
+        for reg in greg_reads(instr, reads):
+            if not (self.greg_valid >> reg) & 1:
+                raise Exception(
+                    f'Read of uninitialised register {isa.GREGS_INV[reg]} '
+                    f'at 0x{pc:04x} in instruction: {instr}'
+                )
+
+    # Decode the instruction at the specified address for the cache.
+    def _predecode(self, addr):
+        instr = self._decode(addr)
+        reads, consts = predecode_operands(instr, addr)
+
+        return Decoded(
+            instr=instr,
+            func=self.instr_funcs[instr.name],
+            size=instr.size(),
+            pred=instr.ops.get('p'),
+            invert=instr.name in isa.INSTRS_PRED_INVERT,
+            reads=reads,
+            read_mask=greg_mask(greg_reads(instr, reads)),
+            consts=consts,
+        )
+
+    # Tick without the cache, decoding the instruction from memory.
+    def _tick_uncached(self):
         # Fetch and decode the next instruction at the current PC.
+        pc = self.pc
         instr, next_pc = self.next_instr()
 
         if self.trace:
-            print(f'RUN     0x{self.pc:04x}    {instr}')
+            mem = self.mem
+            self.trace.run(pc, instr, mem[pc], mem[(pc + 1) & 0xffff])
 
         # Account for the PC being updated before the instruction actually
         # executes due to the pipeline in the RTL.
         self.pc = next_pc
 
         # Run the instruction if required.
-        if self._check_run(instr):
+        run = self._check_run(instr)
+
+        if run:
             redirect = self.instr_funcs[instr.name](
+                self,
                 instr,
-                self._get_operands(instr)
+                self._get_operands(pc, instr)
             )
         else:
             if self.trace:
-                print(f'SKIP    {isa.PREGS_INV[instr.ops["p"]]}')
+                self.trace.skip(instr.ops['p'])
 
             redirect = False
 
@@ -162,6 +1251,9 @@ class Idli:
         if not redirect:
             self.pc = (self.pc + instr.size() - 1) & 0xffff
 
+        if self.counted:
+            self._count(pc, instr, run, redirect)
+
     # Returns true if an instruction should be run. In most cases this is simply
     # checking if the predicate is true, but some instructions explicitly negate
     # the predicate before the check.
@@ -174,19 +1266,20 @@ class Idli:
 
         # Branches and jumps may negate the condition.
         pred = self.pregs[pred]
-        if instr.name in('bf', 'blf', 'jf', 'jlf'):
+        if instr.name in isa.INSTRS_PRED_INVERT:
             pred = not pred
 
         return pred
 
-    # Get operand values for the instruction, correctly handling the immediate
-    # and placing it in C if required.
-    def _get_operands(self, instr):
+    # Get operand values for the instruction at the PC, correctly handling the
+    # immediate and placing it in C if required.
+    def _get_operands(self, pc, instr):
         ops = {}
+        mask = 0
 
         for name, value in instr.ops.items():
             # These operands are never read directly so can be skipped.
-            if name in ('p', 'imm'):
+            if name in ('p', 'q', 'imm'):
                 continue
 
             # Only read A if the instruction uses it as a source operand.
@@ -203,315 +1296,391 @@ class Idli:
                 ops[name] = value
                 continue
 
-            # Read the GREG directly, raising an exception if it hasn't been
-            # initialised.
+            # Read the GREG directly, checking it's valid below.
             ops[name] = self.gregs[value]
+            mask |= 1 << value
 
-            if ops[name] is None:
-                raise Exception(
-                    f'Read of uninitialised register {isa.GREGS_INV[value]} '
-                    f'in instruction: {instr}'
-                )
+        # Raise an exception if any GREGs read, including any read directly by
+        # PUSH and POP, haven't been initialised.
+        if self.checked:
+            if instr.name in ('push', 'pop'):
+                mask |= greg_mask(greg_reads(instr, ()))
+
+            if mask & ~self.greg_valid:
+                self._check_reads(pc, instr, predecode_operands(instr, pc)[0])
 
         return ops
 
-    # Write a GREG and invoke the callback if it's defined.
-    def _write_greg(self, reg, value):
+    # Write a GREG, marking it as valid.
+    def _write_greg_fast(self, reg, value):
+        self.gregs[reg] = value & 0xffff
+        self.greg_valid |= 1 << reg
+
+    # Write a GREG without tracking validity.
+    def _write_greg_unchecked(self, reg, value):
+        self.gregs[reg] = value & 0xffff
+
+    # Write a GREG and invoke the callback if it handles it.
+    def _write_greg_traced(self, reg, value):
         value &= 0xffff
 
-        if self.cb:
-            self.cb.write_greg(reg, value)
+        if self.on_greg is not None:
+            self.on_greg(reg, value)
 
         if self.trace:
-            print(f'GREG    {isa.GREGS_INV[reg]}        0x{value:04x}')
+            self.trace.greg(reg, value)
 
         self.gregs[reg] = value
+        self.greg_valid |= 1 << reg
+
+    # Write a PREG, marking it as valid.
+    def _write_preg_fast(self, reg, value):
+        # Writes to p3 are ignored.
+        if reg != isa.PREGS['pt']:
+            self.pregs[reg] = bool(value & 1)
+            self.preg_valid |= 1 << reg
+
+    # Write a PREG without tracking validity.
+    def _write_preg_unchecked(self, reg, value):
+        if reg != isa.PREGS['pt']:
+            self.pregs[reg] = bool(value & 1)
 
     # Write a PREG and invoke the callback.
-    def _write_preg(self, reg, value):
+    def _write_preg_traced(self, reg, value):
         # Writes to p3 are ignored.
         if reg == isa.PREGS['pt']:
             return
 
         value = bool(value & 1)
 
-        if self.cb:
-            self.cb.write_preg(reg, value)
+        if self.on_preg is not None:
+            self.on_preg(reg, value)
 
         if self.trace:
-            print(f'PREG    {isa.PREGS_INV[reg]}        0x{int(value)}')
+            self.trace.preg(reg, value)
 
         self.pregs[reg] = value
+        self.preg_valid |= 1 << reg
+
+    # Write a new value to the PC.
+    def _write_pc_fast(self, value):
+        self.pc = value & 0xffff
 
-    # Wirte a new value to the PC.
-    def _write_pc(self, value):
+    # Write a new value to the PC and trace the branch.
+    def _write_pc_traced(self, value):
         value &= 0xffff
 
         if self.trace:
-            print(f'BRANCH  0x{value:04x}')
+            self.trace.branch(value)
 
         self.pc = value
 
-    # NOP doesn't do anything.
-    def _nop(self, instr):
-        return False
+    # Get the map from instruction name to the function implementing it, for
+    # simulators with or without tracing and UART output. Each function takes
+    # the simulator, the instruction and the operand values, and returns a bool
+    # indicating whether the instruction has modified the PC. The functions are
+    # specialised for each instruction so they don't need to inspect the
+    # instruction name when run, and are built once and shared by simulators
+    # so creating one is cheap.
+    @classmethod
+    def _get_instr_funcs(cls, traced, uart_write):
+        key = (traced, uart_write)
+        funcs = _INSTR_FUNCS.get(key)
+
+        if funcs is None:
+            funcs = cls._build_instr_funcs(traced, uart_write)
+            _INSTR_FUNCS[key] = funcs
+
+        return funcs
+
+    # Build a map from instruction name to the function implementing it.
+    @classmethod
+    def _build_instr_funcs(cls, traced, uart_write):
+        funcs = {
+            'nop':      cls._nop,
+            'push':     cls._push,
+            'pop':      cls._pop,
+            'putp':     cls._putp,
+            'putpf':    cls._make_putp_const(False),
+            'putpt':    cls._make_putp_const(True),
+            'extbl':    cls._extbl,
+            'extbh':    cls._extbh,
+            'insbl':    cls._insbl,
+            'insbh':    cls._insbh,
+            'not':      cls._not,
+            'neg':      cls._neg,
+            'inc':      cls._inc,
+            'dec':      cls._dec,
+            'urxb':     cls._make_uart_rx(1, traced),
+            'urx':      cls._make_uart_rx(2, traced),
+            'mov':      cls._mov,
+            'addpc':    cls._addpc,
+            'utxb':     cls._make_uart_tx(1, traced, uart_write),
+            'utx':      cls._make_uart_tx(2, traced, uart_write),
+        }
 
-    # ADD/SUB are used to synthesise a number of other operations.
-    def _add_sub(self, instr, ops):
-        op = 'sub' if instr.name in ('neg', 'dec', 'sub') else 'add'
+        for name, func in _BINARY_OPS.items():
+            funcs[name] = cls._make_binary(func)
 
-        if instr.name in ('neg', 'mov'):
-            lhs = 0
-        elif instr.name in ('inc', 'dec'):
-            lhs = ops['a']
-        elif instr.name == 'addpc':
-            lhs = self.pc
-        else:
-            lhs = ops['b']
+        for name, (func, signed) in _CMP_OPS.items():
+            funcs[name] = cls._make_cmp(func, signed)
 
-        if instr.name in ('inc', 'dec'):
-            rhs = 1
-        elif instr.name == 'neg':
-            rhs = ops['b']
-        else:
-            rhs = ops['c']
+        for name, func in _CMP_ZERO_OPS.items():
+            funcs[name] = cls._make_cmp_zero(func)
 
-        if op == 'add':
-            value = lhs + rhs
-        else:
-            value = lhs - rhs
+        for name, func in _BRANCH_REG_OPS.items():
+            funcs[name] = cls._make_branch_reg(func)
 
-        self._write_greg(instr.ops['a'], value)
+        for name in ('bt', 'bf', 'blt', 'blf', 'jt', 'jf', 'jlt', 'jlf'):
+            funcs[name] = cls._make_branch_pred(
+                link='l' in name,
+                relative=name[0] == 'b',
+            )
 
-        return False
+        for name in ('!ld', 'ld!', 'ld'):
+            funcs[name] = cls._make_load(wb_post=name[-1] == '!')
 
-    # Write a value into a predicate register.
-    def _putp(self, instr, ops):
-        if instr.name == 'putp':
-            value = (ops['b'] >> ops['c']) & 1
-        elif instr.name == 'putpt':
-            value = 1
-        else:
-            value = 0
+        for name in ('!st', 'st!', 'st'):
+            funcs[name] = cls._make_store(
+                wb_pre=name[0] == '!',
+                wb_post=name[-1] == '!',
+            )
 
-        self._write_preg(instr.ops['q'], value)
+        return funcs
 
+    # NOP doesn't do anything.
+    def _nop(self, instr, ops):
         return False
 
-    # Branch or jump to a new PC based on predicate. The predicate has already
-    # been checked by this stage so we can just redirect the PC.
-    def _branch_pred(self, instr, ops):
-        # Some branches write to the link register. If the instruction has an
-        # immediate then the PC needs to be incremented again.
-        if 'l' in instr.name:
-            next_pc = self.pc + int('imm' in instr.ops)
-            self._write_greg(isa.GREGS['lr'], next_pc)
+    # Binary operation on B and C writing the result to A.
+    @staticmethod
+    def _make_binary(func):
+        def run(self, instr, ops):
+            self._write_greg(instr.ops['a'], func(ops['b'], ops['c']))
+            return False
 
-        # Branches are PC relative while jumps are absolute.
-        lhs = self.pc if instr.name[0] == 'b' else 0
-        self._write_pc(lhs + ops['c'])
-
-        return True
+        return run
 
-    # Branch based on register comparison with zero.
-    def _branch_reg(self, instr, ops):
-        op = instr.name[1:2]
-        lhs = self._make_signed(ops['b'])
-        rhs = 0
-
-        if op == 'eq':
-            branch = lhs == rhs
-        elif op == 'ne':
-            branch = lhs != rhs
-        elif op == 'lt':
-            branch = lhs < rhs
-        elif op == 'le':
-            branch = lhs <= rhs
-        elif op == 'gt':
-            branch = lhs > rhs
-        else:
-            branch = lhs >= rhs
-
-        if branch:
-            self._write_pc(self.pc + ops['c'])
-
-        return branch
-
-    # Read bytes from UART.
-    def _uart_rx(self, instr, ops):
-        width = 1 if instr.name == 'urxb' else 2
-        value = self.cb.read_uart(width)
-
-        if self.trace:
-            if width == 1:
-                value_str = f'0x{value & 0xff:02x}'
-            else:
-                value_str = f'0x{value & 0xffff:04x}'
-            print(f'URX     {value_str:6}')
+    # Logical and arithmetic negation of B.
+    def _not(self, instr, ops):
+        self._write_greg(instr.ops['a'], ~ops['b'])
+        return False
 
-        self._write_greg(instr.ops['a'], value)
+    def _neg(self, instr, ops):
+        self._write_greg(instr.ops['a'], -ops['b'])
+        return False
 
+    # Increment or decrement A in place.
+    def _inc(self, instr, ops):
+        self._write_greg(instr.ops['a'], ops['a'] + 1)
         return False
 
-    # Write bytes to UART.
-    def _uart_tx(self, instr, ops):
-        width = 1 if instr.name == 'utxb' else 2
+    def _dec(self, instr, ops):
+        self._write_greg(instr.ops['a'], ops['a'] - 1)
+        return False
 
-        if self.trace:
-            if width == 1:
-                value_str = f'0x{ops["c"] & 0xff:02x}'
-            else:
-                value_str = f'0x{ops["c"] & 0xffff:04x}'
-            print(f'UTX     {value_str:6}')
+    # Move C into A.
+    def _mov(self, instr, ops):
+        self._write_greg(instr.ops['a'], ops['c'])
+        return False
 
-        self.cb.write_uart(ops['c'], width)
+    # Add C to the PC and write to A.
+    def _addpc(self, instr, ops):
+        self._write_greg(instr.ops['a'], self.pc + ops['c'])
+        return False
 
+    # Write bit C of B into a predicate register.
+    def _putp(self, instr, ops):
+        self._write_preg(instr.ops['q'], (ops['b'] >> ops['c']) & 1)
         return False
 
-    # Compare register with another register or zero.
-    def _cmp(self, instr, ops):
-        lhs = ops['b']
-        rhs = 0 if instr.name[-1] == 'z' else ops['c']
-
-        # Convert values to signed if required.
-        if instr.name not in ('ltu', 'geu'):
-            lhs = self._make_signed(lhs)
-            rhs = self._make_signed(rhs)
-
-        if instr.name.startswith('eq'):
-            value = lhs == rhs
-        elif instr.name.startswith('ne'):
-            value = lhs != rhs
-        elif instr.name.startswith('lt'):
-            value = lhs < rhs
-        elif instr.name.startswith('le'):
-            value = lhs <= rhs
-        elif instr.name.startswith('gt'):
-            value = lhs > rhs
-        else:
-            value = lhs >= rhs
+    # Clear or set a predicate register.
+    @staticmethod
+    def _make_putp_const(value):
+        def run(self, instr, ops):
+            self._write_preg(instr.ops['q'], value)
+            return False
 
-        self._write_preg(instr.ops['q'], value)
+        return run
 
-        return False
+    # Branch or jump to a new PC based on predicate. The predicate has already
+    # been checked by this stage so we can just redirect the PC.
+    @staticmethod
+    def _make_branch_pred(link, relative):
+        def run(self, instr, ops):
+            # Some branches write to the link register. If the instruction has
+            # an immediate then the PC needs to be incremented again.
+            if link:
+                next_pc = self.pc + int('imm' in instr.ops)
+                self._write_greg(isa.GREGS['lr'], next_pc)
+
+            # Branches are PC relative while jumps are absolute.
+            target = ops.get('target')
+            if target is None:
+                target = ops['c'] + (self.pc if relative else 0)
+
+            self._write_pc(target)
+            return True
 
-    # Convert a value from unsigned to signed.
-    def _make_signed(self, value, bits=16):
-        sign_bit = 1 << (bits - 1)
-        bias = 1 << bits
+        return run
 
-        if value & sign_bit:
-            value -= bias
+    # Branch based on register comparison with zero.
+    @staticmethod
+    def _make_branch_reg(func):
+        def run(self, instr, ops):
+            if not func(_make_signed(ops['b']), 0):
+                return False
 
-        return value
+            self._write_pc(ops.get('target', self.pc + ops['c']))
+            return True
 
-    # Logical ALU operations.
-    def _logic(self, instr, ops):
-        if instr.name == 'not':
-            op = 'or'
-            lhs = 0
-            rhs = ops['b']
+        return run
+
+    # Read bytes from UART.
+    @staticmethod
+    def _make_uart_rx(width, traced):
+        def run(self, instr, ops):
+            self._write_greg(instr.ops['a'], self.cb.read_uart(width))
+            self.uart_rx += width
+            return False
+
+        def run_traced(self, instr, ops):
+            value = self.cb.read_uart(width)
+            self.trace.urx(value, width)
+            self._write_greg(instr.ops['a'], value)
+            self.uart_rx += width
+            return False
+
+        return run_traced if traced else run
+
+    # Write bytes to UART, discarding them if nothing handles the output.
+    @staticmethod
+    def _make_uart_tx(width, traced, write):
+        def run(self, instr, ops):
+            self.on_uart_write(ops['c'], width)
+            self.uart_tx += width
+            return False
+
+        def run_discard(self, instr, ops):
+            self.uart_tx += width
+            return False
+
+        def run_traced(self, instr, ops):
+            self.trace.utx(ops['c'], width)
+            if write:
+                self.on_uart_write(ops['c'], width)
+            self.uart_tx += width
+            return False
+
+        if traced:
+            return run_traced
+        elif write:
+            return run
         else:
-            op = instr.name[:3]
+            return run_discard
+
+    # Compare register with another register, optionally treating both values
+    # as signed.
+    @staticmethod
+    def _make_cmp(func, signed):
+        def run(self, instr, ops):
             lhs = ops['b']
             rhs = ops['c']
 
-        if instr.name in ('not', 'andn'):
-            rhs = ~rhs
+            if signed:
+                lhs = _make_signed(lhs)
+                rhs = _make_signed(rhs)
 
-        if op == 'and':
-            value = lhs & rhs
-        elif op == 'or':
-            value = lhs | rhs
-        else:
-            value = lhs ^ rhs
+            self._write_preg(instr.ops['q'], func(lhs, rhs))
+            return False
 
-        self._write_greg(instr.ops['a'], value)
+        return run
 
-        return False
+    # Compare signed register with zero.
+    @staticmethod
+    def _make_cmp_zero(func):
+        def run(self, instr, ops):
+            self._write_preg(instr.ops['q'], func(_make_signed(ops['b']), 0))
+            return False
 
-    # Shift and rotate.
-    def _shift(self, instr, ops):
-        lhs = ops['b']
-        rhs = ops['c']
+        return run
 
-        if instr.name == 'sra':
-            lhs = self._make_signed(lhs)
+    # Extract and sign extend the high or low byte.
+    def _extbl(self, instr, ops):
+        self._write_greg(instr.ops['a'], _make_signed(ops['b'] & 0xff, 8))
+        return False
 
-        if instr.name in ('srl', 'sra'):
-            value = lhs >> rhs
-        elif instr.name == 'ror':
-            value = (lhs >> rhs) | (lhs << (16 - rhs))
-        else:
-            value = lhs << rhs
+    def _extbh(self, instr, ops):
+        value = _make_signed((ops['b'] >> 8) & 0xff, 8)
+        self._write_greg(instr.ops['a'], value)
+        return False
 
+    # Insert the low byte of B into the high or low byte of A.
+    def _insbl(self, instr, ops):
+        value = (ops['a'] & 0xff00) | (ops['b'] & 0xff)
         self._write_greg(instr.ops['a'], value)
+        return False
 
+    def _insbh(self, instr, ops):
+        value = (ops['a'] & 0xff) | ((ops['b'] & 0xff) << 8)
+        self._write_greg(instr.ops['a'], value)
         return False
 
-    # Extract and sign extend the high or low byte.
-    def _ext(self, instr, ops):
-        if instr.name[-1] == 'l':
-            value &= 0xff
-        else:
-            value = (value >> 8) & 0xff
+    # Load value from memory, optionally with writeback. Note that only the
+    # post-increment form writes the address back.
+    @staticmethod
+    def _make_load(wb_post):
+        def run(self, instr, ops):
+            addr = ops['b']
+            addr_final = (addr + ops['c']) & 0xffff
 
-        value = self._make_signed(value, 8)
-        self._write_greg(instr.ops['a'], value)
+            # If it isn't post-writeback then we should add the offset before
+            # performing the access.
+            if not wb_post:
+                addr = addr_final
 
-        return False
+            self._write_greg(instr.ops['a'], self._read_mem(addr))
 
-    # Insert the low byte of B into the high or low byte of A.
-    def _ins(self, instr, ops):
-        if instr.name[-1] == 'l':
-            value = (ops['a'] & 0xff00) | (ops['b'] & 0xff)
-        else:
-            value = (ops['a'] & 0xff) | ((ops['b'] & 0xff) << 8)
+            if wb_post:
+                self._write_greg(instr.ops['b'], addr_final)
 
-        self._write_greg(instr.ops['a'], value)
+            return False
 
-        return False
+        return run
 
-    # Load/store value from/to memory, optionally with writeback.
-    def _ld_st(self, instr, ops):
-        wb_pre = instr.name[0] == '!'
-        wb_post = instr.name[-1] == '!'
-        load = 'ld' in instr.name
-
-        # Calcualte address - if it isn't post-writeback then we should add the
-        # address before performing the access.
-        addr = ops['b']
-        addr_final = (addr + ops['c']) & 0xffff
-        if not wb_post:
-            addr = addr_final
-
-        # If the writeback address is the value being stored then it should be
-        # visible to the store - this is mainly to simplify the RTL.
-        if not load and wb_pre and instr.ops['a'] == instr.ops['b']:
-            self._write_greg(instr.ops['b'], addr_final)
-            ops['a'] = addr_final
-
-        # Load the value or store to the memory.
-        if load:
-            self._write_greg(instr.ops['a'], self._read_mem(addr))
-        else:
-            self._write_mem(addr, ops['a'])
+    # Store value to memory, optionally with writeback.
+    @staticmethod
+    def _make_store(wb_pre, wb_post):
+        def run(self, instr, ops):
+            addr = ops['b']
+            addr_final = (addr + ops['c']) & 0xffff
+            value = ops['a']
 
-        # Perform post-writeback if required.
-        if wb_post:
-            self._write_greg(instr.ops['b'], addr_final)
+            if not wb_post:
+                addr = addr_final
 
-        return False
+            # If the writeback address is the value being stored then it should
+            # be visible to the store - this is mainly to simplify the RTL.
+            if wb_pre and instr.ops['a'] == instr.ops['b']:
+                self._write_greg(instr.ops['b'], addr_final)
+                value = addr_final
+
+            self._write_mem(addr, value)
+
+            if wb_post:
+                self._write_greg(instr.ops['b'], addr_final)
+
+            return False
+
+        return run
 
     # PUSH register range onto the stack and update SP.
     def _push(self, instr, ops):
-        mask = instr.ops['d']
         sp = self.gregs[isa.GREGS['sp']]
 
-        for idx in isa.GREGS_INV:
-            if mask & (1 << idx):
-                sp = (sp - 1) & 0xffff
-                self._write_mem(sp, self.gregs[idx])
+        for idx in _RANGE_REGS[ops['d']]:
+            sp = (sp - 1) & 0xffff
+            self._write_mem(sp, self.gregs[idx])
 
         self._write_greg(isa.GREGS['sp'], sp)
 
@@ -519,57 +1688,240 @@ class Idli:
 
     # Reverse of push - operates similarly but it's from B to A instead.
     def _pop(self, instr, ops):
-        mask = instr.ops['d']
         sp = self.gregs[isa.GREGS['sp']]
 
-        for idx in reversed(isa.GREGS_INV):
-            if mask & (1 << idx):
-                self._write_greg(idx, self._read_mem(sp))
-                sp = (sp + 1) & 0xffff
+        for idx in reversed(_RANGE_REGS[ops['d']]):
+            self._write_greg(idx, self._read_mem(sp))
+            sp = (sp + 1) & 0xffff
 
         self._write_greg(isa.GREGS['sp'], sp)
 
         return False
 
-    # Write a value to memory.
-    def _write_mem(self, addr, value):
+    # Write a value to memory, marking it as valid.
+    def _write_mem_fast(self, addr, value):
+        self.mem[addr] = value & 0xffff
+        self.mem_valid[addr >> 3] |= 1 << (addr & 7)
+        self._invalidate_code(addr)
+
+    # Write a value to memory without tracking validity.
+    def _write_mem_unchecked(self, addr, value):
+        self.mem[addr] = value & 0xffff
+        self._invalidate_code(addr)
+
+    # Write a value to memory, invoking the callback and tracing.
+    def _write_mem_traced(self, addr, value):
+        value &= 0xffff
+
         # While the core works in little-endian, the memory is big-endian so we
-        # can deal with the SQI memory returning the high bits first.
-        value = self._swap_endian(value)
+        # can deal with the SQI memory returning the high bits first. Callbacks
+        # and tracing see the value as it would appear on the bus.
+        swapped = self._swap_endian(value)
 
-        if self.cb:
-            self.cb.write_mem(addr, value)
+        if self.on_mem_write is not None:
+            self.on_mem_write(addr, swapped)
 
         if self.trace:
-            print(f'STORE   0x{addr:04x}    0x{value:04x}')
+            self.trace.store(addr, swapped)
+
+        self.mem[addr] = value
+        self.mem_valid[addr >> 3] |= 1 << (addr & 7)
+        self._invalidate_code(addr)
+
+    # Write a value to memory, checking whether the address is watched.
+    def _write_mem_watched(self, addr, value):
+        self._mem_ops[1](addr, value)
+
+        if (self.watch.writes[addr >> 3] >> (addr & 7)) & 1:
+            self._watch_hit(addr, value & 0xffff, True)
+
+    # Drop any cached or compiled code for an address that has been written.
+    def _invalidate_code(self, addr):
+        # Any cached instruction using this address is now stale. This could be
+        # the instruction at the address or one with an immediate before it.
+        if self.icache is not None:
+            self.icache.pop(addr, None)
+            self.icache.pop((addr - 1) & 0xffff, None)
 
-        # Pack into LE as we've already converted manually to BE for tracing.
-        self.mem[addr] = struct.pack('<H', value)
+        # Compiled blocks covering the address are also stale.
+        if self.jit is not None and self.jit.code[addr]:
+            self.jit.invalidate(addr)
 
     # Load from memory.
-    def _read_mem(self, addr):
-        value, = struct.unpack('<H', self.mem[addr])
+    def _read_mem_fast(self, addr):
+        if not (self.mem_valid[addr >> 3] >> (addr & 7)) & 1:
+            self._bad_mem_read(addr)
 
-        if self.cb:
-            self.cb.read_mem(addr, value)
+        return self.mem[addr]
+
+    # Load from memory without checking it's valid.
+    def _read_mem_unchecked(self, addr):
+        return self.mem[addr]
+
+    # Load from memory, invoking the callback and tracing.
+    def _read_mem_traced(self, addr):
+        if not self._mem_is_valid(addr):
+            self._bad_mem_read(addr)
+
+        value = self.mem[addr]
+        swapped = self._swap_endian(value)
+
+        if self.on_mem_read is not None:
+            self.on_mem_read(addr, swapped)
 
         if self.trace:
-            print(f'LOAD    0x{addr:04x}    0x{value:04x}')
+            self.trace.load(addr, swapped)
 
-        return self._swap_endian(value)
+        return value
+
+    # Load from memory, checking whether the address is watched.
+    def _read_mem_watched(self, addr):
+        value = self._mem_ops[0](addr)
+
+        if (self.watch.reads[addr >> 3] >> (addr & 7)) & 1:
+            self._watch_hit(addr, value, False)
+
+        return value
+
+    # Record an access to a watched address. Only loads, stores, PUSH and POP
+    # access memory, and none of them redirect the PC, so the instruction is
+    # always the one before the PC.
+    def _watch_hit(self, addr, value, write):
+        pc = (self.pc - 1) & 0xffff
+        self.watch.pending.append(MemAccess(pc, addr, value, write))
+
+    # Watch memory accesses for the watchpoints, or stop watching if None. The
+    # JIT isn't used while watching as blocks don't check each access.
+    def _set_watch(self, watch):
+        self.watch = watch
+
+        if watch is None:
+            self._read_mem, self._write_mem = self._mem_ops
+        else:
+            self._read_mem = self._read_mem_watched
+            self._write_mem = self._write_mem_watched
+
+        self.use_blocks = (
+            self.jit is not None
+            and self.trace is None
+            and not self.counted
+            and watch is None
+        )
+
+    # Raise an exception for a read of uninitialised memory. Only loads and POP
+    # read memory, and neither redirects the PC, so the instruction is always
+    # the one before the PC.
+    def _bad_mem_read(self, addr):
+        pc = (self.pc - 1) & 0xffff
+        raise Exception(
+            f'Read of uninitialised memory: 0x{addr:04x} at 0x{pc:04x} in '
+            f'instruction: {self._decode(pc)}'
+        )
+
+    # Check whether the word at the address has been initialised.
+    def _mem_is_valid(self, addr):
+        return (self.mem_valid[addr >> 3] >> (addr & 7)) & 1
+
+    # Mark all the GREGs, PREGs and memory as valid, as unchecked simulators
+    # don't track validity.
+    def _mark_valid(self):
+        self.greg_valid = (1 << len(self.gregs)) - 1
+        self.preg_valid = (1 << len(self.pregs)) - 1
+        self.mem_valid[:] = b'\xff' * len(self.mem_valid)
 
     # Swap the endianness of the 16b value.
     def _swap_endian(self, value):
         return ((value & 0xff) << 8) | ((value >> 8) & 0xff)
 
+    # Decode the instruction at the specified address.
+    def _decode(self, addr):
+        if not self._mem_is_valid(addr):
+            raise Exception(f'Fetch from uninitialised memory: 0x{addr:04x}')
+
+        next_addr = (addr + 1) & 0xffff
+        next_word = None
+        if self._mem_is_valid(next_addr):
+            next_word = self.mem[next_addr]
+
+        return isa.Instruction.from_words(self.mem[addr], next_word)
+
     # Get the instruction at the current PC.
     def next_instr(self):
         next_pc = (self.pc + 1) & 0xffff
-        instr = isa.Instruction.from_bytes(self.mem[self.pc], self.mem[next_pc])
+        instr = self._decode(self.pc)
 
         return instr, next_pc
 
 
+# Callback feeding UART input into the core from an input channel and writing
+# the output from the core to an output channel. The input can also be bytes,
+# which are read from a buffer, and the output defaults to a buffer.
+class UartCallback(IdliCallback):
+    def __init__(self, uart_in, uart_out=None):
+        if isinstance(uart_in, (bytes, bytearray, memoryview)):
+            uart_in = channel.BufferInput(uart_in)
+
+        if uart_out is None:
+            uart_out = channel.BufferOutput()
+
+        self.uart_in = uart_in
+        self.uart_out = uart_out
+
+    def read_uart(self, width):
+        fmt = '<b' if width == 1 else '<h'
+        value, = struct.unpack(fmt, self.uart_in.read(width))
+
+        return value
+
+    def write_uart(self, value, width):
+        fmt = '<B' if width == 1 else '<H'
+        self.uart_out.write(struct.pack(fmt, value))
+
+
+# Check the result of running a test which writes END followed by its exit code
+# to the UART once finished, raising an exception if the test failed. The output
+# is a buffer or output channel, and isn't compared if expected is None.
+def check_test(result, end, uart_out, expected):
+    if result.reason == Halted.reason:
+        raise Exception(f'Test halted before finishing!')
+    elif result.reason == Idle.reason:
+        raise Exception(f'Test stuck in a loop before finishing!')
+    elif result.reason != end.reason:
+        raise Exception(f'Test exceeded timeout!')
+
+    data, base = _output_window(uart_out)
+    pos = end.pos - base
+
+    exit_code, = struct.unpack_from('<h', data, pos + len(end.sentinel))
+    if exit_code:
+        raise Exception(f'Test exited with code: {exit_code}')
+
+    # Check the output matched the expected value.
+    output = data[:pos]
+    if expected is not None and (base or expected != output):
+        raise Exception(
+            f'Test UART output differed from expected value:\n'
+            f'  Expected: {expected}\n'
+            f'  Actual:   {bytes(output)}'
+        )
+
+
+# Load UART values for test input or output. These files are formatted as a
+# single 16b value per line.
+def load_uart_file(path):
+    data = bytes()
+
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            data += struct.pack('<h', int(line, 0))
+
+    return data
+
+
 # Parse command line arguments if running in standalone mode.
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -589,6 +1941,75 @@ def parse_args():
         help='Maximum ticks to run before ending the test.'
     )
 
+    parser.add_argument(
+        '--no-decode-cache',
+        action='store_true',
+        help='Decode every instruction from memory as it is executed.'
+    )
+
+    parser.add_argument(
+        '--jit',
+        action='store_true',
+        help='Compile basic blocks into Python functions to run them.'
+    )
+
+    parser.add_argument(
+        '--unchecked',
+        action='store_true',
+        help='Skip checking for reads of uninitialised registers and memory.'
+    )
+
+    parser.add_argument(
+        '--no-trace',
+        action='store_true',
+        help='Disable tracing of executed instructions.'
+    )
+
+    parser.add_argument(
+        '--trace-file',
+        type=pathlib.Path,
+        help='Write a binary trace to the file instead of printing it.'
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=pathlib.Path,
+        metavar='FILE',
+        help='Profile execution and write the report to the file.'
+    )
+
+    parser.add_argument(
+        '--no-halt-detect',
+        action='store_true',
+        help='Run until the timeout even if the core halts or gets stuck.'
+    )
+
+    parser.add_argument(
+        '--cycles',
+        action='store_true',
+        help='Estimate the cycles the RTL would take and print a summary.'
+    )
+
+    parser.add_argument(
+        '--checkpoint-at',
+        type=int,
+        metavar='N',
+        help='Save a checkpoint once N instructions have been executed.'
+    )
+
+    parser.add_argument(
+        '--checkpoint-file',
+        type=pathlib.Path,
+        help='Checkpoint file to save, defaulting to the input with .ickpt.'
+    )
+
+    parser.add_argument(
+        '--resume',
+        type=pathlib.Path,
+        metavar='FILE',
+        help='Resume from a checkpoint instead of starting from reset.'
+    )
+
     parser.add_argument(
         '-i',
         '--uart-in',
@@ -603,70 +2024,126 @@ def parse_args():
         help='UART expected output file.'
     )
 
+    parser.add_argument(
+        '--stream-in',
+        metavar='FILE',
+        help='Stream raw UART input from a file, or - for stdin.'
+    )
+
+    parser.add_argument(
+        '--stream-out',
+        metavar='FILE',
+        help='Stream raw UART output to a file, or - for stdout.'
+    )
+
     args = parser.parse_args()
 
     if not args.input.is_file():
         raise Exception(f'Bad input file: {args.input}')
 
-    # Convert input and output data into byte buffers.
-    args.uart_in = tb.load_uart_file(args.uart_in)
-    args.uart_out = tb.load_uart_file(args.uart_out)
+    if args.resume and not args.resume.is_file():
+        raise Exception(f'Bad checkpoint file: {args.resume}')
 
-    return args
+    # The timeout covers instructions run before the checkpoint was saved when
+    # resuming, so the checkpoint must be within it.
+    if args.checkpoint_at is not None and args.checkpoint_at > args.timeout:
+        raise Exception(f'Checkpoint beyond timeout: {args.checkpoint_at}')
 
+    if args.checkpoint_file is None:
+        args.checkpoint_file = args.input.with_suffix('.ickpt')
 
-# Entry point for standalone simulation.
-if __name__ == '__main__':
-    args = parse_args()
-
-    # Create a callback to feed the data into the core and read it out.
-    class Callback(IdliCallback):
-        def __init__(self, uart_in):
-            self.uart_in = uart_in
-            self.uart_out = bytes()
-
-        def read_uart(self, width):
-            if width == 1:
-                value, = struct.unpack_from('<b', self.uart_in)
-                self.uart_in = self.uart_in[1:]
-            else:
-                value, = struct.unpack_from('<h', self.uart_in)
-                self.uart_in = self.uart_in[2:]
+    # Streamed output isn't held in memory so can't be compared, and can't be
+    # mixed with the trace on stdout.
+    if args.stream_in and args.uart_in:
+        raise Exception('Cannot stream UART input with an input file')
 
-            return value
+    if args.stream_out and args.uart_out:
+        raise Exception('Cannot check UART output which is streamed')
 
-        def write_uart(self, value, width):
-            fmt = '<B' if width == 1 else '<H'
-            self.uart_out += struct.pack(fmt, value)
+    if args.stream_out == '-' and not args.no_trace and not args.trace_file:
+        raise Exception('Cannot stream UART output to stdout when tracing')
 
-    # Create the simulator.
-    cb = Callback(args.uart_in)
-    sim = Idli(args.input, trace=True, callback=cb)
+    # Convert input and output data into byte buffers. There's nothing to check
+    # the output against if no file is given.
+    args.uart_in = load_uart_file(args.uart_in) if args.uart_in else bytes()
+    args.uart_out = load_uart_file(args.uart_out) if args.uart_out else None
 
-    # Run the test until we see the END string followed by return value or hit
-    # the timeout.
-    end_str = 'END'.encode('utf-8')
-    finished = False
+    return args
 
-    for i in range(args.timeout):
-        sim.tick()
 
-        finished = cb.uart_out[-5:-2] == end_str
-        if finished:
-            break
+# Entry point for standalone simulation.
+if __name__ == '__main__':
+    args = parse_args()
 
-    # Check we passed.
-    if not finished:
-        raise Exception(f'Test exceeded timeout!')
+    # Create the simulator.
+    if args.trace_file:
+        trace = tracefile.BinaryTracer(args.trace_file)
+    else:
+        trace = not args.no_trace
+
+    if args.stream_in:
+        uart_in = channel.open_input(args.stream_in)
+    else:
+        uart_in = channel.BufferInput(args.uart_in)
+
+    if args.stream_out:
+        uart_out = channel.open_output(args.stream_out)
+    else:
+        uart_out = channel.BufferOutput()
+
+    cb = UartCallback(uart_in, uart_out)
+    sim = Idli(
+        args.input,
+        trace=trace,
+        callback=cb,
+        decode_cache=not args.no_decode_cache,
+        use_jit=args.jit,
+        profile=args.profile is not None,
+        timed=args.cycles,
+        checked=not args.unchecked,
+    )
 
-    exit_code, = struct.unpack_from('<h', cb.uart_out[-2:])
-    if exit_code:
-        raise Exception(f'Test exited with code: {exit_code}')
+    # When resuming, skip the UART input already consumed and restore the output
+    # written before the checkpoint, which is saved with it.
+    if args.resume:
+        cb.uart_out.restore(sim.load_checkpoint(args.resume), sim.uart_tx)
+        cb.uart_in.skip(sim.uart_rx)
 
-    # Check the output matched the expected value.
-    if args.uart_out != cb.uart_out[:-5]:
-        raise Exception(
-            f'Test UART output differed from expected value:\n'
-            f'  Expected: {args.uart_out}\n'
-            f'  Actual:   {cb.uart_out[:-5]}'
-        )
+    # Run the test until we see the END string followed by return value or hit
+    # the timeout, stopping to save a checkpoint on the way if requested. The
+    # trace and profile are written even if the run fails so they can be used
+    # to debug the failure.
+    end = UartSentinel(cb.uart_out, b'END', trailer=2)
+    stop = [end]
+    result = None
+
+    # Stop straight away if the test halts or gets stuck rather than waiting for
+    # the timeout.
+    if not args.no_halt_detect:
+        stop += [Halted(), Idle()]
+
+    try:
+        if (
+            args.checkpoint_at is not None
+            and args.checkpoint_at >= sim.instructions
+        ):
+            result = sim.run(args.checkpoint_at - sim.instructions, stop=stop)
+            if result.reason == 'limit':
+                sim.save_checkpoint(args.checkpoint_file, cb.uart_out.data)
+
+        if result is None or result.reason == 'limit':
+            result = sim.run(args.timeout - sim.instructions, stop=stop)
+    finally:
+        uart_in.close()
+        uart_out.close()
+
+        if sim.trace is not None:
+            sim.trace.close()
+
+        if sim.profile is not None:
+            prof.write(sim.profile, sim, args.input, args.profile)
+
+        if sim.timing is not None:
+            print('\n'.join(timing.report(sim.timing)))
+
+    check_test(result, end, cb.uart_out, args.uart_out)
@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import pathlib
+import socket
+import struct
+import sys
+
+
+# Default path of the socket the daemon listens on.
+SOCKET = pathlib.Path(os.environ.get('IDLI_SIMD_SOCKET', 'build/simd.sock'))
+
+# Messages between the client and daemon are frames holding the sizes of a JSON
+# header and raw data, then the header and data themselves.
+_FRAME = struct.Struct('>II')
+
+
+# Read exactly the number of bytes from a socket, returning None if it's closed
+# before any are read.
+def _recv_exact(sock, size):
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if not data:
+                return None
+
+            raise Exception('Connection closed part way through a message')
+
+        data += chunk
+
+    return bytes(data)
+
+
+# Send a frame with a header, which is any value that can be converted to JSON,
+# and optional raw data.
+def send_frame(sock, header, data=b''):
+    body = json.dumps(header).encode()
+    sock.sendall(_FRAME.pack(len(body), len(data)) + body + data)
+
+
+# Receive a frame, returning the header and data, or None if the connection has
+# been closed.
+def recv_frame(sock):
+    sizes = _recv_exact(sock, _FRAME.size)
+    if sizes is None:
+        return None
+
+    body_size, data_size = _FRAME.unpack(sizes)
+    body = _recv_exact(sock, body_size) if body_size else b''
+    data = _recv_exact(sock, data_size) if data_size else b''
+
+    if body is None or data is None:
+        raise Exception('Connection closed part way through a message')
+
+    return json.loads(body), data
+
+
+# Send a request to the daemon and wait for the response.
+def request(path, header):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError as e:
+            raise Exception(f'Cannot connect to simulator daemon: {e}')
+
+        send_frame(sock, header)
+        response = recv_frame(sock)
+
+    if response is None:
+        raise Exception('Simulator daemon closed the connection')
+
+    return response
+
+
+# Get the absolute path of a file if given, as the daemon has its own working
+# directory.
+def _resolve(path):
+    return None if path is None else str(path.resolve())
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'input',
+        metavar='INPUT',
+        type=pathlib.Path,
+        nargs='?',
+        help='Path to input binary.'
+    )
+
+    parser.add_argument(
+        '-s',
+        '--socket',
+        type=pathlib.Path,
+        default=SOCKET,
+        help='Socket the simulator daemon is listening on.'
+    )
+
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        type=int,
+        default=5000,
+        help='Maximum ticks to run before ending the test.'
+    )
+
+    parser.add_argument(
+        '--jit',
+        action='store_true',
+        help='Compile basic blocks into Python functions to run them.'
+    )
+
+    parser.add_argument(
+        '--unchecked',
+        action='store_true',
+        help='Skip checking for reads of uninitialised registers and memory.'
+    )
+
+    parser.add_argument(
+        '--no-halt-detect',
+        action='store_true',
+        help='Run until the timeout even if the core halts or gets stuck.'
+    )
+
+    parser.add_argument(
+        '-i',
+        '--uart-in',
+        type=pathlib.Path,
+        help='UART input file.'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--uart-out',
+        type=pathlib.Path,
+        help='UART expected output file.'
+    )
+
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print the result as JSON instead of failing on errors.'
+    )
+
+    parser.add_argument(
+        '--stop',
+        action='store_true',
+        help='Stop the simulator daemon instead of running a test.'
+    )
+
+    args = parser.parse_args()
+
+    if args.stop:
+        return args
+
+    if args.input is None or not args.input.is_file():
+        raise Exception(f'Bad input file: {args.input}')
+
+    for path in (args.uart_in, args.uart_out):
+        if path is not None and not path.is_file():
+            raise Exception(f'Bad UART file: {path}')
+
+    return args
+
+
+# Submit a test to the simulator daemon, which runs it as the standalone
+# simulator does without tracing.
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.stop:
+        request(args.socket, {'op': 'stop'})
+        sys.exit()
+
+    result, output = request(args.socket, {
+        'op':           'run',
+        'binary':       _resolve(args.input),
+        'uart_in':      _resolve(args.uart_in),
+        'uart_out':     _resolve(args.uart_out),
+        'timeout':      args.timeout,
+        'jit':          args.jit,
+        'unchecked':    args.unchecked,
+        'halt_detect':  not args.no_halt_detect,
+    })
+
+    if args.json:
+        result['output'] = output.decode('latin-1')
+        print(json.dumps(result, indent=4))
+    elif not result['passed']:
+        raise Exception(result['error'])
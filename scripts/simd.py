@@ -0,0 +1,363 @@
+import argparse
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import pathlib
+import pickle
+import socket
+import socketserver
+import threading
+import time
+
+import sim
+import simc
+
+
+# Default number of program images kept loaded.
+CACHE_SIZE = 64
+
+
+# Program images loaded by the daemon, kept until the binary changes or they're
+# the least recently used once the cache is full. The daemon owns the images
+# and their files, which workers open copies of. Images are shared by the jobs
+# running them, so an image dropped from the cache is only closed once the last
+# job using it has finished:
+# - images      Map from path to the stat of the file when loaded, the image
+#               and the image pickled to send to workers.
+# - users       Number of jobs using each image.
+class ImageCache:
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.images = collections.OrderedDict()
+        self.users = collections.Counter()
+        self.lock = threading.Lock()
+
+    # Get the stat, image and pickled image for a binary, loading it if it isn't
+    # cached or has changed since it was loaded. The image must be released once
+    # finished with.
+    def acquire(self, path):
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+        with self.lock:
+            entry = self.images.get(path)
+
+            if entry is not None and entry[0] == key:
+                self.images.move_to_end(path)
+            else:
+                if entry is not None:
+                    self._drop(path)
+
+                image = sim.ProgramImage(path)
+                entry = (key, image, pickle.dumps(image))
+                self.images[path] = entry
+
+                while len(self.images) > self.size:
+                    self._drop(next(iter(self.images)))
+
+            self.users[entry[1]] += 1
+
+        return entry
+
+    # Finish with an image, closing it if it has been dropped from the cache and
+    # nothing else is using it.
+    def release(self, image):
+        with self.lock:
+            self.users[image] -= 1
+            if self.users[image]:
+                return
+
+            del self.users[image]
+
+            entry = self.images.get(image.path)
+            if entry is None or entry[1] is not image:
+                image.close()
+
+    # Close all the images.
+    def close(self):
+        with self.lock:
+            for _, image, _ in self.images.values():
+                image.close()
+
+            self.images.clear()
+
+    # Remove an image from the cache, closing it unless it's in use.
+    def _drop(self, path):
+        _, image, _ = self.images.pop(path)
+        if not self.users[image]:
+            image.close()
+
+
+# Copies of the daemon's images opened by a worker process, which are kept open
+# for later jobs running the same binary. The copies don't own the files, so
+# closing one only closes the worker's handle:
+# - images      Map from path to the stat of the file when loaded and copy.
+# - size        Maximum number of copies kept open.
+class WorkerImages:
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.images = collections.OrderedDict()
+
+    # Get the copy of the image for a binary, unpickling the image sent by the
+    # daemon if there isn't one open or the binary has changed.
+    def get(self, path, key, state):
+        entry = self.images.get(path)
+
+        if entry is not None and entry[0] == key:
+            self.images.move_to_end(path)
+            return entry[1]
+
+        if entry is not None:
+            entry[1].close()
+
+        image = pickle.loads(state)
+        self.images[path] = (key, image)
+
+        while len(self.images) > self.size:
+            _, (_, dropped) = self.images.popitem(last=False)
+            dropped.close()
+
+        return image
+
+
+# Images opened by this process when it's a worker.
+_worker_images = WorkerImages()
+
+
+# Set up a worker process, which keeps as many images open as the daemon.
+def init_worker(cache_size):
+    _worker_images.size = cache_size
+
+
+# Create the result of a test, which is sent back to the client.
+def new_result():
+    return {
+        'passed': False,
+        'error': None,
+        'reason': None,
+        'instructions': 0,
+        'time': 0.0,
+    }
+
+
+# Run a test as the standalone simulator does without tracing, returning a dict
+# of the results and the UART output. This runs in a worker process so any
+# exception from the test is caught and reported in the result. The image is
+# the key and pickled image from the daemon's cache.
+def run_job(key, state, job):
+    result = new_result()
+    output = b''
+    start = time.perf_counter()
+    idli = None
+
+    try:
+        uart_in = bytes()
+        if job['uart_in']:
+            uart_in = sim.load_uart_file(job['uart_in'])
+
+        expected = None
+        if job['uart_out']:
+            expected = sim.load_uart_file(job['uart_out'])
+
+        image = _worker_images.get(job['binary'], key, state)
+
+        cb = sim.UartCallback(uart_in)
+        idli = sim.Idli(
+            image,
+            callback=cb,
+            use_jit=job['jit'],
+            checked=not job['unchecked'],
+        )
+
+        end = sim.UartSentinel(cb.uart_out, b'END', trailer=2)
+        stop = [end]
+
+        if job['halt_detect']:
+            stop += [sim.Halted(), sim.Idle()]
+
+        run = idli.run(job['timeout'], stop=stop)
+        result['reason'] = run.reason
+        output = bytes(cb.uart_out.data)
+
+        sim.check_test(run, end, cb.uart_out, expected)
+        result['passed'] = True
+    except Exception as e:
+        result['error'] = str(e)
+
+    if idli is not None:
+        result['instructions'] = idli.instructions
+
+    result['time'] = time.perf_counter() - start
+    return result, output
+
+
+# Handler for a connection from a client, which sends requests one at a time
+# and waits for the response to each.
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            frame = simc.recv_frame(self.request)
+            if frame is None:
+                break
+
+            header, _ = frame
+            op = header.get('op')
+
+            if op == 'run':
+                result, output = self.server.run(header)
+                simc.send_frame(self.request, result, output)
+            elif op == 'stop':
+                simc.send_frame(self.request, {})
+
+                # Shutting down waits for the server loop to finish, which runs
+                # on another thread.
+                self.server.shutdown()
+                break
+            else:
+                simc.send_frame(self.request, {'error': f'Bad request: {op}'})
+
+
+# Daemon serving requests to run tests from clients over a Unix socket. Each
+# connection is handled on its own thread, and the tests are run by a pool of
+# worker processes forked once at startup, so they start with the ISA tables
+# already built. Loaded binaries are cached and shared with the workers:
+# - pool        Worker processes running the tests.
+# - images      Cache of loaded binaries.
+# - verbose     Whether to print the result of each test.
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, jobs, cache_size=CACHE_SIZE, verbose=False):
+        # Workers are forked from this process where possible, so they share the
+        # tables built on import.
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = None
+
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            jobs,
+            context,
+            initializer=init_worker,
+            initargs=(cache_size,),
+        )
+        self.images = ImageCache(cache_size)
+        self.verbose = verbose
+
+        # Start the workers now, before there are any other threads to fork.
+        self.pool.submit(int).result()
+
+        super().__init__(str(path), Handler)
+
+    # Run a test on the pool, returning the result and the UART output.
+    def run(self, job):
+        try:
+            key, image, state = self.images.acquire(job['binary'])
+        except Exception as e:
+            result = new_result()
+            result['error'] = str(e)
+
+            return result, b''
+
+        try:
+            future = self.pool.submit(run_job, key, state, job)
+            result, output = future.result()
+        finally:
+            self.images.release(image)
+
+        if self.verbose:
+            status = 'PASS' if result['passed'] else 'FAIL'
+            print(
+                f'{status}  {job["binary"]}  {result["instructions"]}'
+                f'  {result["time"]:.3f}s'
+            )
+
+        return result, output
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+        self.images.close()
+
+
+# Remove a socket left behind by a daemon which is no longer running, raising an
+# exception if it's still running.
+def remove_stale_socket(path):
+    if not path.exists():
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except ConnectionRefusedError:
+            path.unlink()
+            return
+
+    raise Exception(f'Simulator daemon already running: {path}')
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '-s',
+        '--socket',
+        type=pathlib.Path,
+        default=simc.SOCKET,
+        help='Socket to listen on for requests.'
+    )
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of tests to run in parallel.'
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=CACHE_SIZE,
+        help='Maximum number of binaries to keep loaded.'
+    )
+
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        help='Print the result of each test.'
+    )
+
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        raise Exception(f'Bad number of jobs: {args.jobs}')
+
+    if args.cache_size < 1:
+        raise Exception(f'Bad cache size: {args.cache_size}')
+
+    return args
+
+
+# Serve requests until stopped by a client or interrupted. The socket is removed
+# on the way out.
+if __name__ == '__main__':
+    args = parse_args()
+
+    remove_stale_socket(args.socket)
+    args.socket.parent.mkdir(parents=True, exist_ok=True)
+
+    daemon = Daemon(args.socket, args.jobs, args.cache_size, args.verbose)
+
+    with daemon:
+        print(f'Listening on: {args.socket}')
+
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            args.socket.unlink(missing_ok=True)
@@ -1,3 +1,4 @@
+import collections
 import struct
 
 import cocotb
@@ -6,6 +7,7 @@ from cocotb.triggers import (
     RisingEdge, FallingEdge, ClockCycles, Event, with_timeout
 )
 
+import channel
 import sim
 import sqi
 import uart
@@ -15,7 +17,7 @@ import uart
 class TestBenchCallback(sim.IdliCallback):
     def __init__(self, tb, uart_in):
         self.tb = tb
-        self.uart_in = uart_in
+        self.uart_in = channel.BufferInput(uart_in)
 
     def write_greg(self, reg, value):
         self.tb.check_greg_write(reg, value)
@@ -25,8 +27,7 @@ class TestBenchCallback(sim.IdliCallback):
 
     def read_uart(self, width):
         fmt = f'<{"BH"[width - 1]}'
-        value, = struct.unpack_from(fmt, self.uart_in)
-        self.uart_in = self.uart_in[width:]
+        value, = struct.unpack(fmt, self.uart_in.read(width))
 
         return value
 
@@ -56,7 +57,7 @@ class TestBench:
         self.log('BENCH: INIT BEGIN')
 
         self.cb = TestBenchCallback(self, uart_in)
-        self.sim = sim.Idli(path, callback=self.cb)
+        self.sim = sim.Idli(path, callback=self.cb, timed=True)
 
         self.mem = [
             sqi.SQIMemory(verbose=True, log=lambda x: self.log(f'SQI0: {x}')),
@@ -64,12 +65,12 @@ class TestBench:
         ]
         self._backdoor_load(path)
 
-        self.sim_uart_rx = []
-        self.rtl_uart_rx = []
-        self.ref_uart_rx = [x for x, in struct.iter_unpack('<B', uart_out)]
+        self.sim_uart_rx = collections.deque()
+        self.rtl_uart_rx = collections.deque()
+        self.ref_uart_rx = collections.deque(uart_out)
 
-        self.sim_st_data = []
-        self.rtl_st_data = []
+        self.sim_st_data = collections.deque()
+        self.rtl_st_data = collections.deque()
 
         # Add 'END' to the expected UART RX output - this will be followed by
         # the exit code.
@@ -83,6 +84,10 @@ class TestBench:
         )
 
         self.timeout = timeout
+
+        # Number of cycles since reset, for comparing with the estimate from
+        # the timing model in the simulator.
+        self.cycles = 0
         self.exit_code = []
         self.end_of_test = Event()
 
@@ -158,6 +163,7 @@ class TestBench:
 
         while True:
             await RisingEdge(self.dut.gck)
+            self.cycles += 1
 
             done = instr_done.value
             skip = instr_skip.value
@@ -186,8 +192,8 @@ class TestBench:
     # Check simulator and RTL UART match.
     def _check_uart_data(self):
         while self.sim_uart_rx and self.rtl_uart_rx:
-            sim = self.sim_uart_rx.pop(0)
-            rtl = self.rtl_uart_rx.pop(0)
+            sim = self.sim_uart_rx.popleft()
+            rtl = self.rtl_uart_rx.popleft()
 
             self.log(f'UART: sim=0x{sim:02x} rtl=0x{rtl:02x}')
             assert sim == rtl
@@ -195,7 +201,7 @@ class TestBench:
             # Check the output matches the expected from the file, and if we've
             # reached the end of the test then this is the exit code.
             if self.ref_uart_rx:
-                ref = self.ref_uart_rx.pop(0)
+                ref = self.ref_uart_rx.popleft()
                 assert ref == rtl
             else:
                 self.exit_code.append(sim)
@@ -271,6 +277,12 @@ class TestBench:
         else:
             self.log('BENCH: TEST TIMEOUT')
 
+        # Log the cycles taken so the timing model can be calibrated.
+        self.log(
+            f'BENCH: cycles rtl={self.cycles} '
+            f'model={self.sim.timing.cycles}'
+        )
+
         self._check_uart_data()
         if self.sim_uart_rx:
             raise Exception(f'Outstanding sim UART: {self.sim_uart_rx}')
@@ -286,19 +298,3 @@ class TestBench:
         # Check the exit code is correct.
         if self.exit_code != 0:
             raise Exception(f'Bad exit code from test: {self.exit_code}')
-
-
-# Load UART values for test input or output. These files are formatted as a
-# single 16b value per line.
-def load_uart_file(path):
-    data = bytes()
-
-    with open(path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-
-            data += struct.pack('<h', int(line, 0))
-
-    return data
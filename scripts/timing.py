@@ -0,0 +1,174 @@
+# Costs in core clock cycles (GCK) derived from the RTL. These assume the test
+# bench setup, where the UART is clocked at one bit per GCK and the SQI memories
+# respond on every SCK, which is half the frequency of GCK.
+#
+# Each 16b word is fetched from the SQI memories and decoded at 4b per cycle,
+# and the execute stage in idli_ex_m processes 16b over four cycles. These are
+# pipelined, so each instruction takes four cycles for every word it occupies.
+# Skipped instructions are still fetched and decoded, so cost the same.
+WORD_CYCLES = 4
+
+# When EX redirects the PC the SQI state machine goes back to RESET and has to
+# send the READ instruction, four nibbles of address and a dummy byte before
+# the first 16b of data can be clocked in. This is 11 SCK, or 22 GCK, plus the
+# two cycles EX takes to push the address before the SQI sees the redirect.
+REDIRECT_CYCLES = 24
+
+# Cycles between reset and the first instruction executing, which is the same
+# restart of the SQI as a redirect plus decode of the first instruction.
+RESET_CYCLES = REDIRECT_CYCLES + WORD_CYCLES
+
+# The test bench only starts sending a byte to the core once the core stalls
+# waiting for it. The start bit and eight data bits are shifted in one per
+# cycle, then the stall is released after the buffer becomes valid and the clock
+# gate updates on the next falling edge.
+UART_RX_CYCLES = 11
+
+# The UART transmitter is busy for the cycles it accepts the byte in IDLE and
+# START, then for each of the eight data bits. EX stalls on UART TX until the
+# transmitter is IDLE again.
+UART_TX_CYCLES = 10
+
+# The high byte of a 16b UART transfer is sent or received on the third cycle
+# of the instruction in EX.
+UART_HI_OFFSET = 2
+
+# Loads, stores, and compare with zero and branch are split into two operations
+# that each take a pass through EX. Push and pop are split into an operation to
+# adjust SP followed by one for each register transferred.
+INSTRS_VOP = set([
+    'ld',
+    '!ld',
+    'ld!',
+    'st',
+    '!st',
+    'st!',
+    'beqz',
+    'bnez',
+    'bltz',
+    'blez',
+    'bgtz',
+    'bgez',
+])
+
+# Instructions that access data memory, which needs the SQI to be redirected
+# to the data address and then back to the PC again.
+INSTRS_MEM = set([
+    'ld',
+    '!ld',
+    'ld!',
+    'st',
+    '!st',
+    'st!',
+    'push',
+    'pop',
+])
+
+
+# Timing model for the core, estimating the number of cycles a program takes
+# from the instructions it runs. This is only approximate as it doesn't model
+# everything the RTL does, but accounts for the main costs:
+# - cycles      Estimated total cycles, including those before the first
+#               instruction executes.
+# - words       Cycles spent fetching, decoding and executing instructions.
+# - redirects   Cycles spent restarting the SQI after taken branches and jumps.
+# - ops         Cycles spent on the extra operations that instructions are split
+#               into in EX.
+# - memory      Cycles spent redirecting the SQI for loads, stores, push and
+#               pop.
+# - uart        Cycles stalled waiting on the UART.
+class Timing:
+    def __init__(self):
+        self.cycles = RESET_CYCLES
+        self.words = 0
+        self.redirects = 0
+        self.ops = 0
+        self.memory = 0
+        self.uart = 0
+
+        # Cycle at which the UART transmitter will next be idle.
+        self.tx_idle = 0
+
+        # Number of instructions counted and how many of those were skipped.
+        self.instructions = 0
+        self.skipped = 0
+
+    # Count an instruction which was either run or skipped, and whether it
+    # redirected the PC when it ran.
+    def count(self, instr, run, redirect):
+        name = instr.name
+        words = WORD_CYCLES * instr.size()
+
+        self.instructions += 1
+        self.words += words
+
+        if not run:
+            self.skipped += 1
+            self.cycles += words
+            return
+
+        start = self.cycles
+        stall = 0
+
+        if name in ('urxb', 'urx'):
+            stall = UART_RX_CYCLES * (1 if name == 'urxb' else 2)
+        elif name in ('utxb', 'utx'):
+            stall = self._uart_tx(start, name == 'utx')
+
+        ops = 0
+        if name in INSTRS_VOP:
+            ops = WORD_CYCLES
+        elif name in ('push', 'pop'):
+            ops = WORD_CYCLES * bin(instr.ops['d']).count('1')
+
+        memory = 2 * REDIRECT_CYCLES if name in INSTRS_MEM else 0
+
+        self.ops += ops
+        self.memory += memory
+        self.uart += stall
+        self.cycles = start + words + ops + memory + stall
+
+        if redirect:
+            self.redirects += REDIRECT_CYCLES
+            self.cycles += REDIRECT_CYCLES
+
+    # Get the number of cycles stalled for a UART transmit starting on the
+    # specified cycle, updating when the transmitter will be idle.
+    def _uart_tx(self, start, high):
+        begin = max(start, self.tx_idle)
+        self.tx_idle = begin + UART_TX_CYCLES
+        stall = begin - start
+
+        if high:
+            hi = begin + UART_HI_OFFSET
+            hi_begin = max(hi, self.tx_idle)
+            self.tx_idle = hi_begin + UART_TX_CYCLES
+            stall += hi_begin - hi
+
+        return stall
+
+    # Average cycles per instruction.
+    def cpi(self):
+        return self.cycles / self.instructions if self.instructions else 0
+
+
+# Generate a summary of where the estimated cycles were spent.
+def report(timing):
+    total = timing.cycles
+
+    def line(name, cycles):
+        percent = 100 * cycles / total if total else 0
+        return f'  {name:12}{cycles:12} {percent:6.2f}%'
+
+    return [
+        f'Estimated cycles: {total}',
+        f'Instructions:     {timing.instructions} '
+        f'({timing.skipped} skipped)',
+        f'CPI:              {timing.cpi():.3f}',
+        line('reset', RESET_CYCLES),
+        line('words', timing.words),
+        line('redirects', timing.redirects),
+        line('ops', timing.ops),
+        line('memory', timing.memory),
+        line('uart', timing.uart),
+    ]
@@ -0,0 +1,251 @@
+import argparse
+import collections
+import mmap
+import pathlib
+import struct
+import sys
+
+import isa
+
+
+# Binary traces start with this header, which includes the format version.
+MAGIC = b'IDLITRC1'
+
+# Every event in a binary trace is a fixed size record:
+# - kind        Type of event, one of the constants below.
+# - arg         Register, predicate, UART width or instruction size.
+# - addr        PC of the instruction or memory address.
+# - value       Value written or read, or the instruction encoding.
+# - extra       Word following the instruction in memory, for immediates.
+RECORD = struct.Struct('<BBHHH')
+
+# Record kinds.
+RUN = 0
+SKIP = 1
+GREG = 2
+PREG = 3
+BRANCH = 4
+LOAD = 5
+STORE = 6
+URX = 7
+UTX = 8
+
+# Decoded trace record.
+Record = collections.namedtuple('Record', 'kind arg addr value extra')
+
+# Number of records buffered by the writer before flushing to the file.
+BUFFER_RECORDS = 1 << 14
+
+
+# Format the value transferred over the UART.
+def _format_uart(value, width):
+    if width == 1:
+        return f'0x{value & 0xff:02x}'
+    else:
+        return f'0x{value & 0xffff:04x}'
+
+
+# Trace printing each event as a line of text. This is the format produced by
+# the simulator when tracing to stdout.
+class TextTracer:
+    def run(self, pc, instr, this_word, next_word):
+        print(f'RUN     0x{pc:04x}    {instr}')
+
+    def skip(self, pred):
+        print(f'SKIP    {isa.PREGS_INV[pred]}')
+
+    def greg(self, reg, value):
+        print(f'GREG    {isa.GREGS_INV[reg]}        0x{value:04x}')
+
+    def preg(self, reg, value):
+        print(f'PREG    {isa.PREGS_INV[reg]}        0x{int(value)}')
+
+    def branch(self, pc):
+        print(f'BRANCH  0x{pc:04x}')
+
+    def load(self, addr, value):
+        print(f'LOAD    0x{addr:04x}    0x{value:04x}')
+
+    def store(self, addr, value):
+        print(f'STORE   0x{addr:04x}    0x{value:04x}')
+
+    def urx(self, value, width):
+        print(f'URX     {_format_uart(value, width):6}')
+
+    def utx(self, value, width):
+        print(f'UTX     {_format_uart(value, width):6}')
+
+    def close(self):
+        pass
+
+
+# Trace writing each event as a binary record. Records are packed into a buffer
+# which is written to the file whenever it fills, so close() must be called to
+# write out the final records.
+class BinaryTracer:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+
+        self.buf = bytearray(RECORD.size * BUFFER_RECORDS)
+        self.pos = 0
+
+    def _write(self, kind, arg, addr, value, extra):
+        RECORD.pack_into(self.buf, self.pos, kind, arg, addr, value, extra)
+        self.pos += RECORD.size
+
+        if self.pos == len(self.buf):
+            self.flush()
+
+    def run(self, pc, instr, this_word, next_word):
+        self._write(RUN, instr.size(), pc, this_word, next_word)
+
+    def skip(self, pred):
+        self._write(SKIP, pred, 0, 0, 0)
+
+    def greg(self, reg, value):
+        self._write(GREG, reg, 0, value, 0)
+
+    def preg(self, reg, value):
+        self._write(PREG, reg, 0, int(value), 0)
+
+    def branch(self, pc):
+        self._write(BRANCH, 0, pc, 0, 0)
+
+    def load(self, addr, value):
+        self._write(LOAD, 0, addr, value, 0)
+
+    def store(self, addr, value):
+        self._write(STORE, 0, addr, value, 0)
+
+    def urx(self, value, width):
+        self._write(URX, width, 0, value & 0xffff, 0)
+
+    def utx(self, value, width):
+        self._write(UTX, width, 0, value & 0xffff, 0)
+
+    # Write any buffered records to the file.
+    def flush(self):
+        self.file.write(memoryview(self.buf)[:self.pos])
+        self.pos = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Reader for binary traces. The file is mapped into memory and records are only
+# decoded as they're iterated over. Any partial record at the end of the file,
+# such as from a simulator that was killed, is ignored.
+class TraceReader:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise Exception(f'Bad trace file: {path}')
+
+        self.count = (len(self.map) - len(MAGIC)) // RECORD.size
+
+        # Instructions are decoded once for each distinct encoding.
+        self.instrs = {}
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.records()
+
+    # Iterate over the records, optionally starting from the specified index.
+    def records(self, start=0):
+        begin = len(MAGIC) + start * RECORD.size
+        end = len(MAGIC) + self.count * RECORD.size
+
+        with memoryview(self.map) as view:
+            for fields in RECORD.iter_unpack(view[begin:end]):
+                yield Record._make(fields)
+
+    # Get the instruction executed by a RUN record.
+    def instr(self, record):
+        key = (record.value, record.extra, record.arg)
+        instr = self.instrs.get(key)
+
+        if instr is None:
+            next_word = record.extra if record.arg > 1 else None
+            instr = isa.Instruction.from_words(record.value, next_word)
+            self.instrs[key] = instr
+
+        return instr
+
+    # Render a record in the text trace format.
+    def format(self, record):
+        kind, arg, addr, value, extra = record
+
+        if kind == RUN:
+            return f'RUN     0x{addr:04x}    {self.instr(record)}'
+        elif kind == SKIP:
+            return f'SKIP    {isa.PREGS_INV[arg]}'
+        elif kind == GREG:
+            return f'GREG    {isa.GREGS_INV[arg]}        0x{value:04x}'
+        elif kind == PREG:
+            return f'PREG    {isa.PREGS_INV[arg]}        0x{value}'
+        elif kind == BRANCH:
+            return f'BRANCH  0x{addr:04x}'
+        elif kind == LOAD:
+            return f'LOAD    0x{addr:04x}    0x{value:04x}'
+        elif kind == STORE:
+            return f'STORE   0x{addr:04x}    0x{value:04x}'
+        elif kind == URX:
+            return f'URX     {_format_uart(value, arg):6}'
+        elif kind == UTX:
+            return f'UTX     {_format_uart(value, arg):6}'
+        else:
+            raise Exception(f'Bad trace record kind: {kind}')
+
+    # Iterate over the lines of the text trace.
+    def lines(self, start=0):
+        for record in self.records(start):
+            yield self.format(record)
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Parse command line arguments.
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'input',
+        metavar='INPUT',
+        type=pathlib.Path,
+        help='Path to binary trace to print as text.',
+    )
+
+    args = parser.parse_args()
+
+    if not args.input.is_file():
+        raise Exception(f'Bad input file: {args.input}')
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    with TraceReader(args.input) as reader:
+        sys.stdout.writelines(f'{x}\n' for x in reader.lines())
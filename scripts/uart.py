@@ -1,4 +1,4 @@
-import struct
+import collections
 
 
 # UART transmitter and receiver for connecting to the RTL.
@@ -22,9 +22,9 @@ class UART:
         # Callbacks for pushing/pulling new data.
         self.rx_cb = rx_cb
 
-        # Convert TX data into an array of 8b integers for pushing data in one
+        # Convert TX data into a queue of 8b integers for pushing data in one
         # bit at a time in 8b chunks.
-        self.tx_data = [x for x, in struct.iter_unpack('<B', self.tx_data)]
+        self.tx_data = collections.deque(self.tx_data)
 
     # Rising edge of the clock.
     def rising_edge(self, rx, tx_start):
@@ -96,7 +96,7 @@ class UART:
             # move to stop, otherwise send the next bit.
             if cycle >= 7:
                 self.tx_state = 'stop'
-                self.tx_data.pop(0)
+                self.tx_data.popleft()
 
                 if self.verbose:
                     self.log('UART TX data done')
@@ -9,6 +9,7 @@ import pathlib
 
 import cocotb
 
+import sim
 import tb
 
 
@@ -18,8 +19,8 @@ async def run_test(dut):
     # Parse arguments from the environment.
     path = pathlib.Path(os.environ['IDLI_RUN_TEST_BINARY'])
     timeout = int(os.environ['IDLI_RUN_TEST_TIMEOUT'])
-    inputs = tb.load_uart_file(os.environ['IDLI_RUN_TEST_IN'])
-    outputs = tb.load_uart_file(os.environ['IDLI_RUN_TEST_OUT'])
+    inputs = sim.load_uart_file(os.environ['IDLI_RUN_TEST_IN'])
+    outputs = sim.load_uart_file(os.environ['IDLI_RUN_TEST_OUT'])
 
     if not path.is_file():
         raise Exception(f'Bad input binary: {path}')